@@ -0,0 +1,208 @@
+# ASGI 模式：在 asyncio 事件迴圈上服務同一套路由與遊戲邏輯
+# 用法: uvicorn asgi:app --host 0.0.0.0 --port 10000   (原本的 python v8.py 照常可用)
+# 一般請求交給執行緒池執行原本的 Flask 處理函式 (鎖與 SQLite 都可能阻塞，不能放在事件迴圈上)；
+# 長輪詢等待期間只是一個協程，不佔執行緒，因此能同時掛住大量閒置連線
+# 巡邏員 (期限排程器) 改為事件迴圈中的非同步任務，只有處理到期房間時才借用執行緒
+import asyncio
+import io
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.exceptions import HTTPException
+
+import v8
+
+WORKER_THREADS = 32  # 執行 Flask 處理函式的執行緒數，只需涵蓋「同時在處理中」的請求
+
+
+class AsgiApp:
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.executor = ThreadPoolExecutor(WORKER_THREADS, thread_name_prefix="asgi")
+        self.loop = None
+        self.waiters = {}  # room_code -> 等待此房間變動的 asyncio.Event 集合 (只在事件迴圈中修改)
+        self.deadline_event = None
+        self.reaper = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan': await self.lifespan(receive, send)
+        elif scope['type'] == 'http': await self.http(scope, receive, send)
+
+    def run(self, fn, *args):
+        return self.loop.run_in_executor(self.executor, fn, *args)
+
+    # --- 啟動與關閉 ---
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.startup()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.reaper: self.reaper.cancel()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def startup(self):
+        self.loop = asyncio.get_running_loop()
+        self.deadline_event = asyncio.Event()
+        v8.room_change_listeners.append(self.room_changed)
+        v8.deadline_listeners.append(lambda: self.loop.call_soon_threadsafe(self.deadline_event.set))
+        v8.compile_index_page()
+        if v8.start_background_tasks(reaper=False):
+            self.reaper = self.loop.create_task(self.reaper_task())
+
+    # --- HTTP ---
+    async def http(self, scope, receive, send):
+        body = await self.read_body(scope, receive)
+        if body is None:
+            # 超過 MAX_BODY_BYTES：不必讀完也不必借用執行緒，直接回 413
+            v8.rejected_requests.inc("body_too_large")
+            data = json.dumps({"success": False, "message": "請求內容過大"}).encode()
+            await send({'type': 'http.response.start', 'status': 413, 'headers': [(b'content-type', b'application/json')]})
+            await send({'type': 'http.response.body', 'body': data})
+            return
+        environ = self.wsgi_environ(scope, body)
+        if scope['path'] == '/room_updates' and scope['method'] == 'POST':
+            # 不經過 Flask 的完整流程 (before/after_request)，在這裡自己記錄處理時間與慢請求分項
+            start = time.perf_counter()
+            if v8.slow_request_seconds: environ['avalon.trace'] = [0.0, 0.0, 0.0]
+            status, headers, data = await self.room_updates(environ, body)
+            elapsed = time.perf_counter() - start
+            v8.request_seconds.observe(elapsed, '/room_updates', status)
+            v8.check_slow_request('/room_updates', status, elapsed, environ.get('avalon.trace'))
+        else:
+            status, headers, data = await self.run(self.call_wsgi, environ)
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        if isinstance(data, bytes):
+            await send({'type': 'http.response.body', 'body': data})
+            return
+        # 串流回應 (例如遊戲紀錄匯出)：每次借用執行緒取下一段，邊產生邊送出，不在記憶體中組成整個內容
+        try:
+            while True:
+                chunk = await self.run(next, data, None)
+                if chunk is None: break
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(data, 'close'): await self.run(data.close)
+
+    async def read_body(self, scope, receive):
+        # 先看 Content-Length，再邊讀邊檢查累積長度；超過上限回傳 None
+        for name, value in scope['headers']:
+            if name == b'content-length' and value.isdigit() and int(value) > v8.MAX_BODY_BYTES: return None
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if len(body) > v8.MAX_BODY_BYTES: return None
+            if not message.get('more_body'): return body
+
+    def wsgi_environ(self, scope, body):
+        server_name, server_port = scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': scope['method'], 'SCRIPT_NAME': scope.get('root_path', ''),
+            'PATH_INFO': scope['path'], 'QUERY_STRING': scope['query_string'].decode('latin-1'),
+            'SERVER_NAME': server_name, 'SERVER_PORT': str(server_port),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'REMOTE_ADDR': (scope.get('client') or ('', 0))[0], 'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0), 'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body), 'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True, 'wsgi.multiprocess': False, 'wsgi.run_once': False,
+        }
+        for name, value in scope['headers']:
+            key = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if key == 'CONTENT_TYPE': environ['CONTENT_TYPE'] = value
+            elif key != 'CONTENT_LENGTH':
+                key = 'HTTP_' + key
+                environ[key] = f"{environ[key]},{value}" if key in environ else value
+        return environ
+
+    def call_wsgi(self, environ):
+        result = {}
+        def start_response(status, headers, exc_info=None):
+            result['status'], result['headers'] = status, headers
+        chunks = self.flask_app(environ, start_response)
+        if not any(k.lower() == 'content-length' for k, v in result['headers']):
+            # 沒有 Content-Length 的是串流回應，交給 http() 逐段送出
+            return self.asgi_response(int(result['status'].split()[0]), result['headers'], iter(chunks))
+        try: data = b''.join(chunks)
+        finally:
+            if hasattr(chunks, 'close'): chunks.close()
+        return self.asgi_response(int(result['status'].split()[0]), result['headers'], data)
+
+    def asgi_response(self, status, headers, data):
+        return status, [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers], data
+
+    # --- 長輪詢 ---
+    async def room_updates(self, environ, body):
+        response = await self.run(self.room_updates_step, environ, body, False)
+        if response is None:
+            data = json.loads(body)
+            wait_start = time.perf_counter()
+            await self.wait_for_room_change(data.get('roomCode'), data.get('version'), v8.LONG_POLL_TIMEOUT)
+            if 'avalon.trace' in environ: environ['avalon.trace'][v8.TRACE_WAIT] += time.perf_counter() - wait_start
+            response = await self.run(self.room_updates_step, environ, body, True)
+        return response
+
+    def room_updates_step(self, environ, body, final):
+        environ = dict(environ, **{'wsgi.input': io.BytesIO(body)})
+        with self.flask_app.request_context(environ):
+            try: rv = v8.room_updates_step(final)
+            except HTTPException as e: rv = self.flask_app.handle_user_exception(e)
+            if rv is None: return None
+            response = self.flask_app.make_response(rv)
+            return self.asgi_response(response.status_code, response.headers.to_wsgi_list(), response.get_data())
+
+    async def wait_for_room_change(self, room_code, since, timeout):
+        # 與 v8.wait_for_room_change 相同的語意；先登記再檢查版本，避免漏掉兩者之間的通知
+        event = asyncio.Event()
+        self.waiters.setdefault(room_code, set()).add(event)
+        deadline = self.loop.time() + timeout
+        try:
+            while (await self.run(v8.room_version, room_code) if v8.room_store.shared else v8.room_version(room_code)) == since:
+                remaining = deadline - self.loop.time()
+                if remaining <= 0: return
+                try: await asyncio.wait_for(event.wait(), min(remaining, v8.STORE_POLL_INTERVAL) if v8.room_store.shared else remaining)
+                except asyncio.TimeoutError: pass
+                event.clear()
+        finally:
+            waiters = self.waiters.get(room_code)
+            waiters.discard(event)
+            if not waiters: del self.waiters[room_code]
+
+    def room_changed(self, room_code):
+        # 可能在任何執行緒被呼叫；只有確實有協程在等這個房間時才排入事件迴圈
+        if room_code in self.waiters: self.loop.call_soon_threadsafe(self.wake, room_code)
+
+    def wake(self, room_code):
+        for event in self.waiters.get(room_code, ()): event.set()
+
+    # --- 期限排程器 ---
+    async def reaper_task(self):
+        # 與 v8.reaper_task 相同的流程，改以 await 等待；選舉、同步與處理房間會碰到鎖或 SQLite，交給執行緒池
+        while not await self.run(v8.room_store.is_reaper): await asyncio.sleep(v8.REAP_INTERVAL)
+        v8.scheduler_active = True
+        known_versions, next_sync = {}, 0
+        while True:
+            if time.time() >= next_sync:
+                start = time.perf_counter()
+                known_versions, next_sync = await self.run(v8.sync_room_deadlines, known_versions)
+                v8.reaper_seconds.observe(time.perf_counter() - start, "sync")
+            self.deadline_event.clear()
+            timeout = min(v8.next_room_deadline(), next_sync) - time.time()
+            if timeout > 0:
+                try: await asyncio.wait_for(self.deadline_event.wait(), None if timeout == float('inf') else timeout)
+                except asyncio.TimeoutError: pass
+            due = v8.take_due_rooms(time.time())
+            if not due: continue
+            start = time.perf_counter()
+            for room_code in due:
+                await self.run(v8.run_room_deadline, room_code)
+            v8.reaper_seconds.observe(time.perf_counter() - start, "deadlines")
+
+
+app = AsgiApp(v8.app)
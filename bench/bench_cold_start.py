@@ -0,0 +1,91 @@
+# 冷啟動基準測試：從啟動行程到 /healthz 有回應 (開始監聽)、/readyz 回 200 (可接流量) 的時間，以及第一次載入網頁的延遲
+# 另外在本行程內比較網頁的兩種產生方式：每次 render_template，與啟動時預先產生 (含 gzip) 後直接送出
+# 用法: python bench/bench_cold_start.py [重複次數]
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def servers(port):
+    yield "python v8.py", [sys.executable, "v8.py"]
+    yield "uvicorn asgi:app", [sys.executable, "-m", "uvicorn", "asgi:app", "--port", str(port), "--log-level", "warning"]
+    if shutil.which("gunicorn"):
+        yield "gunicorn v8:create_app()", ["gunicorn", "-b", f"127.0.0.1:{port}", "--threads", "8", "v8:create_app()"]
+
+def get(url, headers=None):
+    start = time.perf_counter()
+    with urllib.request.urlopen(urllib.request.Request(url, headers=headers or {}), timeout=5) as r:
+        body = r.read()
+    return r.status, body, time.perf_counter() - start
+
+def wait_for(url, deadline):
+    while time.perf_counter() < deadline:
+        try:
+            if get(url)[0] == 200: return time.perf_counter()
+        except (urllib.error.URLError, ConnectionError, OSError):
+            pass
+        time.sleep(0.005)
+    raise TimeoutError(url)
+
+def measure(cmd, port):
+    env = dict(os.environ, PORT=str(port))
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        base = f"http://127.0.0.1:{port}"
+        live = wait_for(base + "/healthz", start + 30)
+        ready = wait_for(base + "/readyz", start + 30)
+        _, body, first_page = get(base + "/", {"Accept-Encoding": "gzip"})
+        return live - start, ready - start, first_page, len(body)
+    finally:
+        proc.terminate()
+        proc.wait()
+
+def in_process(n=200):
+    import v8
+    client = v8.app.test_client()
+    with v8.app.app_context():
+        start = time.perf_counter()
+        v8.render_template('index.html', all_roles=v8.ALL_ROLES, wire_strings=v8.wire.STRINGS)
+        first_render = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(n): v8.render_template('index.html', all_roles=v8.ALL_ROLES, wire_strings=v8.wire.STRINGS)
+        render = (time.perf_counter() - start) / n
+    start = time.perf_counter()
+    v8.compile_index_page()
+    compile_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(n): client.get('/', headers={"Accept-Encoding": "gzip"})
+    served = (time.perf_counter() - start) / n
+    page = v8.index_page
+    print(f"網頁: 第一次 render_template {first_render * 1000:.1f} ms (含載入並編譯模板)，之後每次 {render * 1000:.2f} ms；"
+          f"預先產生 (含 gzip) {compile_time * 1000:.1f} ms，之後每個請求 {served * 1000:.2f} ms (含 Flask 處理)")
+    print(f"網頁大小: {len(page.html)} bytes，gzip 後 {len(page.gzipped)} bytes")
+
+if __name__ == "__main__":
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "import v8"], cwd=ROOT, check=True)
+    print(f"import v8 (含直譯器啟動): {(time.perf_counter() - start) * 1000:.0f} ms")
+    for label, cmd in servers(free_port()):
+        results = []
+        for _ in range(repeat):
+            port = free_port()
+            cmd = [str(port) if i and cmd[i - 1] == "--port" else arg for i, arg in enumerate(cmd)]
+            results.append(measure(cmd, port))
+        live, ready, first_page, size = (statistics.median(col) for col in zip(*results))
+        print(f"{label:26s} 開始監聽 {live * 1000:6.0f} ms  可接流量 {ready * 1000:6.0f} ms  第一次載入網頁 {first_page * 1000:5.1f} ms ({size:.0f} bytes)")
+    in_process()
@@ -0,0 +1,88 @@
+# 遊戲紀錄基準測試：寫入大量合成的對局後，量測寫入速度、玩家統計 / 條件查詢的延遲，以及串流匯出時的記憶體
+# 玩家名稱從 PLAYER_POOL 個名字中抽出 (熱門玩家的局數會遠多於平均)，結束時間分散在最近一年
+# 用法: python bench/bench_game_history.py [局數]
+import datetime
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from game_engine import ROLE_CONFIG, ROLE_NAMES, Role, is_evil
+from game_history import GameHistory
+
+PLAYER_POOL = 50000
+HOT_PLAYERS = 20  # 這些玩家出現在約 5% 的座位上
+YEAR = 365 * 86400
+
+def synthetic_game(i, rng, now):
+    n = rng.choice(list(ROLE_CONFIG))
+    good, evil = ROLE_CONFIG[n]
+    roles = good + evil; rng.shuffle(roles)
+    names = set()
+    while len(names) < n:
+        names.add(f"hot{rng.randrange(HOT_PLAYERS)}" if rng.random() < 0.05 else f"p{rng.randrange(PLAYER_POOL)}")
+    good_won = rng.random() < 0.45
+    ended_at = now - rng.random() * YEAR
+    duration = rng.uniform(600, 2400) * 1000
+    players = [(name, role, is_evil(role)) for name, role in zip(names, roles)]
+    return {"room_code": f"R{i:07d}", "started_at": ended_at - duration / 1000, "ended_at": ended_at, "duration": duration,
+            "good_won": good_won, "reason": "壞人贏得了 3 個任務。" if not good_won else "好人贏得了 3 個任務 (無刺客)。",
+            "players": players,
+            "data": {"players": [{"name": p, "role": ROLE_NAMES[r], "faction": "evil" if e else "good"} for p, r, e in players],
+                     "missions": [{"mission_num": m, "leader": p, "team": [p], "result": "success", "fails": 0} for m, (p, _, _) in enumerate(players[:3], 1)]}}
+
+def timed(fn, repeat=20):
+    start = time.perf_counter()
+    for _ in range(repeat): result = fn()
+    return (time.perf_counter() - start) / repeat * 1000, result
+
+def main(n_games):
+    base = tempfile.mkdtemp(prefix="avalon-history-")
+    try:
+        history = GameHistory(os.path.join(base, "history.db"))
+        history.start()
+        rng, now = random.Random(1), time.time()
+        start = time.perf_counter()
+        for i in range(n_games):
+            history.append(synthetic_game(i, rng, now))
+            if i % 10000 == 9999: history.flush()  # 讓佇列不要無限制地變長
+        history.flush()
+        elapsed = time.perf_counter() - start
+        size = sum(os.path.getsize(os.path.join(base, f)) for f in os.listdir(base))
+        print(f"寫入 {n_games} 局: {elapsed:.1f} s ({n_games / elapsed:.0f} 局/s)，檔案 {size / 1e6:.1f} MB ({size / n_games:.0f} bytes/局)")
+
+        last_month = (datetime.date.fromtimestamp(now) - datetime.timedelta(days=30))
+        since = datetime.datetime.combine(last_month, datetime.time()).timestamp()
+        queries = [
+            ("熱門玩家統計", lambda: history.player_stats("hot0")["games"]),
+            ("熱門玩家近 30 天統計", lambda: history.player_stats("hot0", since=since)["games"]),
+            ("一般玩家統計", lambda: history.player_stats("p123")["games"]),
+            ("熱門玩家 梅林 + 善良勝 統計", lambda: history.player_stats("hot0", role=Role.MERLIN, good_won=True)["games"]),
+            ("最近 20 局", lambda: len(history.games(20))),
+            ("梅林 + 邪惡勝 最近 20 局", lambda: len(history.games(20, role=Role.MERLIN, good_won=False))),
+            ("熱門玩家 + 梅林 最近 20 局", lambda: len(history.games(20, player="hot0", role=Role.MERLIN))),
+            ("近 30 天 善良勝 最近 20 局", lambda: len(history.games(20, good_won=True, since=since))),
+        ]
+        for label, fn in queries:
+            ms, result = timed(fn)
+            print(f"  {label}: {ms:.2f} ms (結果 {result})")
+
+        start = time.perf_counter()
+        exported = sum(chunk.count('\n') for chunk in history.export())
+        elapsed = time.perf_counter() - start
+        # tracemalloc 會大幅拖慢速度，記憶體高峰另外只看前 EXPORT_BATCH * 20 局 (之後每一批都一樣)
+        tracemalloc.start()
+        for i, _ in enumerate(history.export()):
+            if i == 20: break
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"串流匯出 {exported} 局: {elapsed:.1f} s ({exported / elapsed:.0f} 局/s)，Python 記憶體高峰 {peak / 1e6:.1f} MB")
+    finally:
+        shutil.rmtree(base)
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
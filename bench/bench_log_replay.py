@@ -0,0 +1,102 @@
+# 事件日誌基準測試：大量房間時，重啟恢復 (只重播日誌 / 快照 + 少量日誌) 需要多久
+# 先以測試客戶端完整玩幾局 (隨機出手) 取得真實的事件紀錄，再複製到數千個房號上
+# 用法: python bench/bench_log_replay.py [房間數 ...]
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+BASE_DIR = tempfile.mkdtemp(prefix="avalon-log-")
+os.environ["GAME_LOG_DIR"] = os.path.join(BASE_DIR, "source")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import v8
+from game_log import GameLog
+
+GAMES = 4
+
+def play_game(client, n_players):
+    r = client.post('/create_room', json={'playerName': 'P0'}).get_json()
+    code, tokens = r['roomCode'], {'P0': r['token']}
+    client.post('/update_settings', json={'roomCode': code, 'token': tokens['P0'], 'settings': {'maxPlayers': n_players}})
+    for i in range(1, n_players):
+        tokens[f'P{i}'] = client.post('/join_room', json={'playerName': f'P{i}', 'roomCode': code}).get_json()['token']
+        client.post('/toggle_ready', json={'roomCode': code, 'token': tokens[f'P{i}']})
+    client.post('/start_game', json={'roomCode': code, 'token': tokens['P0']})
+    while True:
+        for name, token in tokens.items():
+            gs = client.post('/room_state', json={'roomCode': code, 'token': token}).get_json()['gameState']
+            if gs['phase'] == 'end': return
+            me = gs['my_info']
+            act = lambda action, value: client.post('/action', json={'roomCode': code, 'token': token, 'action': action, 'value': value})
+            if gs['phase'] == 'team_building' and gs['is_leader']:
+                act('propose_team', {'team': random.sample(gs['player_order'], gs['mission_team_size'])})
+            elif gs['phase'] == 'team_vote':
+                act('vote_team', {'vote': random.choice(['approve', 'approve', 'reject'])})
+            elif gs['phase'] == 'mission_vote' and gs['is_on_mission']:
+                act('mission_vote', {'vote': 'fail' if me['is_evil'] and random.random() < 0.5 else 'success'})
+            elif gs['phase'] == 'lady_of_the_lake' and gs['is_lady_holder']:
+                act('use_lady', {'target': random.choice([p for p in gs['player_order'] if p != name and p not in gs['lady_used_on']])})
+            elif gs['phase'] == 'assassination' and me['role'] == '刺客':
+                act('assassinate', {'target': random.choice([p for p in gs['player_order'] if p not in me['known_evil']])})
+
+def record_games():
+    random.seed(1)
+    v8.game_log.start()
+    client = v8.app.test_client()
+    for i in range(GAMES): play_game(client, 7 + i % 4)
+    v8.game_log.flush()
+    games = {}
+    for record in v8.game_log.records(0):
+        games.setdefault(record[1], []).append(record)
+    return list(games.values())
+
+def write_log(directory, games, n_rooms):
+    # 每個房間使用其中一局的紀錄 (換上新房號)，依時間交錯寫入，模擬許多桌同時進行
+    os.makedirs(directory)
+    rows = []
+    for i in range(n_rooms):
+        code = f"R{i:05d}"
+        for seq, record in enumerate(games[i % len(games)]):
+            rows.append((seq, i, json.dumps([record[0], code] + record[2:], ensure_ascii=False, separators=(',', ':'))))
+    rows.sort()
+    with open(os.path.join(directory, "events-000001.log"), 'w', encoding='utf-8') as f:
+        f.write('\n'.join(row[2] for row in rows) + '\n')
+    return len(rows)
+
+def reset(directory):
+    v8.rooms.clear(); v8.room_runtime.clear(); v8.player_tokens.clear()
+    v8.room_store = v8.create_room_store("memory", None, v8.rooms)
+    v8.game_log = GameLog(directory)
+
+def run(games, n_rooms):
+    directory = os.path.join(BASE_DIR, f"rooms-{n_rooms}")
+    n_records = write_log(directory, games, n_rooms)
+    size = os.path.getsize(os.path.join(directory, "events-000001.log"))
+
+    reset(directory)
+    t0 = time.perf_counter()
+    recovered, _ = v8.recover_rooms()
+    replay_time = time.perf_counter() - t0
+
+    # 以恢復後的狀態寫入快照 (舊分段隨之刪除)，再測一次只讀快照的恢復
+    v8.game_log.start()
+    v8.take_snapshot()
+    reset(directory)
+    t0 = time.perf_counter()
+    v8.recover_rooms()
+    snapshot_time = time.perf_counter() - t0
+
+    print(f"rooms={recovered:6d}  records={n_records:8d}  log={size / 1e6:7.1f}MB  "
+          f"replay={replay_time:6.2f}s ({n_records / replay_time:8.0f} rec/s)  snapshot={snapshot_time:6.2f}s")
+
+if __name__ == "__main__":
+    counts = [int(x) for x in sys.argv[1:]] or [100, 1000, 5000]
+    try:
+        games = record_games()
+        for n in counts:
+            run(games, n)
+    finally:
+        shutil.rmtree(BASE_DIR, ignore_errors=True)
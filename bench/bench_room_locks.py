@@ -0,0 +1,75 @@
+# 併發基準測試：房間數增加時，/room_state 的 p99 延遲應維持平穩
+# 用法: python bench/bench_room_locks.py [房間數 ...]
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import v8
+
+POLL_THREADS = 8
+BUSY_THREADS = 2
+DURATION = 3.0
+
+def setup_rooms(client, n_rooms):
+    seats = []
+    for i in range(n_rooms):
+        r = client.post('/create_room', json={'playerName': 'P0'}).get_json()
+        code = r['roomCode']
+        seats.append((code, r['token']))
+        for j in range(1, 5):
+            t = client.post('/join_room', json={'playerName': f'P{j}', 'roomCode': code}).get_json()['token']
+            seats.append((code, t))
+    return seats
+
+def percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+def run(n_rooms):
+    v8.rooms.clear(); v8.room_runtime.clear(); v8.player_tokens.clear()
+    v8.room_store = v8.create_room_store("memory", None, v8.rooms)
+    client = v8.app.test_client()
+    seats = setup_rooms(client, n_rooms)
+    host_code, host_token = seats[0]
+    stop = threading.Event()
+    latencies = [[] for _ in range(POLL_THREADS)]
+
+    def poller(out):
+        c = v8.app.test_client()
+        while not stop.is_set():
+            code, token = random.choice(seats)
+            t0 = time.perf_counter()
+            c.post('/room_state', json={'roomCode': code, 'token': token})
+            out.append(time.perf_counter() - t0)
+
+    def busy_room():
+        # 單一忙碌房間不斷修改設定，模擬熱門桌
+        c = v8.app.test_client()
+        while not stop.is_set():
+            c.post('/update_settings', json={'roomCode': host_code, 'token': host_token, 'settings': {'useLady': random.random() < 0.5}})
+
+    def reaper():
+        # 連續讓每個房間的期限到期，放大巡邏對輪詢的影響 (實際上只有到期的房間才會被處理)
+        while not stop.is_set():
+            for room_code in v8.room_store.codes():
+                v8.run_room_deadline(room_code)
+
+    threads = [threading.Thread(target=poller, args=(latencies[i],)) for i in range(POLL_THREADS)]
+    threads += [threading.Thread(target=busy_room) for _ in range(BUSY_THREADS)]
+    threads.append(threading.Thread(target=reaper))
+    for t in threads: t.start()
+    time.sleep(DURATION)
+    stop.set()
+    for t in threads: t.join()
+
+    samples = [x for out in latencies for x in out]
+    print(f"rooms={n_rooms:6d}  polls={len(samples):7d}  p50={percentile(samples, 0.50) * 1000:6.2f}ms  "
+          f"p99={percentile(samples, 0.99) * 1000:6.2f}ms  max={max(samples) * 1000:7.2f}ms")
+
+if __name__ == "__main__":
+    counts = [int(x) for x in sys.argv[1:]] or [10, 100, 1000, 5000]
+    for n in counts:
+        run(n)
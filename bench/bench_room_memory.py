@@ -0,0 +1,102 @@
+# 記憶體與 CPU 基準：透過一般路由建立大量 10 人房間 (一半留在大廳、一半開始遊戲)，
+# 量測每個房間常駐的記憶體，以及遊戲動作本身 (不含 HTTP) 的 CPU 時間
+# 記憶體列出兩種：從 rooms / room_runtime / player_tokens / room_snapshots 走訪到的物件總大小 (精確)，與行程 RSS 的增加量 (含配置器的零碎空間)
+# 遊戲進行只依賴客戶端看得到的投影 (build_room_view / build_viewer_view)，不直接讀取房間內部結構
+# 用法: python bench/bench_room_memory.py [房間數]
+import gc
+import os
+import random
+import sys
+import time
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import v8
+
+N_PLAYERS = 10
+
+def rss_bytes():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"): return int(line.split()[1]) * 1024
+
+def deep_size(*roots):
+    # 走訪所有可達的物件加總 sys.getsizeof；型別、模組、函式是共用的，不算在房間上
+    skip = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType)
+    seen, stack, total = set(), list(roots), 0
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, skip): continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        stack.extend(gc.get_referents(obj))
+    return total
+
+def setup_rooms(client, n_rooms):
+    games = []
+    for i in range(n_rooms):
+        r = client.post('/create_room', json={'playerName': 'P0'}).get_json()
+        code, host = r['roomCode'], r['token']
+        client.post('/update_settings', json={'roomCode': code, 'token': host, 'settings': {'maxPlayers': N_PLAYERS}})
+        for j in range(1, N_PLAYERS):
+            token = client.post('/join_room', json={'playerName': f'P{j}', 'roomCode': code}).get_json()['token']
+            client.post('/toggle_ready', json={'roomCode': code, 'token': token})
+        if i % 2:
+            client.post('/start_game', json={'roomCode': code, 'token': host})
+            games.append(code)
+    return games
+
+def next_action(code, rng):
+    # 依房間投影決定下一個合法動作: (玩家, 動作, 參數)；遊戲結束時回傳 None
+    gs = v8.build_room_view(code)['gameState']
+    phase, order = gs['phase'], gs['player_order']
+    if phase == 'team_building':
+        return gs['current_leader'], 'propose_team', {'team': rng.sample(order, gs['mission_team_size'])}
+    if phase == 'team_vote':
+        name = next(p for p in order if p not in gs['voted'])
+        return name, 'vote_team', {'vote': 'approve' if rng.random() < 0.7 else 'reject'}
+    if phase == 'mission_vote':
+        name = next(p for p in gs['team_proposal'] if p not in gs['mission_voted'])
+        return name, 'mission_vote', {'vote': 'fail' if rng.random() < 0.3 else 'success'}
+    if phase == 'lady_of_the_lake':
+        holder = next(p for p in order if v8.build_viewer_view(code, p)['gameState']['is_lady_holder'])
+        return holder, 'use_lady', {'target': rng.choice([p for p in order if p not in gs['lady_used_on']])}
+    if phase == 'assassination':
+        return order[0], 'assassinate', {'target': rng.choice(order)}
+    return None
+
+def play(games, rng):
+    # 輪流在每個遊戲中的房間各做一個動作，直到全部結束；只計 process_game_action 本身的時間
+    elapsed, actions = 0.0, 0
+    active = list(games)
+    while active:
+        still = []
+        for code in active:
+            step = next_action(code, rng)
+            if step is None: continue
+            with v8.locked_room(code):
+                t0 = time.perf_counter()
+                v8.process_game_action(code, *step)
+                elapsed += time.perf_counter() - t0
+            actions += 1
+            still.append(code)
+        active = still
+    return elapsed, actions
+
+if __name__ == "__main__":
+    n_rooms = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    random.seed(1)
+    client = v8.app.test_client()
+    client.post('/create_room', json={'playerName': 'warmup'})  # 先載入模板、路由等一次性的東西
+    gc.collect()
+    base = rss_bytes()
+    t0 = time.perf_counter()
+    games = setup_rooms(client, n_rooms)
+    v8.lock_wait_samples.clear()
+    gc.collect()
+    used = rss_bytes() - base
+    objects = deep_size(v8.rooms, v8.room_runtime, v8.player_tokens, v8.room_snapshots)
+    print(f"{n_rooms} 個房間 ({len(games)} 個遊戲中)，建立 {time.perf_counter() - t0:.1f} 秒")
+    print(f"記憶體: 物件 {objects / n_rooms / 1024:.2f} KB/房間，RSS {used / n_rooms / 1024:.2f} KB/房間 (共 {used / 2**20:.1f} MB)")
+    elapsed, actions = play(games, random.Random(2))
+    print(f"遊戲動作: {actions} 次，每次 {elapsed / actions * 1e6:.2f} µs")
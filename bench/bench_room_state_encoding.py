@@ -0,0 +1,81 @@
+# 編碼基準測試：10 人房間遊戲中途，每個版本所有玩家各輪詢一次，比較每次輪詢的編碼成本
+#   jsonify           每位玩家都以 jsonify 重新編碼整份狀態 (原本的作法)
+#   fragments         逐欄位編碼，但不快取全房間共用的部分
+#   snapshot          每個版本發布一次快照 (共用部分與每位玩家的欄位都預先編碼)，輪詢只合併兩者
+# 後兩者分別以標準 json 與 orjson (有安裝時) 測試
+# 用法: python bench/bench_room_state_encoding.py [版本數]
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import v8
+from game_engine import Phase
+from flask import jsonify
+
+N_PLAYERS = 10
+
+def setup_room():
+    random.seed(1)
+    client = v8.app.test_client()
+    r = client.post('/create_room', json={'playerName': 'P0'}).get_json()
+    code, tokens = r['roomCode'], {'P0': r['token']}
+    client.post('/update_settings', json={'roomCode': code, 'token': r['token'], 'settings': {'maxPlayers': N_PLAYERS}})
+    for i in range(1, N_PLAYERS):
+        tokens[f'P{i}'] = client.post('/join_room', json={'playerName': f'P{i}', 'roomCode': code}).get_json()['token']
+        client.post('/toggle_ready', json={'roomCode': code, 'token': tokens[f'P{i}']})
+    client.post('/start_game', json={'roomCode': code, 'token': r['token']})
+    # 推進到第 4 個任務，讓任務紀錄、投票紀錄等共用欄位有實際的大小
+    gs = v8.rooms[code].game
+    while gs.mission_number < 4 and gs.phase != Phase.END:
+        if gs.phase == Phase.TEAM_BUILDING:
+            leader = gs.player_order[gs.current_leader_index]
+            v8.process_game_action(code, leader, 'propose_team', {'team': random.sample(gs.player_order, gs.mission_team_sizes[gs.mission_number - 1])})
+        elif gs.phase == Phase.TEAM_VOTE:
+            for name in gs.player_order: v8.process_game_action(code, name, 'vote_team', {'vote': 'approve'})
+        elif gs.phase == Phase.MISSION_VOTE:
+            for name in list(gs.team_proposal): v8.process_game_action(code, name, 'mission_vote', {'vote': random.choice(['success', 'fail'])})
+        elif gs.phase == Phase.LADY_OF_THE_LAKE:
+            target = next(p for p in gs.player_order if p not in gs.lady_used_on)
+            v8.process_game_action(code, gs.lady_holder, 'use_lady', {'target': target})
+    return code
+
+def full_state(code, name):
+    view = v8.build_room_view(code)
+    own = v8.build_viewer_view(code, name)
+    view['gameState'] = {**view['gameState'], **own['gameState']}
+    return view
+
+def poll_jsonify(code, name):
+    return jsonify(full_state(code, name)).get_data()
+
+def poll_fragments(code, name):
+    return v8.join_fragments(v8.merge_fragments(v8.encode_fragments(v8.build_room_view(code)), v8.encode_fragments(v8.build_viewer_view(code, name))))
+
+def poll_snapshot(code, name):
+    # 版本號變了之後第一次讀取會發布新快照，攤到同一版本所有人的輪詢上
+    return v8.join_fragments(v8.room_state_fragments(code, name))
+
+def run(label, poll, code, versions):
+    names = list(v8.rooms[code].game.player_order)
+    room = v8.rooms[code]
+    with v8.app.test_request_context():
+        t0 = time.perf_counter()
+        for _ in range(versions):
+            room.version += 1  # 模擬每個版本都有變動，所有人各輪詢一次
+            for name in names: body = poll(code, name)
+        elapsed = time.perf_counter() - t0
+    print(f"{label:22s} {elapsed / (versions * len(names)) * 1e6:8.1f} µs/輪詢  {len(body):6d} bytes")
+
+if __name__ == "__main__":
+    versions = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    code = setup_room()
+    run("jsonify", poll_jsonify, code, versions)
+    backends = [("json", lambda value: json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode())]
+    if v8.orjson: backends.append(("orjson", v8.encode_json))
+    for backend, encode in backends:
+        v8.encode_json = v8.encode_fragment = encode
+        run(f"fragments/{backend}", poll_fragments, code, versions)
+        run(f"snapshot/{backend}", poll_snapshot, code, versions)
@@ -0,0 +1,108 @@
+# 服務模式比較：同步 (python v8.py，每個請求一條執行緒) 與 ASGI (uvicorn asgi:app)
+# 掛住大量閒置的長輪詢連線，同時量測一般 /room_state 輪詢的延遲與伺服器的執行緒數、記憶體
+# 用法: python bench/bench_serving.py [閒置連線數 ...]   (需要已安裝 uvicorn)
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PORT = 18700
+PLAYERS_PER_ROOM = 5
+POLLERS = 20
+DURATION = 5.0
+
+MODES = {
+    "sync": [sys.executable, "v8.py"],
+    "asgi": [sys.executable, "-m", "uvicorn", "asgi:app", "--port", str(PORT), "--log-level", "warning"],
+}
+
+async def post(path, body):
+    reader, writer = await asyncio.open_connection("127.0.0.1", PORT)
+    try:
+        data = json.dumps(body).encode()
+        writer.write(f"POST {path} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n"
+                     f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode() + data)
+        await writer.drain()
+        head = (await reader.readuntil(b"\r\n\r\n")).decode("latin-1").split("\r\n")
+        headers = dict(line.lower().split(": ", 1) for line in head[1:] if ": " in line)
+        payload = await reader.readexactly(int(headers.get("content-length", 0)))
+        return int(head[0].split()[1]), json.loads(payload) if payload[:1] == b"{" else None
+    finally:
+        writer.close()
+
+async def setup_seats(n_seats):
+    seats = []
+    while len(seats) < n_seats:
+        status, r = await post("/create_room", {"playerName": "P0"})
+        seats.append([r["roomCode"], r["token"], None])
+        joins = [post("/join_room", {"playerName": f"P{j}", "roomCode": r["roomCode"]}) for j in range(1, PLAYERS_PER_ROOM)]
+        for status, j in await asyncio.gather(*joins):
+            seats.append([r["roomCode"], j["token"], None])
+    return seats[:n_seats]
+
+async def holder(seat, stop, errors):
+    # 閒置玩家：一直掛著長輪詢，回來就帶新版本號再掛上
+    while not stop.is_set():
+        try:
+            status, r = await post("/room_updates", {"roomCode": seat[0], "token": seat[1], "version": seat[2], "delta": False})
+            if status == 200: seat[2] = r["version"]
+        except OSError:
+            errors.append(1)
+            await asyncio.sleep(0.5)
+
+async def poller(seats, stop, latencies):
+    while not stop.is_set():
+        code, token, _ = random.choice(seats)
+        t0 = time.perf_counter()
+        await post("/room_state", {"roomCode": code, "token": token})
+        latencies.append(time.perf_counter() - t0)
+
+def server_stats(pid):
+    stats = {}
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if key in ("Threads", "VmRSS"): stats[key] = value.split()[0]
+    return int(stats["Threads"]), int(stats["VmRSS"]) / 1024
+
+def percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+async def wait_until_up():
+    for _ in range(100):
+        try: return await post("/create_room", {"playerName": "probe"})
+        except OSError: await asyncio.sleep(0.1)
+    raise RuntimeError("伺服器沒有啟動")
+
+async def run(mode, n_idle):
+    env = dict(os.environ, PORT=str(PORT))
+    server = subprocess.Popen(MODES[mode], cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        await wait_until_up()
+        seats = await setup_seats(n_idle + POLLERS)
+        stop, errors, latencies = asyncio.Event(), [], []
+        holders = [asyncio.create_task(holder(seat, stop, errors)) for seat in seats[:n_idle]]
+        await asyncio.sleep(1.0)  # 讓長輪詢都掛上
+        pollers = [asyncio.create_task(poller(seats[n_idle:], stop, latencies)) for _ in range(POLLERS)]
+        await asyncio.sleep(DURATION)
+        threads, rss = server_stats(server.pid)
+        stop.set()
+        await asyncio.gather(*pollers)
+        for task in holders: task.cancel()
+        await asyncio.gather(*holders, return_exceptions=True)
+        print(f"{mode:4s}  idle={n_idle:5d}  polls/s={len(latencies) / DURATION:7.0f}  p50={percentile(latencies, 0.5) * 1000:7.2f}ms  "
+              f"p99={percentile(latencies, 0.99) * 1000:7.2f}ms  threads={threads:5d}  rss={rss:6.0f}MB  errors={len(errors)}")
+    finally:
+        server.terminate()
+        server.wait()
+
+if __name__ == "__main__":
+    counts = [int(x) for x in sys.argv[1:]] or [100, 1000, 3000]
+    for n in counts:
+        for mode in MODES:
+            asyncio.run(run(mode, n))
@@ -0,0 +1,76 @@
+# 傳輸格式基準測試：10 人房間遊戲中途，比較 JSON 與精簡格式 (MessagePack + 字串字典) 每次輪詢的大小與 CPU
+#   完整狀態     客戶端第一次輪詢或落後太多時收到的整份狀態
+#   差異         一位玩家投票後，其他人長輪詢收到的差異回應
+# 大小另外列出 gzip 後的結果 (反向代理有開壓縮時實際傳輸的量)；CPU 是完整狀態時 room_state_logic 的時間 (合併快照片段 + 編碼 + 建立回應)，
+# 「冷」表示清空片段轉換快取後的第一次 (每個新版本中改變的欄位都要付這個成本)
+# 用法: python bench/bench_wire_protocol.py [輪詢次數]
+import gzip
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import game_engine
+import v8
+import wire
+from bench_room_state_encoding import setup_room
+from game_engine import Phase
+
+FORMATS = (("json", "application/json"), ("msgpack", wire.MIMETYPE))
+
+def poll(code, name, accept, since=None):
+    with v8.app.test_request_context(headers={"Accept": accept}):
+        snap = v8.current_snapshot(code, v8.rooms[code])
+        return v8.room_state_logic(snap, code, name, since, since is not None).get_data()
+
+def per_poll_us(fn, n):
+    start = time.perf_counter()
+    for _ in range(n): fn()
+    return (time.perf_counter() - start) / n * 1e6
+
+def setup_game():
+    # 推進到第 4 個任務的隊伍投票 (任務結果成功、失敗交替，遊戲不會提早結束)
+    code = setup_room()
+    room = v8.rooms[code]
+    settings = room.settings
+    room.game = gs = game_engine.new_game(room.lobby_order, settings.custom_roles, settings.mission_track, settings.use_lady, False)
+    while gs.mission_number < 4 or gs.phase != Phase.TEAM_VOTE:
+        if gs.phase == Phase.TEAM_BUILDING:
+            leader = gs.player_order[gs.current_leader_index]
+            v8.process_game_action(code, leader, 'propose_team', {'team': gs.player_order[:gs.mission_team_sizes[gs.mission_number - 1]]})
+        elif gs.phase == Phase.TEAM_VOTE:
+            for p in gs.player_order: v8.process_game_action(code, p, 'vote_team', {'vote': 'approve'})
+        elif gs.phase == Phase.MISSION_VOTE:
+            vote = 'fail' if gs.mission_number % 2 == 0 else 'success'
+            for p in list(gs.team_proposal): v8.process_game_action(code, p, 'mission_vote', {'vote': vote})
+        elif gs.phase == Phase.LADY_OF_THE_LAKE:
+            target = next(p for p in gs.player_order if p not in gs.lady_used_on and p != gs.lady_holder)
+            v8.process_game_action(code, gs.lady_holder, 'use_lady', {'target': target})
+    room.version += 1
+    v8.publish_snapshot(code, room)
+    return code
+
+def main(n):
+    code = setup_game()
+    room = v8.rooms[code]
+    gs = room.game
+    name, voter = gs.player_order[1], gs.player_order[0]
+    base = room.version
+    full = {label: poll(code, name, accept) for label, accept in FORMATS}
+    v8.process_game_action(code, voter, 'vote_team', {'vote': 'approve'})
+    room.version += 1
+    v8.publish_snapshot(code, room)
+    delta = {label: poll(code, name, accept, base) for label, accept in FORMATS}
+
+    print(f"{'':10s} {'完整狀態':>10s} {'gzip':>6s} {'差異':>6s} {'gzip':>6s} {'µs/輪詢 (熱)':>14s} {'µs/輪詢 (冷)':>14s}")
+    snap = v8.current_snapshot(code, room)
+    for label, accept in FORMATS:
+        with v8.app.test_request_context(headers={"Accept": accept}):
+            hot = per_poll_us(lambda: v8.room_state_logic(snap, code, name).get_data(), n)
+            cold = per_poll_us(lambda: (wire.pack_fragment.cache_clear(), v8.room_state_logic(snap, code, name).get_data()), max(n // 10, 1))
+        print(f"{label:10s} {len(full[label]):10d} {len(gzip.compress(full[label])):6d} {len(delta[label]):6d} "
+              f"{len(gzip.compress(delta[label])):6d} {hot:14.1f} {cold:14.1f}")
+    print(f"字典 {len(wire.STRINGS)} 個字串，JSON {len(v8.encode_json({'id': wire.DICTIONARY_ID, 'strings': wire.STRINGS}))} bytes (每個客戶端只取一次)")
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
@@ -0,0 +1,251 @@
+# 負載測試：模擬 N 桌 5~10 人的完整阿瓦隆遊戲，全部經由真正的 HTTP 路由
+# 每位玩家約每 1.2 秒輪詢一次 /room_state (和網頁客戶端一樣帶版本號、收差異)，輪到自己時隨機出手；
+# 偶爾有玩家停止回應超過 TIMEOUT_SECONDS，讓巡邏員標成離線並代為行動，之後再以 /reconnect 回來
+# 一局結束後房主回到大廳、大家重新準備再開一局，直到測試時間結束
+# 預設在本行程內以 werkzeug 多執行緒伺服器 (與 app.run 相同) 啟動 v8，不需要網路；
+# 也可用 --url 指向已啟動的伺服器 (此時無法回報鎖等待時間)
+# 用法: python bench/load_test.py --tables 50 --duration 60 [--max-p99-ms 250 --max-error-rate 0.01 --json out.json]
+# 超過門檻時結束碼為 1，可用來擋住效能退步的版本
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+POLL_INTERVAL = 1.2
+THINK_TIME = (0.2, 1.5)      # 輪到自己後的思考時間 (秒)
+DISCONNECT_CHANCE = 0.002    # 每次輪詢時開始斷線的機率
+DISCONNECT_EXTRA = 5         # 斷線時間 = TIMEOUT_SECONDS + 此值 (秒)
+
+
+class Client:
+    def __init__(self, host, port):
+        self.host, self.port = host, port
+        self.latencies = defaultdict(list)  # 路由 -> 延遲 (秒)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        self.errors = 0
+
+    async def post(self, path, body):
+        t0 = time.perf_counter()
+        try:
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+        except OSError:
+            self.errors += 1
+            return None, None
+        try:
+            data = json.dumps(body).encode()
+            writer.write(f"POST {path} HTTP/1.1\r\nHost: {self.host}\r\nContent-Type: application/json\r\n"
+                         f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode() + data)
+            await writer.drain()
+            head = (await reader.readuntil(b"\r\n\r\n")).decode("latin-1").split("\r\n")
+            headers = dict(line.lower().split(": ", 1) for line in head[1:] if ": " in line)
+            payload = await reader.readexactly(int(headers.get("content-length", 0)))
+        except (OSError, asyncio.IncompleteReadError):
+            self.errors += 1
+            return None, None
+        finally:
+            writer.close()
+        status = int(head[0].split()[1])
+        self.latencies[path].append(time.perf_counter() - t0)
+        self.statuses[path][status] += 1
+        if status >= 500: self.errors += 1
+        return status, json.loads(payload) if payload[:1] == b"{" else None
+
+
+def apply_delta(base, delta):
+    # 與 index.html 的 applyDelta 相同
+    result = {k: v for k, v in base.items() if k not in delta["unset"]}
+    result.update(delta["set"])
+    for key, sub in delta["patch"].items(): result[key] = apply_delta(result.get(key) or {}, sub)
+    return result
+
+
+class Player:
+    def __init__(self, client, code, name, token, rng):
+        self.client, self.code, self.name, self.token, self.rng = client, code, name, token, rng
+        self.version, self.state = None, None
+        self.acted = None  # 上次出手時的 (版本號)，避免同一個狀態重複出手
+
+    async def poll(self):
+        status, r = await self.client.post("/room_state", {"roomCode": self.code, "token": self.token, "version": self.version, "delta": True})
+        return self.absorb(status, r)
+
+    def absorb(self, status, r):
+        # 套用 /room_state 或 /actions 回傳的狀態 (完整或差異)
+        if status != 200 or r is None: return status
+        if "delta" in r:
+            if self.state is None or r["base_version"] != self.version:
+                self.version = None
+                return status
+            r = dict(apply_delta(self.state, r["delta"]), version=r["version"])
+        self.version, self.state = r["version"], r
+        return status
+
+    def decide(self):
+        # 依目前狀態回傳 (路由, 內容)，沒事可做時回傳 None
+        state, rng = self.state, self.rng
+        me = next((p for p in state["players"] if p["name"] == self.name), None)
+        if me is None: return None
+        gs = state.get("gameState")
+        if gs is None:
+            if me["isHost"]:
+                if len(state["players"]) == state["settings"]["maxPlayers"] and all(p["isReady"] for p in state["players"]):
+                    return "/start_game", {}
+            elif not me["isReady"]:
+                return "/toggle_ready", {}
+            return None
+        info, phase = gs["my_info"], gs["phase"]
+        if phase == "end":
+            return ("/return_to_lobby", {}) if me["isHost"] else None
+        if phase == "team_building" and gs["is_leader"]:
+            return "/actions", {"action": "propose_team", "value": {"team": rng.sample(gs["player_order"], gs["mission_team_size"])}}
+        if phase == "team_vote" and gs["my_vote"] is None:
+            return "/actions", {"action": "vote_team", "value": {"vote": rng.choice(["approve", "approve", "reject"])}}
+        if phase == "mission_vote" and gs["is_on_mission"] and gs["my_mission_vote"] is None:
+            vote = "fail" if info["is_evil"] and rng.random() < 0.5 else "success"
+            return "/actions", {"action": "mission_vote", "value": {"vote": vote}}
+        if phase == "lady_of_the_lake" and gs["is_lady_holder"]:
+            targets = [p for p in gs["player_order"] if p != self.name and p not in gs["lady_used_on"]]
+            return "/actions", {"action": "use_lady", "value": {"target": rng.choice(targets)}}
+        if phase == "assassination" and info["role"] == "刺客":
+            targets = [p for p in gs["player_order"] if p not in info["known_evil"]]
+            return "/actions", {"action": "assassinate", "value": {"target": rng.choice(targets)}}
+        return None
+
+    async def run(self, stop, counters, timeout_seconds):
+        await asyncio.sleep(self.rng.uniform(0, POLL_INTERVAL))
+        while not stop.is_set():
+            if self.rng.random() < DISCONNECT_CHANCE:
+                counters["disconnects"] += 1
+                try:
+                    await asyncio.wait_for(stop.wait(), timeout_seconds + DISCONNECT_EXTRA)
+                    return
+                except asyncio.TimeoutError: pass
+                await self.client.post("/reconnect", {"roomCode": self.code, "token": self.token})
+                self.version = None
+                continue
+            next_poll = time.monotonic() + POLL_INTERVAL
+            status = await self.poll()
+            if status in (403, 404): return  # 被踢出或房間已刪除
+            action = self.decide() if self.state else None
+            if action and self.acted != self.version:
+                self.acted = self.version
+                await asyncio.sleep(self.rng.uniform(*THINK_TIME))
+                path, body = action
+                if path == "/actions":
+                    # 與網頁相同：動作以批次送出，回應就是新的狀態
+                    body = {"actions": [body], "version": self.version, "delta": True}
+                status, r = await self.client.post(path, dict(body, roomCode=self.code, token=self.token))
+                if path == "/actions": self.absorb(status, r)
+                if path == "/start_game" and r and r.get("success"): counters["games"] += 1
+            await asyncio.sleep(max(0.0, next_poll - time.monotonic()))
+
+
+async def open_table(client, n_players, rng):
+    status, r = await client.post("/create_room", {"playerName": "P0"})
+    if status != 200: return []
+    code = r["roomCode"]
+    await client.post("/update_settings", {"roomCode": code, "token": r["token"], "settings": {"maxPlayers": n_players}})
+    players = [Player(client, code, "P0", r["token"], rng)]
+    for i in range(1, n_players):
+        status, j = await client.post("/join_room", {"playerName": f"P{i}", "roomCode": code})
+        if status == 200: players.append(Player(client, code, f"P{i}", j["token"], rng))
+    return players
+
+
+def percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * q))] if samples else 0.0
+
+
+def start_local_server(port):
+    import v8
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args): pass
+
+    server = make_server("127.0.0.1", port, v8.app, threaded=True, request_handler=QuietHandler)
+    server.socket.listen(1024)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    v8.start_background_tasks()
+    return v8
+
+
+async def main(args):
+    rng = random.Random(args.seed)
+    v8 = None
+    if args.url:
+        target = urlsplit(args.url)
+        host, port = target.hostname, target.port or 80
+        timeout_seconds = args.timeout_seconds
+    else:
+        host, port = "127.0.0.1", args.port
+        v8 = start_local_server(port)
+        timeout_seconds = v8.TIMEOUT_SECONDS
+    client = Client(host, port)
+
+    tables = [await open_table(client, rng.randint(5, 10), rng) for _ in range(args.tables)]
+    if v8: v8.lock_wait_samples.clear()
+    client.latencies.clear(); client.statuses.clear(); client.errors = 0
+    stop, counters = asyncio.Event(), defaultdict(int)
+    started = time.perf_counter()
+    tasks = [asyncio.create_task(p.run(stop, counters, timeout_seconds)) for players in tables for p in players]
+    await asyncio.sleep(args.duration)
+    stop.set()
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+
+    all_latencies = [x for samples in client.latencies.values() for x in samples]
+    total = len(all_latencies) + client.errors
+    result = {
+        "tables": args.tables, "players": sum(len(t) for t in tables), "duration": round(elapsed, 1),
+        "requests": total, "throughput": round(total / elapsed, 1), "error_rate": round(client.errors / max(total, 1), 4),
+        "games_started": counters["games"], "disconnects": counters["disconnects"],
+        "routes": {path: {"count": len(samples), "p50_ms": round(percentile(samples, 0.5) * 1000, 2),
+                          "p99_ms": round(percentile(samples, 0.99) * 1000, 2), "statuses": dict(client.statuses[path])}
+                   for path, samples in sorted(client.latencies.items())},
+        "p50_ms": round(percentile(all_latencies, 0.5) * 1000, 2), "p99_ms": round(percentile(all_latencies, 0.99) * 1000, 2),
+    }
+    if v8:
+        waits = list(v8.lock_wait_samples)
+        result["lock_wait"] = {"count": len(waits), "p50_ms": round(percentile(waits, 0.5) * 1000, 3),
+                               "p99_ms": round(percentile(waits, 0.99) * 1000, 3), "max_ms": round(max(waits, default=0) * 1000, 3)}
+
+    print(f"{result['tables']} 桌 / {result['players']} 位玩家，{result['duration']} 秒：{result['requests']} 個請求 "
+          f"({result['throughput']} req/s)，錯誤率 {result['error_rate']:.2%}，開局 {result['games_started']} 次，斷線 {result['disconnects']} 次")
+    for path, r in result["routes"].items():
+        print(f"  {path:18s} n={r['count']:7d}  p50={r['p50_ms']:8.2f}ms  p99={r['p99_ms']:8.2f}ms  {r['statuses']}")
+    print(f"  {'全部':16s} p50={result['p50_ms']:8.2f}ms  p99={result['p99_ms']:8.2f}ms")
+    if "lock_wait" in result:
+        lw = result["lock_wait"]
+        print(f"  房間鎖等待 n={lw['count']}  p50={lw['p50_ms']}ms  p99={lw['p99_ms']}ms  max={lw['max_ms']}ms")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f: json.dump(result, f, ensure_ascii=False, indent=2)
+
+    failed = []
+    if args.max_p99_ms is not None and result["p99_ms"] > args.max_p99_ms: failed.append(f"p99 {result['p99_ms']}ms > {args.max_p99_ms}ms")
+    if args.max_error_rate is not None and result["error_rate"] > args.max_error_rate: failed.append(f"錯誤率 {result['error_rate']} > {args.max_error_rate}")
+    for reason in failed: print("未通過:", reason)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="阿瓦隆伺服器負載測試")
+    parser.add_argument("--tables", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=60)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--port", type=int, default=18800, help="本行程內伺服器使用的埠")
+    parser.add_argument("--url", help="改測已啟動的伺服器，例如 http://127.0.0.1:10000")
+    parser.add_argument("--timeout-seconds", type=float, default=10, help="--url 模式下伺服器的 TIMEOUT_SECONDS")
+    parser.add_argument("--max-p99-ms", type=float)
+    parser.add_argument("--max-error-rate", type=float)
+    parser.add_argument("--json", help="將結果寫成 JSON 檔")
+    sys.exit(asyncio.run(main(parser.parse_args())))
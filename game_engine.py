@@ -0,0 +1,356 @@
+# 阿瓦隆規則引擎：不依賴 Flask、鎖或全域的 rooms，只操作呼叫者傳入的 GameState
+# 伺服器 (v8.py) 在房間鎖內呼叫；批次模擬 (simulate.py) 在各自的行程中直接呼叫
+# 為了每秒處理大量對局，狀態是就地修改而不是複製；呼叫者負責狀態的擁有權 (伺服器以房間鎖保護)
+# players: 房間目前的玩家名稱 (房間順序)，投票人數門檻與隊長輪替都以它的長度計算
+# now: 目前時間 (秒)，只用來計算遊戲時長；重播事件日誌時傳入事件發生的時間
+# 狀態內部以整數列舉 (角色、階段、投票) 與 __slots__ 資料類別表示；中文角色名、階段字串等
+# 只在邊界 (apply_action 的參數、對外格式一節) 轉換，規則本身只比較整數
+import random
+import time
+from dataclasses import asdict, dataclass, field
+from enum import IntEnum
+from typing import Optional
+
+ALL_ROLES = {
+    "good": ["梅林", "派西維爾",
+             "亞瑟的忠臣", "亞瑟的忠臣", "亞瑟的忠臣", "亞瑟的忠臣", "亞瑟的忠臣", "亞瑟的忠臣"],
+    "evil": ["莫甘娜", "刺客", "莫德雷德", "奧伯倫",
+             "莫德雷德的爪牙", "莫德雷德的爪牙", "莫德雷德的爪牙", "莫德雷德的爪牙"]
+}
+
+
+# --- 列舉 ---
+class Role(IntEnum):
+    MERLIN = 0
+    PERCIVAL = 1
+    SERVANT = 2
+    MORGANA = 3
+    ASSASSIN = 4
+    MORDRED = 5
+    OBERON = 6
+    MINION = 7
+
+class Phase(IntEnum):
+    TEAM_BUILDING = 0
+    TEAM_VOTE = 1
+    MISSION_VOTE = 2
+    LADY_OF_THE_LAKE = 3
+    ASSASSINATION = 4
+    END = 5
+
+class Vote(IntEnum):
+    APPROVE = 0
+    REJECT = 1
+    SUCCESS = 2
+    FAIL = 3
+
+class Quest(IntEnum):
+    PENDING = 0
+    SUCCESS = 1
+    FAIL = 2
+
+# 以列舉值為索引的對外名稱
+ROLE_NAMES = ("梅林", "派西維爾", "亞瑟的忠臣", "莫甘娜", "刺客", "莫德雷德", "奧伯倫", "莫德雷德的爪牙")
+PHASE_NAMES = ("team_building", "team_vote", "mission_vote", "lady_of_the_lake", "assassination", "end")
+PHASE_TEXTS = ("組建隊伍", "隊伍投票", "執行任務", "湖中女神階段", "刺殺階段", "遊戲結束")
+VOTE_NAMES = ("approve", "reject", "success", "fail")
+QUEST_NAMES = ("pending", "success", "fail")
+ROLE_BY_NAME = {name: Role(i) for i, name in enumerate(ROLE_NAMES)}
+VOTE_BY_NAME = {name: Vote(i) for i, name in enumerate(VOTE_NAMES)}
+
+# 陣營以位元遮罩判斷：第 n 個位元代表 Role(n) 是邪惡角色
+EVIL_MASK = sum(1 << r for r in (Role.MORGANA, Role.ASSASSIN, Role.MORDRED, Role.OBERON, Role.MINION))
+
+def is_evil(role):
+    return bool(EVIL_MASK >> role & 1)
+
+ROLE_CONFIG = {
+    5: ([Role.MERLIN, Role.PERCIVAL, Role.SERVANT], [Role.MORGANA, Role.ASSASSIN]),
+    6: ([Role.MERLIN, Role.PERCIVAL, Role.SERVANT, Role.SERVANT], [Role.MORGANA, Role.ASSASSIN]),
+    7: ([Role.MERLIN, Role.PERCIVAL, Role.SERVANT, Role.SERVANT], [Role.MORGANA, Role.ASSASSIN, Role.OBERON]),
+    8: ([Role.MERLIN, Role.PERCIVAL, Role.SERVANT, Role.SERVANT, Role.SERVANT], [Role.MORGANA, Role.ASSASSIN, Role.MORDRED]),
+    9: ([Role.MERLIN, Role.PERCIVAL, Role.SERVANT, Role.SERVANT, Role.SERVANT, Role.SERVANT], [Role.MORGANA, Role.ASSASSIN, Role.MORDRED]),
+    10: ([Role.MERLIN, Role.PERCIVAL, Role.SERVANT, Role.SERVANT, Role.SERVANT, Role.SERVANT], [Role.MORGANA, Role.ASSASSIN, Role.MORDRED, Role.OBERON]),
+}
+MISSION_SIZES = {
+    5: [2, 3, 2, 3, 3], 6: [2, 3, 4, 3, 4], 7: [2, 3, 3, 4, 4],
+    8: [3, 4, 4, 5, 5], 9: [3, 4, 4, 5, 5], 10: [3, 4, 4, 5, 5],
+}
+TWO_FAILS_MISSION_REQUIRED = { 7: 4, 8: 4, 9: 4, 10: 4 }
+
+
+# --- 狀態 ---
+@dataclass(slots=True)
+class LadyReveal:
+    # 湖中女神的查驗結果，只給持有者 (to) 看
+    to: str
+    mission_num: int
+    target: str
+    evil: bool
+
+@dataclass(slots=True)
+class MissionRecord:
+    mission_num: int
+    leader: str
+    team: list
+    success: bool
+    fails: int
+
+@dataclass(slots=True)
+class GameOver:
+    good_won: bool
+    reason: str
+    duration: float
+
+@dataclass(slots=True)
+class GameState:
+    player_order: list
+    roles: dict          # 玩家名稱 -> Role
+    roles_in_game: list  # 本局的 Role 列表 (洗牌後的順序)
+    seen: dict           # 玩家名稱 -> 他看得到的玩家 (tuple，同陣營的人共用同一個)
+    mission_team_sizes: list
+    game_start_time: float  # 毫秒
+    lady_holder: Optional[str] = None
+    lady_used_on: list = field(default_factory=list)
+    lady_used_missions: list = field(default_factory=list)
+    current_leader_index: int = 0
+    mission_number: int = 1
+    phase: Phase = Phase.TEAM_BUILDING
+    quest_track: list = field(default_factory=lambda: [Quest.PENDING] * 5)
+    mission_history: list = field(default_factory=list)  # MissionRecord
+    team_proposal: list = field(default_factory=list)
+    votes: dict = field(default_factory=dict)          # 玩家名稱 -> Vote
+    mission_votes: dict = field(default_factory=dict)  # 玩家名稱 -> Vote
+    vote_reject_count: int = 0
+    last_vote_details: Optional[list] = None  # [(玩家名稱, Vote 或 None)]，依房間玩家順序
+    events: list = field(default_factory=list)  # LadyReveal
+    game_over: Optional[GameOver] = None
+
+
+# --- 開局 ---
+def compute_seen(roles):
+    # 開局時算一次每位玩家看得到誰：梅林看到莫德雷德以外的壞人、派西維爾看到梅林與莫甘娜、
+    # 奧伯倫以外的壞人看到彼此 (含自己)；同一類玩家共用同一個 tuple
+    evil_players = [p for p, r in roles.items() if is_evil(r)]
+    seen_by_merlin = tuple(p for p in evil_players if roles[p] != Role.MORDRED)
+    merlin_and_morgana = tuple(p for p, r in roles.items() if r in (Role.MERLIN, Role.MORGANA))
+    evil_team = tuple(p for p in evil_players if roles[p] != Role.OBERON)
+    seen = {}
+    for name, role in roles.items():
+        if role == Role.MERLIN: seen[name] = seen_by_merlin
+        elif role == Role.PERCIVAL: seen[name] = merlin_and_morgana
+        elif is_evil(role) and role != Role.OBERON: seen[name] = evil_team
+        else: seen[name] = ()
+    return seen
+
+def new_game(lobby_order, custom_roles, mission_track, use_lady=True, randomize_order=True, rng=random, now=None):
+    # 依大廳順序與房間設定建立新的 GameState；rng 可傳入自己的 random.Random 以便重現
+    player_order = lobby_order[:]
+    if randomize_order: rng.shuffle(player_order)
+    roles_in_game = list(custom_roles)
+    rng.shuffle(roles_in_game)
+    roles = dict(zip(player_order, roles_in_game))
+
+    lady_holder = None
+    lady_used_on = []
+    if use_lady and len(player_order) >= 7:
+        good_players = [p for p, r in roles.items() if not is_evil(r)]
+        if good_players:
+            lady_holder = rng.choice(good_players)
+            lady_used_on.append(lady_holder)
+
+    return GameState(
+        player_order=player_order, roles=roles, roles_in_game=roles_in_game, seen=compute_seen(roles),
+        mission_team_sizes=list(mission_track), game_start_time=(time.time() if now is None else now) * 1000,
+        lady_holder=lady_holder, lady_used_on=lady_used_on,
+    )
+
+
+# --- 動作 ---
+# 動作 -> 允許的階段，以及客戶端的投票字串 -> 列舉
+# 熱路徑上以查表代替逐一比較列舉成員 (Python 3.11 每次從類別取列舉成員都要經過 metaclass)
+ACTION_PHASES = {
+    "propose_team": Phase.TEAM_BUILDING, "vote_team": Phase.TEAM_VOTE, "mission_vote": Phase.MISSION_VOTE,
+    "use_lady": Phase.LADY_OF_THE_LAKE, "assassinate": Phase.ASSASSINATION,
+}
+TEAM_VOTES = {"approve": Vote.APPROVE, "reject": Vote.REJECT}
+MISSION_VOTES = {"success": Vote.SUCCESS, "fail": Vote.FAIL}
+
+def apply_action(state, players, player_name, action, value=None, now=None):
+    # value 是客戶端送來的原始參數 (例如 {"vote": "approve"})，在這裡轉成列舉
+    # 回傳 True 表示狀態有改變 (用於喚醒長輪詢)
+    # 只接受 ACTION_PHASES 中的玩家動作；伺服器代斷線玩家補票後改呼叫 check_vote_complete
+    pc = len(players)
+    if ACTION_PHASES.get(action) != state.phase: return False
+
+    if action == 'vote_team':
+        vote = TEAM_VOTES.get(value.get('vote'))
+        if vote is None: return False
+        state.votes[player_name] = vote
+        if len(state.votes) >= pc:
+            process_team_vote_result(state, players, now)
+
+    elif action == 'mission_vote':
+        vote = MISSION_VOTES.get(value.get('vote'))
+        if vote is None: return False
+        state.mission_votes[player_name] = vote
+        if len(state.mission_votes) >= len(state.team_proposal):
+            process_mission_vote_result(state, players, now)
+
+    elif action == 'propose_team':
+        team = value.get('team', [])
+        if len(team) != state.mission_team_sizes[state.mission_number - 1]: return False
+        state.team_proposal = team; state.phase = Phase.TEAM_VOTE; state.votes = {}
+
+    elif action == 'use_lady':
+        if player_name != state.lady_holder: return False
+        target = value.get('target')
+        if target == player_name or target in state.lady_used_on: return False
+        if target not in state.roles: return False
+        state.events.append(LadyReveal(player_name, state.mission_number, target, is_evil(state.roles[target])))
+        state.lady_holder = target
+        state.lady_used_missions.append(state.mission_number)
+        state.lady_used_on.append(target)
+        advance_to_next_mission(state, players)
+
+    elif action == 'assassinate':
+        target = value.get('target')
+        if state.roles.get(target) == Role.MERLIN:
+            end_game(state, False, f"刺客 {player_name} 成功刺殺了梅林 ({target})！", now)
+        else:
+            end_game(state, True, f"刺客 {player_name} 刺殺失敗！", now)
+    return True
+
+def check_vote_complete(state, players, now=None):
+    # 伺服器替斷線玩家補上票之後呼叫：票數湊齊就結算這一輪投票 (不是玩家動作，客戶端無法觸發)
+    if state.phase == Phase.TEAM_VOTE and len(state.votes) >= len(players):
+        process_team_vote_result(state, players, now)
+    elif state.phase == Phase.MISSION_VOTE and len(state.mission_votes) >= len(state.team_proposal):
+        process_mission_vote_result(state, players, now)
+
+def process_team_vote_result(state, players, now=None):
+    pc = len(players)
+    votes = state.votes
+    approves = list(votes.values()).count(Vote.APPROVE)
+    state.last_vote_details = [(name, votes.get(name)) for name in players]
+    if approves > pc / 2:
+        state.phase = Phase.MISSION_VOTE; state.mission_votes = {}; state.vote_reject_count = 0
+    else:
+        advance_to_next_leader(state, players, now)
+
+def process_mission_vote_result(state, players, now=None):
+    pc = len(players)
+    fails = list(state.mission_votes.values()).count(Vote.FAIL)
+    is_two_fails_mission = TWO_FAILS_MISSION_REQUIRED.get(pc) == state.mission_number
+    fail_threshold = 2 if is_two_fails_mission else 1
+    is_success = fails < fail_threshold
+    state.quest_track[state.mission_number - 1] = Quest.SUCCESS if is_success else Quest.FAIL
+    state.mission_history.append(MissionRecord(
+        state.mission_number, state.player_order[state.current_leader_index], state.team_proposal, is_success, fails))
+    check_game_phase_after_mission(state, players, now)
+
+def end_game(state, good_won, reason="", now=None):
+    state.phase = Phase.END
+    state.game_over = GameOver(good_won, reason, (time.time() if now is None else now) * 1000 - state.game_start_time)
+
+def check_game_phase_after_mission(state, players, now=None):
+    mn = state.mission_number
+    if state.quest_track.count(Quest.FAIL) >= 3:
+        end_game(state, False, "壞人贏得了 3 個任務。", now)
+        return
+    if state.quest_track.count(Quest.SUCCESS) >= 3:
+        if Role.ASSASSIN in state.roles_in_game:
+            state.phase = Phase.ASSASSINATION
+        else:
+            end_game(state, True, "好人贏得了 3 個任務 (無刺客)。", now)
+        return
+    if state.lady_holder and mn in (2, 3, 4) and mn not in state.lady_used_missions:
+        state.phase = Phase.LADY_OF_THE_LAKE
+        return
+    advance_to_next_mission(state, players)
+
+def advance_to_next_mission(state, players):
+    state.mission_number += 1
+    state.current_leader_index = (state.current_leader_index + 1) % len(players)
+    state.phase = Phase.TEAM_BUILDING
+    state.team_proposal = []; state.votes = {}; state.last_vote_details = None
+
+def advance_to_next_leader(state, players, now=None):
+    state.vote_reject_count += 1
+    if state.vote_reject_count >= 5:
+        end_game(state, False, "連續 5 次投票被否決。", now)
+    else:
+        state.current_leader_index = (state.current_leader_index + 1) % len(players)
+        state.phase = Phase.TEAM_BUILDING
+        state.team_proposal = []; state.votes = {}
+
+
+# --- 對外格式 (JSON 邊界) ---
+def factions_view(state):
+    return {"good": [ROLE_NAMES[r] for r in state.roles_in_game if not is_evil(r)],
+            "evil": [ROLE_NAMES[r] for r in state.roles_in_game if is_evil(r)]}
+
+def player_info_view(state, name):
+    # 玩家自己的角色情報；不在本局的玩家 (觀看者) 得到空的情報
+    role = state.roles.get(name)
+    if role is None: return {"role": None, "is_evil": False, "role_info": "", "known_evil": []}
+    seen = state.seen[name]
+    info = {"role": ROLE_NAMES[role], "is_evil": is_evil(role), "role_info": "", "known_evil": []}
+    if role == Role.MERLIN: info["role_info"] = f"你知道的壞人是: {', '.join(seen)}"
+    elif role == Role.PERCIVAL: info["role_info"] = f"梅林和莫甘娜是: {', '.join(seen)}"
+    elif seen:
+        info["known_evil"] = list(seen)
+        info["role_info"] = f"你的邪惡夥伴是: {', '.join(p for p in seen if p != name)}"
+    return info
+
+def event_view(event):
+    loyalty = "邪惡" if event.evil else "善良"
+    return {"type": "lady_reveal", "to": event.to, "mission_num": event.mission_num,
+            "target": event.target, "text": f"你查驗了 {event.target}，他的陣營是: {loyalty}"}
+
+def mission_history_view(state):
+    return [{"mission_num": m.mission_num, "leader": m.leader, "team": m.team,
+             "result": "success" if m.success else "fail", "fails": m.fails} for m in state.mission_history]
+
+def vote_details_view(state):
+    if state.last_vote_details is None: return None
+    return [{"name": name, "vote": None if vote is None else VOTE_NAMES[vote]} for name, vote in state.last_vote_details]
+
+def game_over_view(state):
+    over = state.game_over
+    return {
+        "winning_team": "善良陣營" if over.good_won else "邪惡陣營",
+        "reason": over.reason,
+        "duration": over.duration,
+        "all_roles": [{"name": p, "role": ROLE_NAMES[r], "faction": "evil" if is_evil(r) else "good"} for p, r in state.roles.items()],
+    }
+
+def parse_roles(names):
+    # 客戶端送來的中文角色名列表 -> Role 列表；有未知的角色時回傳 None
+    roles = [ROLE_BY_NAME.get(name) for name in names] if isinstance(names, list) else [None]
+    return None if None in roles else roles
+
+def role_names(roles):
+    return [ROLE_NAMES[r] for r in roles]
+
+# 持久化 (事件日誌、快照、共用儲存) 用的精簡格式：欄位名稱不變，列舉存成整數
+def state_to_dict(state):
+    return asdict(state)
+
+def state_from_dict(d):
+    over = d['game_over']
+    return GameState(**{
+        **d,
+        "roles": {p: Role(r) for p, r in d['roles'].items()},
+        "roles_in_game": [Role(r) for r in d['roles_in_game']],
+        "seen": {p: tuple(s) for p, s in d['seen'].items()},
+        "phase": Phase(d['phase']),
+        "quest_track": [Quest(q) for q in d['quest_track']],
+        "mission_history": [MissionRecord(**m) for m in d['mission_history']],
+        "votes": {p: Vote(v) for p, v in d['votes'].items()},
+        "mission_votes": {p: Vote(v) for p, v in d['mission_votes'].items()},
+        "last_vote_details": None if d['last_vote_details'] is None else
+            [(name, None if v is None else Vote(v)) for name, v in d['last_vote_details']],
+        "events": [LadyReveal(**e) for e in d['events']],
+        "game_over": GameOver(**over) if over else None,
+    })
@@ -0,0 +1,164 @@
+# 遊戲紀錄：每局結束時附加一筆到 SQLite，之後可依玩家、角色、日期與獲勝陣營查詢，或串流匯出
+# 資料表:
+#   games         每局一列；(room_code, started_at) 唯一，同一局重複寫入會被忽略
+#   game_players  每局每位玩家一列，冗餘存放 ended_at / won；玩家統計只掃描該玩家的索引項 (covering index)，
+#                 依玩家列出對局時沿著 (玩家, game_id) 的索引由新到舊走，依角色時由新到舊走過各局、以 (角色, game_id) 索引確認，湊滿一頁就停
+# 寫入與事件日誌相同：呼叫端只放進佇列，背景執行緒整批在一個交易內寫入 (group commit)，不拖慢持有房間鎖的請求
+import json
+import queue
+import sqlite3
+import sys
+import threading
+
+from game_engine import ROLE_NAMES, Role, is_evil
+
+EXPORT_BATCH = 500  # 匯出時每次從資料庫取出的筆數，記憶體只保留這一批
+EVIL_ROLE_IDS = ','.join(str(int(r)) for r in Role if is_evil(r))  # 只會是整數，直接寫進 SQL
+
+
+class GameHistory:
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS games (
+            id INTEGER PRIMARY KEY, room_code TEXT NOT NULL, started_at REAL NOT NULL, ended_at REAL NOT NULL,
+            duration REAL NOT NULL, good_won INTEGER NOT NULL, reason TEXT NOT NULL, player_count INTEGER NOT NULL,
+            data TEXT NOT NULL, UNIQUE (room_code, started_at)
+        );
+        CREATE TABLE IF NOT EXISTS game_players (
+            game_id INTEGER NOT NULL REFERENCES games (id), player TEXT NOT NULL, role INTEGER NOT NULL,
+            evil INTEGER NOT NULL, won INTEGER NOT NULL, ended_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS games_ended ON games (ended_at);
+        CREATE INDEX IF NOT EXISTS games_winner ON games (good_won);
+        CREATE INDEX IF NOT EXISTS game_players_player ON game_players (player, game_id, role, won, ended_at);
+        CREATE INDEX IF NOT EXISTS game_players_role ON game_players (role, game_id);
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+        self.start_lock = threading.Lock()
+        self.conn().executescript(self.SCHEMA)
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def conn(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None: conn = self.local.conn = self.connect()
+        return conn
+
+    # --- 寫入 ---
+    def start(self):
+        with self.start_lock:
+            if self.thread: return
+            self.thread = threading.Thread(target=self.writer_task, name="game-history", daemon=True)
+            self.thread.start()
+
+    def append(self, game):
+        # game: {"room_code", "started_at", "ended_at" (秒), "duration" (毫秒), "good_won", "reason",
+        #        "players": [(名稱, Role, 是否邪惡)], "data": 其餘內容 (任務紀錄等)}；在呼叫端就編碼，之後房間再變動也不影響
+        self.queue.put((game["room_code"], game["started_at"], game["ended_at"], game["duration"], int(game["good_won"]),
+                        game["reason"], game["players"], json.dumps(game["data"], ensure_ascii=False, separators=(',', ':'))))
+
+    def flush(self):
+        # 等到目前佇列中的紀錄都已寫入
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait()
+
+    def pending(self):
+        return self.queue.qsize()
+
+    def writer_task(self):
+        conn = self.connect()
+        while True:
+            batch = [self.queue.get()]
+            while True:
+                try: batch.append(self.queue.get_nowait())
+                except queue.Empty: break
+            try: self.write(conn, [item for item in batch if isinstance(item, tuple)])
+            except sqlite3.Error as e: print(f"寫入遊戲紀錄失敗 ({len(batch)} 筆): {e}", file=sys.stderr)
+            for item in batch:
+                if isinstance(item, threading.Event): item.set()
+
+    def write(self, conn, games):
+        if not games: return
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for room_code, started_at, ended_at, duration, good_won, reason, players, data in games:
+                cur = conn.execute('INSERT OR IGNORE INTO games (room_code, started_at, ended_at, duration, good_won, reason, player_count, data) '
+                                   'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                   (room_code, started_at, ended_at, duration, good_won, reason, len(players), data))
+                if cur.rowcount != 1: continue
+                conn.executemany('INSERT INTO game_players (game_id, player, role, evil, won, ended_at) VALUES (?, ?, ?, ?, ?, ?)',
+                                 [(cur.lastrowid, name, int(role), int(evil), int(evil != good_won), ended_at) for name, role, evil in players])
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    # --- 查詢 ---
+    def player_stats(self, player, role=None, good_won=None, since=None, until=None):
+        # 只讀 game_players_player 索引，成本與該玩家的局數成正比，與總局數無關；
+        # 獲勝陣營由「該玩家是否獲勝」與「角色是否邪惡」推得 (善良勝 = 善良角色贏或邪惡角色輸)，不必回到 games 表
+        sql = 'SELECT role, COUNT(*), TOTAL(won) FROM game_players WHERE player = ?'
+        args = [player]
+        if role is not None: sql += ' AND role = ?'; args.append(int(role))
+        if good_won is not None: sql += f' AND won = (role {"NOT IN" if good_won else "IN"} ({EVIL_ROLE_IDS}))'
+        if since is not None: sql += ' AND ended_at >= ?'; args.append(since)
+        if until is not None: sql += ' AND ended_at < ?'; args.append(until)
+        by_role = {ROLE_NAMES[role]: {"games": games, "wins": int(wins)} for role, games, wins in self.conn().execute(sql + ' GROUP BY role', args)}
+        games = sum(r["games"] for r in by_role.values())
+        wins = sum(r["wins"] for r in by_role.values())
+        return {"player": player, "games": games, "wins": wins, "byRole": by_role}
+
+    def game_query(self, descending, player=None, role=None, good_won=None, since=None, until=None, before_id=None):
+        # 依條件組出 (SQL, 參數)，依局號排序；有玩家條件時從 game_players 的索引出發 (每局每位玩家只有一列)，再以主鍵取出該局
+        # 只有角色條件時同一局可能有多個座位是該角色 (例如忠臣)，改以 EXISTS 確認，每局只出現一次
+        where, args = [], []
+        if player is not None: where.append('gp.player = ?'); args.append(player)
+        if role is not None:
+            if player is not None: where.append('gp.role = ?')
+            else: where.append('EXISTS (SELECT 1 FROM game_players gp WHERE gp.role = ? AND gp.game_id = g.id)')
+            args.append(int(role))
+        if good_won is not None: where.append('g.good_won = ?'); args.append(int(good_won))
+        if since is not None: where.append('g.ended_at >= ?'); args.append(since)
+        if until is not None: where.append('g.ended_at < ?'); args.append(until)
+        if before_id is not None: where.append('g.id < ?'); args.append(before_id)
+        if player is not None: sql = 'SELECT g.* FROM game_players gp JOIN games g ON g.id = gp.game_id'
+        else: sql = 'SELECT g.* FROM games g'
+        if where: sql += ' WHERE ' + ' AND '.join(where)
+        return sql + (' ORDER BY g.id DESC' if descending else ' ORDER BY g.id'), args
+
+    def games(self, limit, **filters):
+        # 由新到舊；分頁以局號為游標 (before_id)，不用 OFFSET，翻到多後面都一樣快
+        sql, args = self.game_query(True, **filters)
+        return [json.loads(line) for line in self.encode_rows(self.conn().execute(sql + ' LIMIT ?', args + [limit]))]
+
+    def export(self, **filters):
+        # 產生器：由舊到新，每次取 EXPORT_BATCH 筆編成 NDJSON 輸出，記憶體只保留這一批；
+        # 使用獨立的連線，匯出期間不影響同一執行緒的其他查詢
+        sql, args = self.game_query(False, **filters)
+        conn = self.connect()
+        try:
+            cur = conn.execute(sql, args)
+            while True:
+                rows = cur.fetchmany(EXPORT_BATCH)
+                if not rows: break
+                yield ''.join(self.encode_rows(rows))
+        finally:
+            conn.close()
+
+    @staticmethod
+    def encode_rows(rows):
+        # 每局一行 JSON；data 欄位本身已是 JSON 物件，直接接在其他欄位後面，不必解碼再編碼
+        for game_id, room_code, started_at, ended_at, duration, good_won, reason, player_count, data in rows:
+            head = json.dumps({"id": game_id, "roomCode": room_code, "startedAt": started_at, "endedAt": ended_at, "duration": duration,
+                               "winningTeam": "good" if good_won else "evil", "reason": reason, "playerCount": player_count},
+                              ensure_ascii=False, separators=(',', ':'))
+            yield head[:-1] + ',' + data[1:] + '\n'
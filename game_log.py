@@ -0,0 +1,115 @@
+# 事件日誌：房間的每次變動附加一行 JSON，定期寫入快照，重啟時以「快照 + 重播」恢復房間
+# 檔案配置 (皆在同一資料夾):
+#   events-000001.log  日誌分段，每行一筆 [時間, 房號, 版本號, 類型, 參數]
+#   snapshot.json      {"segment": 分段編號, "rooms": {房號: 房間}}，重播從該分段開始
+# 附加只是放進佇列；背景寫入執行緒一次寫出整批並只 fsync 一次 (group commit)，不拖慢請求
+import json
+import os
+import queue
+import threading
+
+SEGMENT_PREFIX = "events-"
+SEGMENT_SUFFIX = ".log"
+SNAPSHOT_FILE = "snapshot.json"
+
+
+class GameLog:
+    def __init__(self, directory):
+        self.dir = directory
+        os.makedirs(directory, exist_ok=True)
+        segments = self.segments()
+        self.segment = (segments[-1] if segments else 0) + 1  # 每次啟動都從新的分段開始寫
+        self.queue = queue.SimpleQueue()
+        self.file = None
+        self.thread = None
+        self.start_lock = threading.Lock()
+
+    def segment_path(self, n):
+        return os.path.join(self.dir, f"{SEGMENT_PREFIX}{n:06d}{SEGMENT_SUFFIX}")
+
+    def segments(self):
+        names = [f for f in os.listdir(self.dir) if f.startswith(SEGMENT_PREFIX) and f.endswith(SEGMENT_SUFFIX)]
+        return sorted(int(f[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]) for f in names)
+
+    # --- 寫入 ---
+    def start(self):
+        with self.start_lock:
+            if self.thread: return
+            self.file = open(self.segment_path(self.segment), 'a', encoding='utf-8')
+            self.thread = threading.Thread(target=self.writer_task, daemon=True)
+            self.thread.start()
+
+    def append(self, record):
+        # 在呼叫端就編碼，之後房間再被修改也不影響這筆紀錄
+        self.queue.put(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n')
+
+    def rotate(self):
+        # 切換到新分段並回傳其編號；在此之前放進佇列的紀錄都會留在舊分段
+        done = threading.Event()
+        self.queue.put(('rotate', done))
+        done.wait()
+        return self.segment
+
+    def flush(self):
+        # 等到目前佇列中的紀錄都已寫入並 fsync
+        done = threading.Event()
+        self.queue.put(('flush', done))
+        done.wait()
+
+    def writer_task(self):
+        while True:
+            batch = [self.queue.get()]
+            while True:
+                try: batch.append(self.queue.get_nowait())
+                except queue.Empty: break
+            lines, markers = [], []
+            for item in batch:
+                if isinstance(item, str):
+                    lines.append(item)
+                    continue
+                self.write_lines(lines); lines = []
+                kind, done = item
+                if kind == 'rotate':
+                    self.file.close()
+                    self.segment += 1
+                    self.file = open(self.segment_path(self.segment), 'a', encoding='utf-8')
+                markers.append(done)
+            self.write_lines(lines)
+            for done in markers: done.set()
+
+    def write_lines(self, lines):
+        if not lines: return
+        self.file.write(''.join(lines))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    # --- 快照 ---
+    def write_snapshot(self, segment, room_texts):
+        # room_texts: 房號 -> 已編碼的房間 JSON；寫入暫存檔後原子地改名，再刪除快照已涵蓋的舊分段
+        tmp = os.path.join(self.dir, SNAPSHOT_FILE + '.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(f'{{"segment":{segment},"rooms":{{')
+            f.write(','.join(f'{json.dumps(code)}:{text}' for code, text in room_texts.items()))
+            f.write('}}')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, os.path.join(self.dir, SNAPSHOT_FILE))
+        for n in self.segments():
+            if n < segment: os.remove(self.segment_path(n))
+
+    # --- 恢復 ---
+    def load(self):
+        # 回傳 (快照中的房間, 之後依序的紀錄產生器)；最後一行若在當機時只寫了一半會被略過
+        path = os.path.join(self.dir, SNAPSHOT_FILE)
+        snapshot = {"segment": 0, "rooms": {}}
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f: snapshot = json.load(f)
+        return snapshot["rooms"], self.records(snapshot["segment"])
+
+    def records(self, first_segment):
+        for n in self.segments():
+            if n < first_segment: continue
+            with open(self.segment_path(n), encoding='utf-8') as f:
+                for line in f:
+                    try: yield json.loads(line)
+                    except ValueError: continue
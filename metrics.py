@@ -0,0 +1,150 @@
+# 指標：以 Prometheus 文字格式匯出 (GET /metrics)，不依賴 prometheus_client
+# 計數器與直方圖在熱路徑上只把觀測值 append 到 deque (GIL 下是原子操作，不取鎖)，
+# 匯出時 (或累積過多時) 才彙整；量表 (gauge) 在匯出時才呼叫函式取值，平常不需要維護
+# 多個 worker 行程時每個行程各自計數，由 Prometheus 依 instance 分開抓取後再加總
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+
+FOLD_THRESHOLD = 4096  # 未彙整的觀測值超過此數量時，由記錄的執行緒順手彙整 (搶不到鎖就留給下一個)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+LOCK_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1)
+
+
+def format_labels(names, values):
+    if not names: return ""
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in values)
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, escaped)) + "}"
+
+
+class Buffered:
+    # 觀測值先進 pending (inc / observe 直接 append，省去多一層函式呼叫)，fold() 時在鎖內彙整到 self.values
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.values = {}  # 標籤值 tuple -> 彙整後的值
+        self.pending = deque()
+        self.lock = threading.Lock()
+
+    def fold_some(self):
+        if not self.lock.acquire(blocking=False): return
+        try: self.drain()
+        finally: self.lock.release()
+
+    def fold(self):
+        with self.lock:
+            self.drain()
+            return list(self.values.items())
+
+    def drain(self):
+        pending, add = self.pending, self.add
+        while pending:
+            try: label_values, value = pending.popleft()
+            except IndexError: break
+            add(label_values, value)
+
+
+class Counter(Buffered):
+    kind = "counter"
+
+    def inc(self, *label_values, amount=1):
+        pending = self.pending
+        pending.append((label_values, amount))
+        if len(pending) > FOLD_THRESHOLD: self.fold_some()
+
+    def add(self, label_values, amount):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        return [(self.name, format_labels(self.labels, k), v) for k, v in self.fold()]
+
+
+class Histogram(Buffered):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        pending = self.pending
+        pending.append((label_values, value))
+        if len(pending) > FOLD_THRESHOLD: self.fold_some()
+
+    def add(self, label_values, value):
+        entry = self.values.get(label_values)
+        if entry is None: entry = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def samples(self):
+        out = []
+        names = self.labels + ("le",)
+        for k, (counts, total) in self.fold():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                out.append((self.name + "_bucket", format_labels(names, k + (bound,)), cumulative))
+            labels = format_labels(self.labels, k)
+            out.append((self.name + "_sum", labels, total))
+            out.append((self.name + "_count", labels, cumulative))
+        return out
+
+
+class Gauge:
+    kind = "gauge"
+
+    def __init__(self, name, help, fn, labels=()):
+        # fn() 回傳數值；有標籤時回傳 {標籤值 tuple: 數值}
+        self.name, self.help, self.fn, self.labels = name, help, fn, tuple(labels)
+
+    def samples(self):
+        value = self.fn()
+        if not self.labels: return [(self.name, "", value)]
+        return [(self.name, format_labels(self.labels, k), v) for k, v in value.items()]
+
+
+class TimedLock:
+    # 取代 threading.Lock 的 with 用法，另外記錄等待與持有的秒數到 histogram (標籤 stage=wait/hold)
+    def __init__(self, histogram, *label_values):
+        self.lock = threading.Lock()
+        self.histogram, self.label_values = histogram, label_values
+        self.acquired_at = 0.0  # 只有持有者會寫入
+
+    def __enter__(self):
+        start = time.perf_counter()
+        self.lock.acquire()
+        self.acquired_at = now = time.perf_counter()
+        self.histogram.observe(now - start, *self.label_values, "wait")
+
+    def __exit__(self, *exc):
+        held = time.perf_counter() - self.acquired_at
+        self.lock.release()
+        self.histogram.observe(held, *self.label_values, "hold")
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name, help, fn, labels=()):
+        return self.register(Gauge(name, help, fn, labels))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {value}")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,82 @@
+# 取樣式剖析器：背景執行緒以固定頻率讀取所有執行緒的呼叫堆疊 (sys._current_frames)，累計成 folded stacks 格式
+# (每行「執行緒;最外層;...;最內層 次數」)，可直接交給 flamegraph.pl、inferno 或 speedscope 畫成火焰圖
+# 取樣時不會暫停其他執行緒，只在取樣的瞬間需要 GIL；關閉時完全沒有成本
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+DUMP_INTERVAL = 30  # 取樣期間每隔多久 (秒) 把目前的累計結果寫到檔案 (覆寫同一個檔案)
+
+
+def frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ":")
+
+
+def fold_stack(thread_name, frame):
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame))
+        frame = frame.f_back
+    labels.append(thread_name.replace(";", ":"))
+    return ";".join(reversed(labels))
+
+
+class SamplingProfiler:
+    def __init__(self, out_dir):
+        self.out_dir = out_dir
+        self.lock = threading.Lock()  # 保護啟動/停止與 stacks 的讀寫
+        self.thread = None
+        self.stop_event = None
+        self.stacks = Counter()
+        self.samples = 0
+        self.hz = 0
+        self.path = None
+
+    def status(self):
+        return {"running": self.thread is not None, "hz": self.hz, "samples": self.samples, "path": self.path}
+
+    def start(self, hz):
+        # 已在取樣時回傳 False；每次啟動都寫到新的檔案
+        with self.lock:
+            if self.thread: return False
+            os.makedirs(self.out_dir, exist_ok=True)
+            self.hz, self.stacks, self.samples = hz, Counter(), 0
+            self.path = os.path.join(self.out_dir, time.strftime("profile-%Y%m%d-%H%M%S") + f"-{os.getpid()}.folded")
+            self.stop_event = threading.Event()
+            self.thread = threading.Thread(target=self.run, args=(self.stop_event, 1 / hz), name="profiler", daemon=True)
+            self.thread.start()
+            return True
+
+    def stop(self):
+        # 停止取樣並寫出最終結果，回傳檔案路徑；沒有在取樣時回傳 None
+        with self.lock:
+            thread, self.thread = self.thread, None
+            if not thread: return None
+            self.stop_event.set()
+        thread.join()
+        self.dump()
+        return self.path
+
+    def run(self, stop_event, interval):
+        me = threading.get_ident()
+        next_dump = time.monotonic() + DUMP_INTERVAL
+        while not stop_event.wait(interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            frames = sys._current_frames()
+            with self.lock:
+                for ident, frame in frames.items():
+                    if ident != me: self.stacks[fold_stack(names.get(ident, str(ident)), frame)] += 1
+                self.samples += 1
+            frames = frame = None  # 不要讓堆疊上的區域變數活到下一次取樣
+            if time.monotonic() >= next_dump:
+                self.dump()
+                next_dump = time.monotonic() + DUMP_INTERVAL
+
+    def dump(self):
+        with self.lock: lines = [f"{stack} {count}\n" for stack, count in self.stacks.most_common()]
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f: f.writelines(lines)
+        os.replace(tmp, self.path)
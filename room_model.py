@@ -0,0 +1,61 @@
+# 房間、玩家與房間設定：__slots__ 資料類別，遊戲狀態見 game_engine.GameState
+# 對客戶端的 JSON 由 v8.py 的投影 (build_room_view / build_viewer_view) 產生；
+# 這裡的 room_to_dict / room_from_dict 只用於持久化 (共用儲存、事件日誌、快照)
+from dataclasses import asdict, dataclass, replace
+from typing import Optional
+
+from game_engine import GameState, Role, state_from_dict
+
+
+@dataclass(slots=True)
+class Player:
+    name: str
+    token: str
+    is_host: bool = False
+    is_ready: bool = False
+    last_seen: float = 0.0
+    connected: bool = True
+
+@dataclass(slots=True)
+class Settings:
+    max_players: int
+    custom_roles: list   # Role
+    mission_track: list
+    password: str = ""
+    use_lady: bool = True
+    randomize_order: bool = True
+    allow_spectators: bool = False
+    spectator_delay: int = 0   # 觀戰延遲 (秒)
+
+@dataclass(slots=True)
+class Room:
+    players: list        # Player
+    lobby_order: list    # 玩家名稱
+    settings: Settings
+    created_at: float
+    game: Optional[GameState] = None
+    version: int = 0
+
+
+# --- 持久化格式 ---
+def room_to_dict(room):
+    return asdict(room)
+
+def settings_from_dict(d):
+    return Settings(**{**d, "custom_roles": [Role(r) for r in d['custom_roles']]})
+
+def room_from_dict(d):
+    return Room(
+        players=[Player(**p) for p in d['players']], lobby_order=d['lobby_order'],
+        settings=settings_from_dict(d['settings']), created_at=d['created_at'],
+        game=state_from_dict(d['game']) if d['game'] else None, version=d['version'],
+    )
+
+def lobby_to_dict(room):
+    # 大廳事件只記錄玩家、順序與設定
+    return {"players": [asdict(p) for p in room.players], "lobby_order": room.lobby_order, "settings": asdict(room.settings)}
+
+def with_lobby(room, d):
+    # 回傳套用大廳事件後的新房間物件 (原本的物件不變)
+    return replace(room, players=[Player(**p) for p in d['players']], lobby_order=d['lobby_order'],
+                   settings=settings_from_dict(d['settings']))
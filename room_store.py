@@ -0,0 +1,216 @@
+# 房間儲存後端
+# MemoryRoomStore: 預設，房間只存在本行程的 rooms dict (單一 worker)
+# SqliteRoomStore: 多個 worker 行程共用同一個 SQLite 檔，rooms dict 只當作本行程的快取
+import fcntl
+import json
+import os
+import random
+import sqlite3
+import threading
+from contextlib import contextmanager, nullcontext
+
+from room_model import room_from_dict, room_to_dict
+
+
+class MemoryRoomStore:
+    shared = False
+
+    def __init__(self, rooms):
+        self.rooms = rooms
+        self.joinable = []        # 可隨機加入的公開房間 (未開始、未滿、無密碼)
+        self.joinable_index = {}  # room_code -> 在 joinable 中的位置，用來 O(1) 移除
+        self.joinable_lock = threading.Lock()
+        self.player_counts = {}   # room_code -> 最後一次寫回時的玩家數，供容量限制使用
+        self.total_players = 0
+
+    def transaction(self, write=True):
+        return nullcontext()
+
+    def exists(self, room_code):
+        return room_code in self.rooms
+
+    def load(self, room_code):
+        # 回傳 (房間, 是否為新載入的物件)；記憶體模式永遠是同一個物件
+        return self.rooms.get(room_code), False
+
+    def insert(self, room_code, room, joinable):
+        # setdefault 是單次 dict 操作，房號相同的兩個請求只有一個會成功，不需要登記鎖
+        if self.rooms.setdefault(room_code, room) is not room: return False
+        self.set_joinable(room_code, joinable)
+        self.set_player_count(room_code, len(room.players))
+        return True
+
+    def save(self, room_code, room, joinable):
+        # 回傳 False 表示寫回衝突 (只有共用儲存會發生)
+        # 只有持有房間鎖的請求會改動自己的名單狀態，所以先不加鎖比對，沒變就不碰 joinable_lock
+        if joinable != (room_code in self.joinable_index):
+            self.set_joinable(room_code, joinable)
+        if self.player_counts.get(room_code) != len(room.players):
+            self.set_player_count(room_code, len(room.players))
+        return True
+
+    def delete(self, room_code):
+        self.set_joinable(room_code, False)
+        self.set_player_count(room_code, 0)
+
+    def set_player_count(self, room_code, count):
+        with self.joinable_lock:
+            self.total_players += count - self.player_counts.pop(room_code, 0)
+            if count: self.player_counts[room_code] = count
+
+    def usage(self):
+        # (房間數, 玩家數)
+        return len(self.rooms), self.total_players
+
+    def codes(self):
+        return list(self.rooms.keys())
+
+    def version(self, room_code):
+        room = self.rooms.get(room_code)
+        return room.version if room else None
+
+    def versions(self):
+        return {code: room.version for code, room in list(self.rooms.items())}
+
+    def pick_joinable(self):
+        with self.joinable_lock:
+            return random.choice(self.joinable) if self.joinable else None
+
+    def set_joinable(self, room_code, joinable):
+        with self.joinable_lock:
+            if joinable and room_code not in self.joinable_index:
+                self.joinable_index[room_code] = len(self.joinable)
+                self.joinable.append(room_code)
+            elif not joinable and room_code in self.joinable_index:
+                i = self.joinable_index.pop(room_code)
+                last = self.joinable.pop()
+                if last != room_code:
+                    self.joinable[i] = last
+                    self.joinable_index[last] = i
+
+    def is_reaper(self):
+        # 單一行程時自己就是巡邏員
+        return True
+
+
+class SqliteRoomStore:
+    # 每個房間一列 JSON；rev 在每次寫回時 +1，本行程快取的 rev 不同就重新載入
+    # 會改動房間的請求以 BEGIN IMMEDIATE 交易序列化；只讀的請求不開交易 (單一 SELECT 本身就是延遲的讀取交易)，
+    # WAL 模式下不會擋住寫入也不會被寫入擋住。寫回時比對 rev，讀取後被其他行程搶先寫入就放棄這次寫回
+    shared = True
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS rooms (
+            code TEXT PRIMARY KEY, rev INTEGER NOT NULL, version INTEGER NOT NULL,
+            joinable INTEGER NOT NULL, players INTEGER NOT NULL, data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS rooms_joinable ON rooms (code) WHERE joinable = 1;
+    """
+
+    def __init__(self, path, rooms):
+        self.path = path
+        self.rooms = rooms
+        self.revs = {}   # room_code -> 本行程快取的 rev
+        self.texts = {}  # room_code -> 最後一次讀到/寫入的 JSON，內容沒變就不寫回
+        self.local = threading.local()
+        self.reaper_fd = None
+        self.conn().executescript(self.SCHEMA)
+
+    def conn(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    def transaction(self, write=True):
+        return self.write_transaction() if write else nullcontext()
+
+    @contextmanager
+    def write_transaction(self):
+        conn = self.conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def exists(self, room_code):
+        return self.conn().execute('SELECT 1 FROM rooms WHERE code = ?', (room_code,)).fetchone() is not None
+
+    def load(self, room_code):
+        row = self.conn().execute('SELECT rev, data FROM rooms WHERE code = ?', (room_code,)).fetchone()
+        if row is None:
+            self.revs.pop(room_code, None); self.texts.pop(room_code, None)
+            return None, False
+        rev, text = row
+        if self.revs.get(room_code) == rev and room_code in self.rooms:
+            return self.rooms[room_code], False
+        self.revs[room_code], self.texts[room_code] = rev, text
+        return room_from_dict(json.loads(text)), True
+
+    def insert(self, room_code, room, joinable):
+        text = json.dumps(room_to_dict(room), ensure_ascii=False)
+        cur = self.conn().execute('INSERT OR IGNORE INTO rooms (code, rev, version, joinable, players, data) VALUES (?, 1, ?, ?, ?, ?)',
+                                  (room_code, room.version, int(joinable), len(room.players), text))
+        if cur.rowcount != 1: return False
+        self.revs[room_code], self.texts[room_code] = 1, text
+        return True
+
+    def save(self, room_code, room, joinable):
+        # 呼叫者需已 load 過這個房間；寫入交易內 rev 一定相符，只讀的請求則可能在 load 之後被其他行程搶先寫入，
+        # 此時不寫回、清掉本行程記錄的 rev 並回傳 False (下次 load 會重新載入)
+        text = json.dumps(room_to_dict(room), ensure_ascii=False)
+        if text == self.texts.get(room_code): return True
+        rev = self.revs.get(room_code, 0)
+        cur = self.conn().execute('UPDATE rooms SET rev = ?, version = ?, joinable = ?, players = ?, data = ? WHERE code = ? AND rev = ?',
+                                  (rev + 1, room.version, int(joinable), len(room.players), text, room_code, rev))
+        if cur.rowcount != 1:
+            self.revs.pop(room_code, None); self.texts.pop(room_code, None)
+            return False
+        self.revs[room_code], self.texts[room_code] = rev + 1, text
+        return True
+
+    def delete(self, room_code):
+        self.conn().execute('DELETE FROM rooms WHERE code = ?', (room_code,))
+        self.revs.pop(room_code, None); self.texts.pop(room_code, None)
+
+    def codes(self):
+        return [row[0] for row in self.conn().execute('SELECT code FROM rooms')]
+
+    def version(self, room_code):
+        row = self.conn().execute('SELECT version FROM rooms WHERE code = ?', (room_code,)).fetchone()
+        return row[0] if row else None
+
+    def versions(self):
+        return dict(self.conn().execute('SELECT code, version FROM rooms'))
+
+    def usage(self):
+        rooms, players = self.conn().execute('SELECT COUNT(*), TOTAL(players) FROM rooms').fetchone()
+        return rooms, int(players)
+
+    def pick_joinable(self):
+        row = self.conn().execute('SELECT code FROM rooms WHERE joinable = 1 ORDER BY RANDOM() LIMIT 1').fetchone()
+        return row[0] if row else None
+
+    def is_reaper(self):
+        # 以檔案鎖選出唯一的巡邏員行程；持有者結束時由作業系統釋放，其他行程下一輪即可接手
+        if self.reaper_fd is not None: return True
+        fd = os.open(self.path + '.reaper.lock', os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self.reaper_fd = fd
+        return True
+
+
+def create_room_store(kind, path, rooms):
+    if kind == 'sqlite': return SqliteRoomStore(path, rooms)
+    if kind == 'memory': return MemoryRoomStore(rooms)
+    raise ValueError(f"未知的 ROOM_STORE: {kind}")
@@ -0,0 +1,356 @@
+# 批次蒙地卡羅模擬：用規則引擎 (game_engine) 讓機器人大量對局，統計各種設定下好壞兩方的勝率
+# 不經過 HTTP、鎖或房間，每局直接在記憶體裡跑完；對局分批交給多個行程平行執行
+# 用法:
+#   python simulate.py --games 100000                     # ROLE_CONFIG 的每種人數，搭配預設任務軌跡
+#   python simulate.py --players 7 --track 2,3,3,4,4 --roles 梅林,派西維爾,亞瑟的忠臣,亞瑟的忠臣,莫甘娜,刺客,奧伯倫
+#   python simulate.py --policy simple --workers 4 --seed 1 --json
+# 策略: random (隨機)、simple (簡單推理)，或以 module:Class 指定自訂策略 (介面見 RandomPolicy)
+# 勝率是「這個策略下」的結果：random 只能當下限參考；simple 會依情報推理 (見 SimplePolicy)，但仍比不上真人，
+# 適合比較不同設定之間的相對差異，不要當成規則平衡的直接證據
+import argparse
+import importlib
+import json
+import math
+import os
+import random
+import sys
+import time
+from collections import Counter
+from functools import lru_cache
+from itertools import combinations
+from concurrent.futures import ProcessPoolExecutor
+
+import game_engine
+from game_engine import Phase, Quest, Role, Vote, is_evil
+
+CHUNK_SIZE = 2000  # 每個工作批次的對局數
+# 對局迴圈每一步都要比較階段，先把列舉成員取成模組層級的名稱 (從類別取成員較慢)
+TEAM_BUILDING, TEAM_VOTE, MISSION_VOTE, LADY_OF_THE_LAKE, ASSASSINATION, END = Phase
+APPROVE = Vote.APPROVE
+
+
+# --- 策略 ---
+class RandomPolicy:
+    # 建構時拿到玩家名稱、自己的角色 (Role) 與看得到的玩家 (seen)；各方法拿到引擎的 GameState 與共用的 rng
+    # 策略只應該讀取公開的欄位 (隊伍、投票與任務紀錄等) 和自己的情報，不要偷看 roles
+    # 每局開始時每位玩家各建立一個實例，可以在實例上保留自己的推理
+    def __init__(self, name, role, seen):
+        self.name, self.role, self.seen = name, role, seen
+
+    def propose_team(self, state, size, rng):
+        return rng.sample(state.player_order, size)
+
+    def vote_team(self, state, rng):
+        return 'approve' if rng.random() < 0.6 else 'reject'
+
+    def mission_vote(self, state, rng):
+        return 'fail' if rng.random() < 0.5 else 'success'
+
+    def use_lady(self, state, candidates, rng):
+        return rng.choice(candidates)
+
+    def assassinate(self, state, candidates, rng):
+        return rng.choice(candidates)
+
+    def observe_votes(self, state, leader, team, approvers):
+        # 每次隊伍投票結束後呼叫 (所有玩家都看得到誰同意)；approvers 是同意者的 frozenset
+        pass
+
+
+@lru_cache(maxsize=None)
+def evil_sets(n_players, n_evil):
+    # 所有可能的壞人座位組合: [(位元遮罩, 座位)]
+    return [(sum(1 << i for i in seats), seats) for seats in combinations(range(n_players), n_evil)]
+
+
+class SimplePolicy(RandomPolicy):
+    # 好人對「誰是壞人」維持一份機率：列出所有可能的壞人組合，先以自己的情報刪去不可能的
+    # (梅林看到的壞人、派西維爾看到的兩人中恰有一位是莫甘娜、湖中女神的查驗)，再依公開紀錄調整權重：
+    #   任務   失敗票數多於隊上壞人數的組合不可能；有壞人卻全是成功票的組合不太可能 (壞人偶爾放水)
+    #   投票   壞人傾向同意有自己人的隊伍、否決沒有的
+    # 好人當隊長時帶最不可疑的人，只同意乾淨機率接近最佳隊伍的提案
+    # 壞人: 隊上有自己人才同意 (偶爾反著投以免太明顯)；同一隊多個壞人時只由一人出失敗票，第 1 個任務偶爾出成功票換取信任
+    # 刺客: 猜投票與帶隊最像「看得到壞人」的好人
+    EVIL_BLUFF = 0.3        # 壞人在第 1 個任務改出成功票的機率
+    EVIL_VOTE_NOISE = 0.2   # 壞人反著投隊伍票的機率
+    LATE_BLUFF = 0.05       # 好人估計壞人在之後的任務放水的機率
+    APPROVE_RATIO = 0.75    # 提案的乾淨機率至少是自己心目中最佳隊伍的這個比例才同意
+
+    def __init__(self, name, role, seen):
+        super().__init__(name, role, seen)
+        self.evil = is_evil(role)
+        # 梅林看到的是壞人 (莫德雷德除外)；壞人看到的是同伴 (奧伯倫除外)；派西維爾看到梅林與莫甘娜但分不出來
+        self.known_evil = set(seen) - {name} if role == Role.MERLIN or self.evil else set()
+        self.pair = frozenset(seen) if role == Role.PERCIVAL else frozenset()
+        self.votes = []  # (任務編號, 隊長, 隊伍, 同意者)
+        self.beliefs = None  # 可能的壞人組合 -> 權重，第一次需要時才建立
+        self.applied = [0, 0, 0]  # 已套用到 beliefs 的投票、任務與查驗筆數
+        self.odds = None          # 依目前 beliefs 算好的每人嫌疑，以及各隊伍的乾淨機率
+        self.clean = {}
+
+    def observe_votes(self, state, leader, team, approvers):
+        self.votes.append((state.mission_number, leader, frozenset(team), approvers))
+
+    # --- 好人的推理 ---
+    # 組合與隊伍都以位元遮罩表示 (第 i 位 = player_order[i])，交集與人數只是整數運算
+    def mask(self, state, players):
+        order = state.player_order
+        return sum(1 << order.index(p) for p in players)
+
+    def belief(self, state):
+        if self.beliefs is None:
+            order = state.player_order
+            n_evil = sum(map(is_evil, state.roles_in_game))
+            morgana = Role.MORGANA in state.roles_in_game
+            known, pair = self.mask(state, self.known_evil), self.mask(state, self.pair)
+            self.k = n_evil
+            self.members = {}
+            self.beliefs = {}
+            me = 1 << order.index(self.name)
+            for m, seats in evil_sets(len(order), n_evil):
+                if m & me or m & known != known: continue
+                if pair and (m & pair).bit_count() != morgana: continue
+                self.members[m] = [order[i] for i in seats]
+                self.beliefs[m] = 1.0
+        beliefs = self.beliefs
+        applied = [len(self.votes), len(state.mission_history), len(state.events)]
+        if self.applied == applied: return beliefs
+        votes, missions, events = self.applied
+        # 每位壞人的票與「隊上有沒有壞人」一致的機率是 0.8 (相對於好人的 0.5 是 1.6 倍)，不一致是 0.2 (0.4 倍)
+        factor = [1.6 ** c * 0.4 ** (self.k - c) for c in range(self.k + 1)]
+        for _, _, team, approvers in self.votes[votes:]:
+            team, approvers = self.mask(state, team), self.mask(state, approvers)
+            for h in beliefs:
+                agree = h & approvers if h & team else h & ~approvers
+                beliefs[h] *= factor[agree.bit_count()]
+        for mission in state.mission_history[missions:]:
+            team = self.mask(state, mission.team)
+            bluff = self.EVIL_BLUFF if mission.mission_num == 1 else self.LATE_BLUFF
+            for h in list(beliefs):
+                evil_on_team = (h & team).bit_count()
+                if mission.fails > evil_on_team: del beliefs[h]
+                elif evil_on_team and not mission.fails: beliefs[h] *= bluff
+        for event in state.events[events:]:
+            if event.to != self.name: continue
+            target = self.mask(state, [event.target])
+            for h in list(beliefs):
+                if bool(h & target) != event.evil: del beliefs[h]
+        total = sum(beliefs.values()) or 1.0
+        for h in beliefs: beliefs[h] /= total
+        self.applied, self.odds, self.clean = applied, None, {}
+        return beliefs
+
+    def evil_odds(self, state):
+        beliefs = self.belief(state)
+        if self.odds is None:
+            self.odds = odds = dict.fromkeys(state.player_order, 0.0)
+            members = self.members
+            for h, w in beliefs.items():
+                for p in members[h]: odds[p] += w
+        return self.odds
+
+    def clean_odds(self, state, team):
+        beliefs = self.belief(state)
+        team = self.mask(state, team)
+        if team not in self.clean: self.clean[team] = sum(w for h, w in beliefs.items() if not h & team)
+        return self.clean[team]
+
+    def best_team(self, state, size, rng):
+        odds = self.evil_odds(state)
+        others = [p for p in state.player_order if p != self.name]
+        rng.shuffle(others)
+        others.sort(key=lambda p: odds[p])
+        return [self.name] + others[:size - 1]
+
+    # --- 壞人 ---
+    def evil_on(self, team):
+        return [p for p in team if p == self.name or p in self.known_evil]
+
+    def propose_team(self, state, size, rng):
+        if not self.evil: return self.best_team(state, size, rng)
+        # 壞人帶自己加上其他看起來乾淨的人，避免一次放太多自己人而曝光
+        others = [p for p in state.player_order if p != self.name and p not in self.known_evil]
+        return [self.name] + rng.sample(others, size - 1)
+
+    def vote_team(self, state, rng):
+        team = state.team_proposal
+        if state.vote_reject_count >= 4:
+            # 第五次提案被否決就直接輸了，好人一律同意；壞人一律否決
+            return 'reject' if self.evil else 'approve'
+        if self.evil:
+            approve = bool(self.evil_on(team)) != (rng.random() < self.EVIL_VOTE_NOISE)
+            return 'approve' if approve else 'reject'
+        best = self.clean_odds(state, self.best_team(state, len(team), rng))
+        return 'approve' if self.clean_odds(state, team) >= best * self.APPROVE_RATIO else 'reject'
+
+    def mission_vote(self, state, rng):
+        fails = state.quest_track.count(Quest.FAIL)
+        successes = state.quest_track.count(Quest.SUCCESS)
+        two_fails = game_engine.TWO_FAILS_MISSION_REQUIRED.get(len(state.player_order)) == state.mission_number
+        if fails == 2 or successes == 2 or two_fails: return 'fail'
+        # 同隊的壞人 (彼此看得到) 約定由順位最前的人出失敗票，避免失敗票數暴露人數
+        evil_on_team = sorted(self.evil_on(state.team_proposal), key=state.player_order.index)
+        if evil_on_team[0] != self.name: return 'success'
+        if state.mission_number == 1 and rng.random() < self.EVIL_BLUFF: return 'success'
+        return 'fail'
+
+    def use_lady(self, state, candidates, rng):
+        # 查驗最拿不準的人 (壞人持有時隨便查)
+        if self.evil: return rng.choice(candidates)
+        odds = self.evil_odds(state)
+        return min(candidates, key=lambda p: (abs(odds[p] - 0.5), rng.random()))
+
+    def assassinate(self, state, candidates, rng):
+        # 梅林的投票會避開壞人：否決含壞人的隊伍、同意乾淨的隊伍，當隊長時不帶壞人
+        merlinness = Counter()
+        for _, leader, team, approvers in self.votes:
+            dirty = bool(self.evil_on(team))
+            for p in candidates:
+                approved = p in approvers
+                merlinness[p] += (-1 if approved else 1) if dirty else (0.5 if approved else -0.5)
+            merlinness[leader] += -2 if dirty else 1
+        return max(candidates, key=lambda p: (merlinness[p], rng.random()))
+
+
+POLICIES = {"random": RandomPolicy, "simple": SimplePolicy}
+
+def load_policy(spec):
+    if spec in POLICIES: return POLICIES[spec]
+    module, _, attr = spec.partition(':')
+    if not attr: raise ValueError(f"未知的策略 {spec}，請用 {', '.join(POLICIES)} 或 module:Class")
+    return getattr(importlib.import_module(module), attr)
+
+
+# --- 對局 ---
+def play_game(players, roles, track, use_lady, policy_cls, rng):
+    # 跑完一局，回傳 (勝方, 結束原因)
+    state = game_engine.new_game(players, roles, track, use_lady, rng=rng, now=0)
+    bots = {name: policy_cls(name, state.roles[name], state.seen[name]) for name in players}
+    observers = [bot for bot in bots.values() if hasattr(bot, 'observe_votes')]
+    apply = game_engine.apply_action
+    while state.phase != END:
+        phase = state.phase
+        if phase == TEAM_BUILDING:
+            leader = state.player_order[state.current_leader_index]
+            size = state.mission_team_sizes[state.mission_number - 1]
+            team = list(bots[leader].propose_team(state, size, rng))
+            if len(set(team)) != size or not set(team) <= bots.keys():
+                raise ValueError(f"{policy_cls.__name__}.propose_team 回傳了不合法的隊伍: {team}")
+            apply(state, players, leader, 'propose_team', {'team': team}, now=0)
+        elif phase == TEAM_VOTE:
+            leader, team = state.player_order[state.current_leader_index], state.team_proposal
+            for name in players:
+                apply(state, players, name, 'vote_team', {'vote': bots[name].vote_team(state, rng)}, now=0)
+            approvers = frozenset(name for name, vote in state.last_vote_details if vote == APPROVE)
+            for bot in observers: bot.observe_votes(state, leader, team, approvers)
+        elif phase == MISSION_VOTE:
+            for name in list(state.team_proposal):
+                # 與網頁一樣，好人只能投成功
+                vote = bots[name].mission_vote(state, rng) if is_evil(state.roles[name]) else 'success'
+                apply(state, players, name, 'mission_vote', {'vote': vote}, now=0)
+        elif phase == LADY_OF_THE_LAKE:
+            holder = state.lady_holder
+            candidates = [p for p in players if p != holder and p not in state.lady_used_on]
+            apply(state, players, holder, 'use_lady', {'target': bots[holder].use_lady(state, candidates, rng)}, now=0)
+        elif phase == ASSASSINATION:
+            assassin = next(p for p in players if state.roles[p] == Role.ASSASSIN)
+            candidates = [p for p in players if not is_evil(state.roles[p])]
+            apply(state, players, assassin, 'assassinate', {'target': bots[assassin].assassinate(state, candidates, rng)}, now=0)
+    return outcome(state)
+
+def outcome(state):
+    if state.game_over.good_won:
+        return 'good', 'assassin_missed' if Role.ASSASSIN in state.roles_in_game else 'missions'
+    if state.quest_track.count(Quest.FAIL) >= 3: return 'evil', 'missions'
+    if state.vote_reject_count >= 5: return 'evil', 'rejected'
+    return 'evil', 'assassinated'
+
+def run_batch(job):
+    # 在工作行程中執行：job = (設定名稱, 玩家人數, 角色, 任務軌跡, 湖中女神, 策略, 局數, 種子)
+    label, n_players, roles, track, use_lady, policy, games, seed = job
+    rng = random.Random(seed)
+    players = [f"P{i}" for i in range(n_players)]
+    policy_cls = load_policy(policy)
+    counts = Counter()
+    for _ in range(games): counts[play_game(players, roles, track, use_lady, policy_cls, rng)] += 1
+    return label, counts
+
+
+# --- 設定與報表 ---
+def default_configs():
+    for n, (good, evil) in sorted(game_engine.ROLE_CONFIG.items()):
+        yield f"{n}人", n, good + evil, game_engine.MISSION_SIZES[n]
+
+def custom_config(args):
+    n = args.players
+    if n < 2: raise SystemExit(f"--players 至少要 2 人: {n}")
+    if n not in game_engine.ROLE_CONFIG and not (args.roles and args.track):
+        raise SystemExit(f"沒有 {n} 人的預設角色與任務軌跡 (預設支援 {min(game_engine.ROLE_CONFIG)}–{max(game_engine.ROLE_CONFIG)} 人)，"
+                         "請以 --roles 與 --track 指定")
+    roles = game_engine.parse_roles(args.roles.split(',')) if args.roles else sum(game_engine.ROLE_CONFIG[n], [])
+    track = [int(x) for x in args.track.split(',')] if args.track else game_engine.MISSION_SIZES[n]
+    if roles is None or len(roles) != n: raise SystemExit(f"角色數量必須等於玩家人數且都是已知角色: {args.roles}")
+    if len(track) != 5 or any(size < 1 or size > n for size in track): raise SystemExit(f"任務軌跡必須是 5 個介於 1 與 {n} 的人數: {track}")
+    return f"{n}人 自訂", n, roles, track
+
+def jobs_for(configs, args):
+    seed = args.seed
+    for label, n, roles, track in configs:
+        left = args.games
+        while left > 0:
+            games = min(CHUNK_SIZE, left)
+            yield (label, n, tuple(roles), tuple(track), not args.no_lady, args.policy, games, seed)
+            left -= games; seed += 1
+
+def report(results, args, elapsed):
+    rows = []
+    for label, counts in results.items():
+        total = sum(counts.values())
+        good = sum(v for (team, _), v in counts.items() if team == 'good')
+        p = good / total
+        rows.append({
+            "config": label, "games": total, "good_win_rate": round(p, 4),
+            "ci95": round(1.96 * math.sqrt(p * (1 - p) / total), 4),
+            "reasons": {f"{team}/{reason}": v / total for (team, reason), v in sorted(counts.items())},
+        })
+    if args.json:
+        print(json.dumps({"policy": args.policy, "seed": args.seed, "elapsed": elapsed, "results": rows}, ensure_ascii=False, indent=2))
+        return
+    total_games = sum(r['games'] for r in rows)
+    print(f"策略 {args.policy}，共 {total_games} 局，{elapsed:.1f} 秒 ({total_games / elapsed:.0f} 局/秒)")
+    print("(勝率反映的是機器人策略在這套規則下的表現，適合比較設定之間的差異，不等於真人對局的平衡)")
+    for r in rows:
+        reasons = "  ".join(f"{k} {v * 100:5.1f}%" for k, v in r['reasons'].items())
+        print(f"{r['config']:8s} 好人勝率 {r['good_win_rate'] * 100:5.1f}% ±{r['ci95'] * 100:.1f}  {reasons}")
+
+def main():
+    parser = argparse.ArgumentParser(description="阿瓦隆批次模擬")
+    parser.add_argument("--games", type=int, default=10000, help="每種設定的對局數")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--policy", default="simple", help="random、simple 或 module:Class")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--players", type=int, help="只模擬這個人數 (搭配 --roles / --track 自訂)")
+    parser.add_argument("--roles", help="逗號分隔的角色列表")
+    parser.add_argument("--track", help="逗號分隔的五個任務人數")
+    parser.add_argument("--no-lady", action="store_true", help="不使用湖中女神")
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+    if args.games < 1: raise SystemExit(f"--games 至少要 1 局: {args.games}")
+    load_policy(args.policy)  # 提早檢查策略能不能載入
+
+    if args.players is not None: configs = [custom_config(args)]
+    elif args.roles or args.track: raise SystemExit("--roles 與 --track 需要搭配 --players")
+    else: configs = list(default_configs())
+
+    results = {label: Counter() for label, *_ in configs}
+    t0 = time.perf_counter()
+    jobs = list(jobs_for(configs, args))
+    if args.workers <= 1:
+        for label, counts in map(run_batch, jobs): results[label] += counts
+    else:
+        with ProcessPoolExecutor(args.workers) as pool:
+            for label, counts in pool.map(run_batch, jobs): results[label] += counts
+    report(results, args, time.perf_counter() - t0)
+
+if __name__ == "__main__":
+    sys.exit(main())
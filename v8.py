@@ -1,263 +1,915 @@
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, g, has_request_context, request, jsonify, render_template
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+from functools import lru_cache
+import copy
+import datetime
+import gzip
+import hashlib
+import heapq
+import hmac
 import random
+import sys
 import threading
+import json
+import math
 import os
 import time
+import urllib.error
+import urllib.request
 import uuid
+from room_store import create_room_store
+try:
+    import orjson  # 選用：有安裝時用來編碼回應，比標準 json 快數倍
+except ImportError:
+    orjson = None
+from game_history import GameHistory
+from game_log import GameLog
+from metrics import LOCK_BUCKETS, Registry, TimedLock
+from profiler import SamplingProfiler
+import game_engine
+import wire
+from game_engine import ALL_ROLES, ROLE_BY_NAME, ROLE_CONFIG, MISSION_SIZES, PHASE_NAMES, PHASE_TEXTS, QUEST_NAMES, Phase, Vote
+from room_model import Player, Room, Settings, lobby_to_dict, room_from_dict, room_to_dict, with_lobby
 
 # 初始化 Flask App，它會自動從 'templates' 資料夾尋找網頁
 app = Flask(__name__)
 
 # --- 全域狀態 (多房間) ---
+# 多個 worker 行程 (例如 gunicorn -w 4) 必須設定 ROOM_STORE=sqlite 共用房間，此時 rooms 只是本行程的快取
+ROOM_STORE = os.environ.get("ROOM_STORE", "memory")
+ROOM_STORE_PATH = os.environ.get("ROOM_STORE_PATH", "avalon_rooms.db")
+STORE_POLL_INTERVAL = 0.2  # 共用儲存時，長輪詢檢查其他行程變動的間隔 (秒)
+HEARTBEAT_SAVE_INTERVAL = 1  # 共用儲存時心跳更新 last_seen 的最短間隔 (秒)，需小於 TIMEOUT_SECONDS - LONG_POLL_TIMEOUT
+
+metrics = Registry()  # GET /metrics 匯出的指標，其餘定義見下方「指標」一節
+lock_seconds = metrics.histogram("avalon_lock_seconds", "取得鎖的等待 (stage=wait) 與持有 (stage=hold) 秒數", ["lock", "stage"], LOCK_BUCKETS)
+
 rooms = {}
-rooms_lock = threading.Lock()
+rooms_lock = TimedLock(lock_seconds, "registry")  # 登記鎖：只保護 rooms / room_runtime 的新增、刪除與查詢
+room_runtime = {}  # 房間的執行期資料 (不傳給客戶端)，cond 同時是該房間的鎖與長輪詢的 Condition
+player_tokens = {}  # token -> (room_code, player)，單次 dict 操作即完成，不另外加鎖
+room_snapshots = {}  # room_code -> RoomSnapshot，寫入者持有房間鎖時整個換掉，讀取者不取鎖
+spectator_feeds = {}  # room_code -> ((發布時間, 版本號, 已編碼的觀戰狀態), ...)，由舊到新，同樣整個換掉
+lock_wait_samples = deque(maxlen=100000)  # 最近取得房間鎖 (含共用儲存的交易) 的等待秒數，供負載測試統計
+room_change_listeners = []  # 房間變動 (或被移除) 時呼叫 listener(room_code)，供 ASGI 模式喚醒協程
+room_store = create_room_store(ROOM_STORE, ROOM_STORE_PATH, rooms)
+
+# 設定 GAME_LOG_DIR 後，每次房間變動都寫入事件日誌，重啟時由快照 + 重播恢復 (共用儲存本身已持久化，不需要)
+GAME_LOG_DIR = os.environ.get("GAME_LOG_DIR")
+SNAPSHOT_INTERVAL = 60  # 寫入快照的間隔 (秒)，限制重啟時需要重播的紀錄數
+game_log = GameLog(GAME_LOG_DIR) if GAME_LOG_DIR and not room_store.shared else None
+
+# 設定 GAME_HISTORY_PATH 後，每局結束時把結果附加到該 SQLite 檔 (多個 worker 可共用同一個檔案)，供 /history 查詢與匯出
+GAME_HISTORY_PATH = os.environ.get("GAME_HISTORY_PATH")
+HISTORY_PAGE_LIMIT = 100  # /history/games 一頁最多的局數
+game_history = GameHistory(GAME_HISTORY_PATH) if GAME_HISTORY_PATH else None
 
 # --- 遊戲設定 ---
 TIMEOUT_SECONDS = 10  # 玩家超時時間 (秒)
 LOBBY_KICK_TIMEOUT = 60 # 大廳玩家離線踢除時間 (秒)
-REAP_INTERVAL = 5     # 巡邏員檢查間隔 (秒)
-
-ALL_ROLES = {
-    "good": ["梅林", "派西維爾",
-             "亞瑟的忠臣", "亞瑟的忠臣", "亞瑟的忠臣", "亞瑟的忠臣", "亞瑟的忠臣", "亞瑟的忠臣"],
-    "evil": ["莫甘娜", "刺客", "莫德雷德", "奧伯倫",
-             "莫德雷德的爪牙", "莫德雷德的爪牙", "莫德雷德的爪牙", "莫德雷德的爪牙"]
-}
-
-ROLE_CONFIG = {
-    5: (["梅林", "派西維爾", "亞瑟的忠臣"], ["莫甘娜", "刺客"]),
-    6: (["梅林", "派西維爾", "亞瑟的忠臣", "亞瑟的忠臣"], ["莫甘娜", "刺客"]),
-    7: (["梅林", "派西維爾", "亞瑟的忠臣", "亞瑟的忠臣"], ["莫甘娜", "刺客", "奧伯倫"]),
-    8: (["梅林", "派西維爾", "亞瑟的忠臣", "亞瑟的忠臣", "亞瑟的忠臣"], ["莫甘娜", "刺客", "莫德雷德"]),
-    9: (["梅林", "派西維爾", "亞瑟的忠臣", "亞瑟的忠臣", "亞瑟的忠臣", "亞瑟的忠臣"], ["莫甘娜", "刺客", "莫德雷德"]),
-    10: (["梅林", "派西維爾", "亞瑟的忠臣", "亞瑟的忠臣", "亞瑟的忠臣", "亞瑟的忠臣"], ["莫甘娜", "刺客", "莫德雷德", "奧伯倫"]),
-}
-MISSION_SIZES = {
-    5: [2, 3, 2, 3, 3], 6: [2, 3, 4, 3, 4], 7: [2, 3, 3, 4, 4],
-    8: [3, 4, 4, 5, 5], 9: [3, 4, 4, 5, 5], 10: [3, 4, 4, 5, 5],
-}
-TWO_FAILS_MISSION_REQUIRED = { 7: 4, 8: 4, 9: 4, 10: 4 }
+ROOM_EXPIRY = 3600    # 房間建立超過此時間 (秒) 且無人在線即刪除
+REAP_INTERVAL = 5     # 未當選巡邏員時重試選舉、共用儲存時同步其他行程房間的間隔 (秒)
+MAX_AUTO_ACTIONS = 20 # 一次連續代替斷線玩家行動的次數上限
+DEADLINE_SLACK = 0.01 # 期限到達後再多等的時間 (秒)，確保超時判斷 (嚴格大於) 成立
+LONG_POLL_TIMEOUT = 8 # 長輪詢最長等待時間 (秒)，需小於 TIMEOUT_SECONDS 以免被判定離線
+MAX_BATCH_ACTIONS = 20 # /actions 一次最多的動作數
+MAX_SPECTATOR_DELAY = 600  # 觀戰延遲上限 (秒)
+SPECTATE_MAX_AGE = 1  # 觀戰回應允許快取的秒數 (Cache-Control)，讓 CDN / 反向代理也能分擔同一份內容
+DELTA_HISTORY = 2     # 快照保留之前幾個版本的編碼結果，客戶端落後不超過這個數量時仍可收差異 (長輪詢通常只落後 1 版)
+
+# --- 容量限制 ---
+# 房間數與玩家數是軟上限 (同時建立的請求可能略為超過)；達到房間上限時先回收閒置房間，沒有可回收的就快速拒絕
+MAX_ROOMS = int(os.environ.get("MAX_ROOMS", 20000))
+MAX_PLAYERS = int(os.environ.get("MAX_PLAYERS", 100000))
+MAX_BODY_BYTES = int(os.environ.get("MAX_BODY_BYTES", 16 * 1024))  # 請求內容上限，超過回 413
+MAX_NAME_LENGTH = 20
+RETRY_AFTER = 5       # 拒絕時 Retry-After 建議的秒數；找不到可回收房間後這段時間內不再重新掃描
+EVICT_BATCH = 32      # 達到房間上限時一次最多回收的閒置房間數
+GAME_EVICT_IDLE = int(os.environ.get("GAME_EVICT_IDLE", 1800))  # 進行中的遊戲要閒置超過此秒數才可被回收，短暫斷線不會丟掉整局
+app.config['MAX_CONTENT_LENGTH'] = MAX_BODY_BYTES
+eviction_blocked_until = 0
+
+# --- 指標 (GET /metrics) ---
+# 熱路徑上的記錄只是 deque.append，匯出時才彙整；房間與玩家分布在匯出時掃描本行程的 rooms
+# (共用儲存時只涵蓋本行程載入過的房間)
+request_seconds = metrics.histogram("avalon_request_seconds", "各路由的處理時間 (長輪詢含等待時間)", ["route", "status"])
+reaper_seconds = metrics.histogram("avalon_reaper_pass_seconds", "排程器每一輪的時間 (stage=sync 同步房間、deadlines 處理到期房間)", ["stage"])
+auto_actions = metrics.counter("avalon_auto_actions_total", "代替斷線玩家執行的自動動作", ["type"])
+spectator_reads = metrics.counter("avalon_spectator_reads_total", "觀戰請求 (status=200 送出內容、304 未變動)", ["status"])
+metrics.gauge("avalon_spectated_rooms", "開放觀戰且已有觀戰紀錄的房間數", lambda: len(spectator_feeds))
+state_bytes = metrics.counter("avalon_state_bytes_total", "房間狀態回應的內容大小 (format=json 預設、msgpack 精簡格式)", ["format"])
+state_reads = metrics.counter("avalon_state_reads_total", "讀取房間狀態的路徑 (snapshot 不取鎖、locked 取房間鎖)", ["path"])
+rejected_requests = metrics.counter("avalon_rejected_requests_total", "因容量限制或排空 (reason=draining) 被拒絕的請求", ["reason"])
+evicted_rooms = metrics.counter("avalon_evicted_rooms_total", "達到房間上限時回收的閒置房間", ["kind"])
+metrics.gauge("avalon_rooms", "目前的房間數", lambda: room_store.usage()[0])
+metrics.gauge("avalon_players", "目前的玩家數", lambda: room_store.usage()[1])
+metrics.gauge("avalon_room_limit", "房間數上限 (MAX_ROOMS)", lambda: MAX_ROOMS)
+metrics.gauge("avalon_player_limit", "玩家數上限 (MAX_PLAYERS)", lambda: MAX_PLAYERS)
+metrics.gauge("avalon_history_pending", "尚未寫入遊戲紀錄的局數", lambda: game_history.pending() if game_history else 0)
+
+def rooms_by_phase():
+    counts = dict.fromkeys([("lobby",)] + [(name,) for name in PHASE_NAMES], 0)
+    for room in list(rooms.values()):
+        counts[(PHASE_NAMES[room.game.phase] if room.game else "lobby",)] += 1
+    return counts
+
+def players_by_status():
+    connected = disconnected = 0
+    for room in list(rooms.values()):
+        for p in room.players:
+            if p.connected: connected += 1
+            else: disconnected += 1
+    return {("connected",): connected, ("disconnected",): disconnected}
+
+# --- 管理介面 (/admin/*) ---
+# 以 ADMIN_SECRET 驗證 (請求帶 X-Admin-Secret 標頭)，未設定時一律拒絕
+# 不以來源位址判斷：同一台機器上的反向代理轉送進來的外部請求，來源位址也是 127.0.0.1
+ADMIN_SECRET = os.environ.get("ADMIN_SECRET")
+
+def admin_denied():
+    # 驗證失敗時回傳 403 回應，通過時回傳 None
+    secret = request.headers.get('X-Admin-Secret', '')
+    if not ADMIN_SECRET or not hmac.compare_digest(secret.encode(), ADMIN_SECRET.encode()):
+        return jsonify({"success": False, "message": "管理驗證失敗"}), 403
+    return None
+
+# --- 效能剖析 (預設關閉；也可以 /admin/profiler 在執行中開關) ---
+# PROFILE_HZ > 0 時啟動取樣剖析器，火焰圖格式 (folded stacks) 寫到 PROFILE_DIR
+# SLOW_REQUEST_MS > 0 時記錄超過此時間的請求，並拆成鎖等待、長輪詢等待、序列化與其餘處理邏輯
+MAX_PROFILE_HZ = 1000  # 取樣頻率上限；再高時取樣執行緒本身就會拖慢請求
+PROFILE_HZ = min(float(os.environ.get("PROFILE_HZ", 0)), MAX_PROFILE_HZ)
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+slow_request_seconds = float(os.environ.get("SLOW_REQUEST_MS", 0)) / 1000
+profiler = SamplingProfiler(PROFILE_DIR)
+TRACE_LOCK, TRACE_WAIT, TRACE_SERIALIZE = range(3)  # 請求分項計時 (request.environ['avalon.trace']) 的位置
+
+metrics.gauge("avalon_rooms_by_phase", "各階段的房間數 (lobby 表示尚未開始遊戲)", rooms_by_phase, ["phase"])
+metrics.gauge("avalon_players_by_status", "連線中與離線的玩家數", players_by_status, ["status"])
 
 # --- 輔助函式 ---
 def get_new_room_code():
     return ''.join(random.choices('ABCDEFGHIJKLMNPQRSTUVWXYZ123456789', k=5))
 
 def find_player_by_token(room, token):
-    if not room: return None
-    for p in room.get('players', []):
-        if p.get('token') == token:
-            return p
-    return None
+    entry = player_tokens.get(token)
+    if not room or not entry: return None
+    room_code, player = entry
+    return player if rooms.get(room_code) is room else None
+
+def find_player_by_name(room_code, name):
+    rt = room_runtime.get(room_code)
+    return rt['by_name'].get(name) if rt else None
+
+# --- 玩家索引 (呼叫者需持有該房間的鎖) ---
+def index_player(room_code, player):
+    room_runtime[room_code]['by_name'][player.name] = player
+    player_tokens[player.token] = (room_code, player)
+
+def unindex_player(room_code, player):
+    room_runtime[room_code]['by_name'].pop(player.name, None)
+    player_tokens.pop(player.token, None)
+
+def reindex_room(room_code, room):
+    # 共用儲存時從其他行程載入了新版本：換掉快取並重建索引 (呼叫者需持有該房間的鎖)
+    old = rooms.get(room_code)
+    for p in (old.players if old else []):
+        player_tokens.pop(p.token, None)
+    room_runtime[room_code]['by_name'] = {}
+    with rooms_lock: rooms[room_code] = room
+    for p in room.players:
+        index_player(room_code, p)
+
+def is_joinable(room):
+    return not room.settings.password and not room.game and len(room.players) < room.settings.max_players
+
+# --- 房間鎖與變動通知 ---
+def init_room_runtime(room_code):
+    # by_name: 玩家名稱 -> 玩家
+    # 呼叫者需持有 rooms_lock；已存在時沿用原本的
+    return room_runtime.setdefault(room_code, {"cond": threading.Condition(threading.Lock()), "by_name": {}})
+
+def get_room_runtime(room_code):
+    rt = room_runtime.get(room_code)
+    if rt is None and room_store.shared and room_store.exists(room_code):
+        # 其他行程建立的房間，第一次在本行程出現
+        with rooms_lock: rt = init_room_runtime(room_code)
+    return rt
+
+@contextmanager
+def locked_room(room_code, write=True):
+    # 只鎖住該房間 (共用儲存時再加上跨行程交易)，從儲存載入後給出房間，結束時寫回
+    # write=False 給只讀的路徑 (查詢狀態、長輪詢、觀戰)：共用儲存時不開寫入交易，版本或 last_seen 有變才寫回
+    # 房間不存在 (或在等鎖期間被刪除) 時給出 None
+    # 鎖的順序固定為「房間鎖 -> 資料庫交易 -> 登記鎖」：持有登記鎖時不可再去取房間鎖或寫入儲存
+    rt = get_room_runtime(room_code)
+    if rt is None:
+        yield None
+        return
+    wait_start = time.perf_counter()
+    with rt['cond'], room_store.transaction(write):
+        acquired_at = time.perf_counter()
+        lock_wait_samples.append(acquired_at - wait_start)
+        lock_seconds.observe(acquired_at - wait_start, "room", "wait")
+        trace_add(TRACE_LOCK, acquired_at - wait_start)
+        room, fresh = room_store.load(room_code)
+        if room is None:
+            forget_room(room_code)
+        elif fresh:
+            reindex_room(room_code, room)
+        stamp = None if write or room is None else room_stamp(room)
+        yield room
+        if room is not None and rooms.get(room_code) is room and (write or room_stamp(room) != stamp):
+            # 寫回衝突 (只讀的路徑載入後被其他行程改動)：本行程的快取與快照已過時，丟掉後下次重新載入
+            if not room_store.save(room_code, room, is_joinable(room)): forget_room(room_code)
+    lock_seconds.observe(time.perf_counter() - acquired_at, "room", "hold")
+
+def room_stamp(room):
+    # 只讀的路徑可能改到的部分：版本號 (斷線後回來) 與心跳
+    return room.version, [p.last_seen for p in room.players]
+
+def room_version(room_code):
+    return room_store.version(room_code)
+
+def wait_for_room_change(room_code, since, timeout):
+    # 不持有交易地等待房間版本離開 since；共用儲存時其他行程的變動靠定期查詢發現
+    rt = get_room_runtime(room_code)
+    if rt is None: return
+    deadline = time.time() + timeout
+    wait_start = time.perf_counter()
+    try:
+        with rt['cond']:
+            while room_version(room_code) == since:
+                remaining = deadline - time.time()
+                if remaining <= 0: return
+                rt['cond'].wait(min(remaining, STORE_POLL_INTERVAL) if room_store.shared else remaining)
+    finally:
+        trace_add(TRACE_WAIT, time.perf_counter() - wait_start)
+
+def mark_room_changed(room_code, event=('lobby',), players_only=False):
+    # 房間狀態確實改變時呼叫：版本號 +1、寫入事件日誌、發布新的快照，並喚醒本行程中等待此房間的長輪詢
+    # event 預設為 'lobby' (只記錄玩家與設定)；改動 gameState 的路徑必須傳入對應的事件
+    # players_only: 只有玩家的連線狀態改變，快照沿用上一版其餘已編碼的欄位
+    room = rooms.get(room_code)
+    if room:
+        room.version += 1
+        record_event(room_code, *event)
+        if event[0] in ('action', 'actions', 'auto') and room.game.phase == Phase.END: record_finished_game(room_code, room)
+        schedule_room(room_code, room_next_deadline(room))
+        publish_snapshot(room_code, room, players_only)
+    rt = room_runtime.get(room_code)
+    if rt: rt['cond'].notify_all()
+    for listener in room_change_listeners: listener(room_code)
+
+def record_event(room_code, kind, *args):
+    # 事件類型: room (整個房間)、lobby (玩家/順序/設定)、action (玩家動作)、actions (同一位玩家的一批動作)、
+    # auto (代替斷線玩家行動)、delete
+    # 呼叫者需持有該房間的鎖，同一房間的紀錄才會依版本順序寫入
+    if not game_log: return
+    room = rooms.get(room_code)
+    if kind == 'room': args = (room_to_dict(room),)
+    elif kind == 'lobby': args = (lobby_to_dict(room),)
+    game_log.append([time.time(), room_code, room.version if room else None, kind, list(args)])
+
+def record_finished_game(room_code, room):
+    # 只有玩家動作 (含代替斷線玩家的動作) 會讓遊戲結束，結束後不再接受動作，所以每局只會寫一次；
+    # 即使重複，(房號, 開始時間) 的唯一限制也會忽略
+    if not game_history: return
+    gs = room.game
+    started_at = gs.game_start_time / 1000
+    over = game_engine.game_over_view(gs)
+    game_history.append({
+        "room_code": room_code, "started_at": started_at, "ended_at": started_at + gs.game_over.duration / 1000,
+        "duration": gs.game_over.duration, "good_won": gs.game_over.good_won, "reason": gs.game_over.reason,
+        "players": [(name, role, game_engine.is_evil(role)) for name, role in gs.roles.items()],
+        "data": {"players": over["all_roles"], "missions": game_engine.mission_history_view(gs)},
+    })
 
-def find_player_by_name(room, name):
-    if not room: return None
-    for p in room.get('players', []):
-        if p.get('name') == name:
-            return p
-    return None
+def forget_room(room_code):
+    # 清掉本行程中此房間的快取與索引 (呼叫者需持有該房間的鎖)
+    with rooms_lock:
+        room = rooms.pop(room_code, None)
+        rt = room_runtime.pop(room_code, None)
+    room_snapshots.pop(room_code, None)
+    spectator_feeds.pop(room_code, None)
+    for p in (room.players if room else []):
+        player_tokens.pop(p.token, None)
+    if rt: rt['cond'].notify_all()
+    for listener in room_change_listeners: listener(room_code)
+
+def delete_room(room_code):
+    # 呼叫者需持有該房間的鎖
+    record_event(room_code, 'delete')
+    room_store.delete(room_code)
+    forget_room(room_code)
+    unschedule_room(room_code)
+
+def touch_player(room_code, player):
+    # 心跳：更新最後上線時間；只有斷線 -> 上線才算房間變動
+    # 共用儲存時 last_seen 必須寫回其他行程 (巡邏員) 才看得到，間隔太短就不更新，一般的心跳不必寫回
+    now = time.time()
+    if not room_store.shared or now - player.last_seen >= HEARTBEAT_SAVE_INTERVAL: player.last_seen = now
+    if not player.connected:
+        player.connected = True
+        mark_room_changed(room_code, players_only=True)
+
+# --- 容量限制與回收 ---
+def valid_player_name(name):
+    return isinstance(name, str) and 0 < len(name) <= MAX_NAME_LENGTH
+
+def reject_busy(reason, message):
+    # 容量不足時快速拒絕 (不取任何房間鎖)，並告訴客戶端多久後再試
+    rejected_requests.inc(reason)
+    response = jsonify({"success": False, "message": message})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(RETRY_AFTER)
+    return response
+
+def ensure_room_capacity():
+    # 回傳 True 表示可以再建立房間 (呼叫者不可持有任何房間鎖)
+    global eviction_blocked_until
+    room_count = room_store.usage()[0]
+    if room_count < MAX_ROOMS: return True
+    if time.time() < eviction_blocked_until: return False
+    if evict_idle_rooms(max(EVICT_BATCH, room_count - MAX_ROOMS + 1)): return True
+    eviction_blocked_until = time.time() + RETRY_AFTER
+    return False
+
+def room_last_active(room):
+    return max((p.last_seen for p in room.players), default=0)
+
+def room_evictable(room, now):
+    # 大廳與已結束的遊戲：所有玩家都超過 TIMEOUT_SECONDS 沒有心跳；進行中的遊戲要閒置超過 GAME_EVICT_IDLE
+    return now - room_last_active(room) > (GAME_EVICT_IDLE if room_in_progress(room) else TIMEOUT_SECONDS)
+
+def evict_idle_rooms(limit):
+    # 先回收大廳與已結束的遊戲、再回收進行中的遊戲，各自由最久沒有活動的開始
+    # 掃描時不上鎖 (只讀取)，真正刪除前在房間鎖內重新確認；共用儲存時只考慮本行程載入過的房間
+    now = time.time()
+    candidates = []
+    for room_code, room in list(rooms.items()):
+        if room_evictable(room, now): candidates.append((room_in_progress(room), room_last_active(room), room_code))
+    evicted = 0
+    for _, _, room_code in heapq.nsmallest(limit, candidates):
+        with locked_room(room_code) as room:
+            if not room or not room_evictable(room, now): continue
+            delete_room(room_code)
+            evicted_rooms.inc("game" if room.game else "lobby")
+            evicted += 1
+    return evicted
 
 # --- API 端點 (Routes) ---
 @app.route('/')
 def home():
-    return render_template('index.html')
+    # 網頁內容只在啟動時產生一次 (見 compile_index_page)；ETag 是內容的雜湊，重新部署後才會改變
+    page = index_page or compile_index_page()
+    gzipped = 'gzip' in request.accept_encodings
+    etag = page.etag + ("-gz" if gzipped else "")
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = app.response_class(page.gzipped if gzipped else page.html, mimetype='text/html')
+        if gzipped: response.headers['Content-Encoding'] = 'gzip'
+    response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = 'no-cache'  # 每次都向伺服器確認，內容沒變時只回 304
+    return response
+
+@app.route('/wire/dictionary')
+def wire_dictionary():
+    # 精簡格式的字串字典，內容只隨版本更新改變，可以長期快取
+    response = jsonify({"id": wire.DICTIONARY_ID, "strings": wire.STRINGS})
+    response.set_etag(wire.DICTIONARY_ID)
+    response.headers['Cache-Control'] = "public, max-age=86400"
+    return response.make_conditional(request)
 
 @app.errorhandler(404)
 def page_not_found(e):
     return "404 - Page not found.", 404
 
+@app.errorhandler(413)
+def request_too_large(e):
+    rejected_requests.inc("body_too_large")
+    return jsonify({"success": False, "message": "請求內容過大"}), 413
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return app.response_class(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# --- 遊戲紀錄查詢 ---
+# 共同的篩選參數: player、role (中文角色名)、winner (good / evil)、from / to (YYYY-MM-DD，UTC，to 不含當天之後)
+def parse_day(value):
+    return datetime.datetime.combine(datetime.date.fromisoformat(value), datetime.time(), datetime.timezone.utc).timestamp()
+
+def history_filters(args):
+    # 回傳篩選條件 dict；參數無效時回傳錯誤訊息字串
+    filters = {"player": args.get('player')}
+    role = args.get('role')
+    if role is not None:
+        if role not in ROLE_BY_NAME: return "未知的角色"
+        filters["role"] = ROLE_BY_NAME[role]
+    winner = args.get('winner')
+    if winner is not None:
+        if winner not in ('good', 'evil'): return "winner 必須是 good 或 evil"
+        filters["good_won"] = winner == 'good'
+    try:
+        if args.get('from'): filters["since"] = parse_day(args['from'])
+        if args.get('to'): filters["until"] = parse_day(args['to']) + 86400
+    except ValueError:
+        return "日期格式應為 YYYY-MM-DD"
+    return filters
+
+def history_unavailable():
+    return jsonify({"success": False, "message": "未啟用遊戲紀錄"}), 404
+
+@app.route('/history/players/<player_name>')
+def history_player_stats(player_name):
+    if not game_history: return history_unavailable()
+    filters = history_filters(request.args)
+    if isinstance(filters, str): return jsonify({"success": False, "message": filters}), 400
+    if filters["player"] is not None: return jsonify({"success": False, "message": "玩家已由網址指定，不可再用 player 篩選"}), 400
+    del filters["player"]
+    return jsonify(game_history.player_stats(player_name, **filters))
+
+@app.route('/history/games')
+def history_games():
+    # 由新到舊分頁；下一頁傳入 before=上一頁最後一局的 id
+    if not game_history: return history_unavailable()
+    filters = history_filters(request.args)
+    if isinstance(filters, str): return jsonify({"success": False, "message": filters}), 400
+    limit = min(request.args.get('limit', 20, type=int), HISTORY_PAGE_LIMIT)
+    return jsonify({"games": game_history.games(max(limit, 1), before_id=request.args.get('before', type=int), **filters)})
+
+@app.route('/admin/history/export')
+def history_export():
+    # 需要 ADMIN_SECRET；以 NDJSON 串流所有符合條件的局 (由舊到新)，伺服器端只保留一批資料在記憶體
+    denied = admin_denied()
+    if denied: return denied
+    if not game_history: return history_unavailable()
+    filters = history_filters(request.args)
+    if isinstance(filters, str): return jsonify({"success": False, "message": filters}), 400
+    return app.response_class(game_history.export(**filters), mimetype='application/x-ndjson')
+
 @app.route('/create_room', methods=['POST'])
 def create_room():
     data = request.json
     player_name = data.get('playerName')
-    with rooms_lock:
-        room_code = get_new_room_code()
-        while room_code in rooms: room_code = get_new_room_code()
-
-        token = str(uuid.uuid4())
-        player = {
-            "name": player_name, "isHost": True, "isReady": True,
-            "token": token, "last_seen": time.time(), "status": "connected"
-        }
-
-        default_max_players = 5
-        default_good, default_evil = ROLE_CONFIG[default_max_players]
-        default_mission_track = MISSION_SIZES[default_max_players]
-
-        rooms[room_code] = {
-            "players": [player],
-            "lobbyPlayerOrder": [player_name],
-            "settings": {
-                "maxPlayers": default_max_players, "password": "", "useLady": True,
-                "randomizeOrder": True, "customRoles": default_good + default_evil,
-                "missionTrack": default_mission_track
-            },
-            "gameState": None,
-            "created_at": time.time()
-        }
+    if not valid_player_name(player_name): return jsonify({"success": False, "message": "玩家名稱無效"}), 400
+    if draining: return reject_busy("draining", "伺服器即將更新，請稍後再試")
+    if room_store.usage()[1] >= MAX_PLAYERS: return reject_busy("players", "伺服器玩家已滿，請稍後再試")
+    if not ensure_room_capacity(): return reject_busy("rooms", "伺服器房間已滿，請稍後再試")
+    room_code = get_new_room_code()
+    token = str(uuid.uuid4())
+    player = Player(player_name, token, is_host=True, is_ready=True, last_seen=time.time())
+
+    default_max_players = 5
+    default_good, default_evil = ROLE_CONFIG[default_max_players]
+    default_mission_track = MISSION_SIZES[default_max_players]
+
+    room = Room(
+        players=[player],
+        lobby_order=[player_name],
+        settings=Settings(default_max_players, default_good + default_evil, list(default_mission_track)),
+        created_at=time.time(),
+    )
+    # 寫入儲存時不持有登記鎖 (見 locked_room 的鎖順序)；房號重複就換一個再試
+    while not room_store.insert(room_code, room, is_joinable(room)): room_code = get_new_room_code()
+    with rooms_lock: rt = init_room_runtime(room_code)
+    with rt['cond']:
+        # 共用儲存時房間一寫入就可能被其他請求 (例如隨機加入) 載入並改動，此時以已載入的為準
+        if rooms.get(room_code, room) is room:
+            with rooms_lock: rooms[room_code] = room
+            index_player(room_code, player)
+        record_event(room_code, 'room')
+        schedule_room(room_code, room_next_deadline(rooms.get(room_code, room)))
     return jsonify({"success": True, "roomCode": room_code, "token": token})
 
 @app.route('/join_room', methods=['POST'])
 def join_room():
     data = request.json
     player_name, room_code = data.get('playerName'), data.get('roomCode')
-    with rooms_lock:
-        if not room_code:
-            available_rooms = [rc for rc, r in rooms.items() if not r['settings']['password'] and not r['gameState'] and len(r['players']) < r['settings']['maxPlayers']]
-            if not available_rooms: return jsonify({"success": False, "message": "沒有可加入的公開房間"}), 404
-            room_code = random.choice(available_rooms)
-
-        if room_code not in rooms: return jsonify({"success": False, "message": "房間不存在"}), 404
-        room = rooms[room_code]
-        if len(room['players']) >= room['settings']['maxPlayers']: return jsonify({"success": False, "message": "房間已滿"}), 403
-        if room['gameState']: return jsonify({"success": False, "message": "遊戲已開始"}), 403
-        if any(p['name'] == player_name for p in room['players']): return jsonify({"success": False, "message": "此名稱已被使用"}), 409
+    if not valid_player_name(player_name): return jsonify({"success": False, "message": "玩家名稱無效"}), 400
+    if room_store.usage()[1] >= MAX_PLAYERS: return reject_busy("players", "伺服器玩家已滿，請稍後再試")
+    if not room_code:
+        # 加入前會在房間鎖內重新檢查
+        room_code = room_store.pick_joinable()
+        if not room_code: return jsonify({"success": False, "message": "沒有可加入的公開房間"}), 404
+
+    with locked_room(room_code) as room:
+        if not room: return room_not_found(room_code)
+        if len(room.players) >= room.settings.max_players: return jsonify({"success": False, "message": "房間已滿"}), 403
+        if room.game: return jsonify({"success": False, "message": "遊戲已開始"}), 403
+        if find_player_by_name(room_code, player_name): return jsonify({"success": False, "message": "此名稱已被使用"}), 409
 
         token = str(uuid.uuid4())
-        player = {
-            "name": player_name, "isHost": False, "isReady": False,
-            "token": token, "last_seen": time.time(), "status": "connected"
-        }
-        room['players'].append(player)
-        room['lobbyPlayerOrder'] = [p['name'] for p in room['players']]
+        player = Player(player_name, token, last_seen=time.time())
+        room.players.append(player)
+        room.lobby_order = [p.name for p in room.players]
+        index_player(room_code, player)
+        mark_room_changed(room_code)
     return jsonify({"success": True, "roomCode": room_code, "token": token})
 
 @app.route('/reconnect', methods=['POST'])
 def reconnect():
     data = request.json
     room_code, token = data.get('roomCode'), data.get('token')
-    with rooms_lock:
-        if room_code not in rooms: return jsonify({"success": False, "message": "房間不存在"}), 404
-        room = rooms[room_code]
+    snap, player_name = read_snapshot(room_code, token)
+    if snap: return room_state_logic(snap, room_code, player_name)
+    with locked_room(room_code, write=False) as room:
+        if not room: return room_not_found(room_code)
         player = find_player_by_token(room, token)
         if not player: return jsonify({"success": False, "message": "玩家身份驗證失敗"}), 403
 
-        player['status'] = 'connected'
-        player['last_seen'] = time.time()
-        return room_state_logic(room_code, player['name'])
+        touch_player(room_code, player)
+        return room_state_logic(current_snapshot(room_code, room), room_code, player.name)
 
 @app.route('/room_state', methods=['POST'])
 def room_state():
     data = request.json
     room_code, token = data.get('roomCode'), data.get('token')
-    with rooms_lock:
-        if room_code not in rooms: return jsonify({"success": False, "message": "房間不存在"}), 404
-        room = rooms[room_code]
+    snap, player_name = read_snapshot(room_code, token)
+    if snap: return room_state_logic(snap, room_code, player_name, data.get('version'), data.get('delta'))
+    with locked_room(room_code, write=False) as room:
+        if not room: return room_not_found(room_code)
         player = find_player_by_token(room, token)
         if not player: return jsonify({"success": False, "message": "玩家身份驗證失敗"}), 403
 
-        player['last_seen'] = time.time()
-        player['status'] = 'connected'
-        return room_state_logic(room_code, player['name'])
+        touch_player(room_code, player)
+        return room_state_logic(current_snapshot(room_code, room), room_code, player.name, data.get('version'), data.get('delta'))
+
+@app.route('/room_updates', methods=['POST'])
+def room_updates():
+    # 長輪詢：客戶端帶上已知的版本號，房間有變動 (或逾時) 才回傳最新狀態
+    # 單執行緒的 WSGI worker (如 gunicorn sync) 無法同時掛住連線，客戶端會退回定時輪詢
+    if not request.environ.get('wsgi.multithread'):
+        return jsonify({"success": False, "message": "伺服器不支援長輪詢"}), 501
+    response = room_updates_step(final=False)
+    if response is None:
+        # 在鎖 (與交易) 之外等待，醒來後第二輪一定回傳
+        data = request.json
+        wait_for_room_change(data.get('roomCode'), data.get('version'), LONG_POLL_TIMEOUT)
+        response = room_updates_step(final=True)
+    return response
+
+def room_updates_step(final):
+    # 長輪詢的一輪 (需在請求情境中呼叫)；非最後一輪且版本未變時回傳 None，由呼叫者負責等待
+    # ASGI 模式 (asgi.py) 也用這個函式，只是改在事件迴圈中等待
+    data = request.json
+    room_code, token, since = data.get('roomCode'), data.get('token'), data.get('version')
+    snap, player_name = read_snapshot(room_code, token)
+    if snap: return room_state_logic(snap, room_code, player_name, since, data.get('delta')) if final or snap.version != since else None
+    with locked_room(room_code, write=False) as room:
+        if not room: return room_not_found(room_code)
+        player = find_player_by_token(room, token)
+        if not player: return jsonify({"success": False, "message": "玩家身份驗證失敗"}), 403
+        touch_player(room_code, player)
+        if final or room.version != since:
+            return room_state_logic(current_snapshot(room_code, room), room_code, player.name, since, data.get('delta'))
+    return None
 
-def room_state_logic(room_code, player_name):
+if orjson:
+    def encode_json(value):
+        return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)
+
+    def encode_fragment(value):
+        # 會留在快照裡的片段：部分 orjson 版本 (例如 3.8) 的輸出保留約 1 KB 的緩衝區，複製成剛好的大小
+        return bytes(memoryview(orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)))
+else:
+    def encode_json(value):
+        return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode()
+
+    encode_fragment = encode_json
+
+# 回應以「欄位 -> 已編碼的 JSON bytes」組成，gameState 再往下拆一層，也是差異比對的單位
+# 最常見的幾個值 (true、null、空陣列...) 所有快照共用同一個 bytes 物件
+COMMON_FRAGMENTS = {f: f for f in (b'true', b'false', b'null', b'[]', b'{}', b'""', b'0')}
+
+def encode_fragments(payload):
+    return {k: (encode_game_fragments(v) if k == 'gameState' and isinstance(v, dict) else encode_fragment(v))
+            for k, v in payload.items()}
+
+def encode_game_fragments(game_view):
+    frags = {}
+    for k, v in game_view.items():
+        f = encode_fragment(v)
+        frags[k] = COMMON_FRAGMENTS.get(f, f)
+    return frags
+
+@lru_cache(maxsize=1024)
+def encode_key(key):
+    # 欄位名稱是有限的固定集合，編碼結果 (含冒號) 快取起來
+    return encode_fragment(key) + b':'
+
+def join_fragments(frags):
+    return b'{' + b','.join(encode_key(k) + (join_fragments(v) if isinstance(v, dict) else v) for k, v in frags.items()) + b'}'
+
+def diff_fragments(old, new):
+    # 差異格式: {"set": {欄位: 新值}, "unset": [已移除欄位], "patch": {欄位: 子差異}}；完全相同時回傳 None
+    changed, patch = {}, {}
+    for k, v in new.items():
+        if isinstance(v, dict) and isinstance(old.get(k), dict):
+            sub = diff_fragments(old[k], v)
+            if sub: patch[k] = sub
+        elif old.get(k) != v:
+            changed[k] = v
+    unset = [k for k in old if k not in new]
+    if not changed and not patch and not unset: return None
+    return {"set": changed, "unset": unset, "patch": patch}
+
+def encode_delta(delta):
+    if not delta: return b'{"set":{},"unset":[],"patch":{}}'
+    patch = b','.join(encode_key(k) + encode_delta(v) for k, v in delta['patch'].items())
+    return b'{"set":' + join_fragments(delta["set"]) + b',"unset":' + encode_json(delta["unset"]) + b',"patch":{' + patch + b'}}'
+
+# --- 房間快照 (讀取路徑) ---
+# 每次變動後，寫入者在房間鎖內把全房間共用的欄位與每位玩家自己的欄位都編碼好，整個換上新的快照；
+# 輪詢只讀取最新的快照，不取任何鎖，也不會看到改到一半的狀態
+@dataclass(frozen=True, slots=True)
+class RoomSnapshot:
+    version: int
+    shared: dict   # 欄位 -> JSON bytes，gameState 再往下拆一層
+    viewers: dict  # 玩家名稱 -> 只屬於該玩家的欄位
+    recent: dict   # 之前的版本號 -> (shared, viewers)，作為差異回應的基準
+
+NO_FRAGMENTS = {}  # 沒有自己欄位的觀看者 (例如大廳中的非房主) 共用同一個空 dict，不可修改
+
+def publish_snapshot(room_code, room, players_only=False):
+    # 呼叫者持有房間鎖；players_only 且上一版快照正好是前一個版本時，只重新編碼玩家列表
+    prev = room_snapshots.get(room_code)
+    encode_start = time.perf_counter()
+    if players_only and prev and prev.version == room.version - 1:
+        shared = {**prev.shared, "version": encode_fragment(room.version), "players": encode_fragment(player_list_view(room))}
+        viewers = prev.viewers
+    else:
+        old_viewers = prev.viewers if prev else {}
+        shared = reuse_fragments(encode_fragments(build_room_view(room_code)), prev and prev.shared)
+        viewers = {p.name: reuse_fragments(encode_fragments(build_viewer_view(room_code, p.name)), old_viewers.get(p.name)) or NO_FRAGMENTS
+                   for p in room.players}
+    recent = {}
+    if prev and prev.version < room.version:
+        recent = {v: frags for v, frags in prev.recent.items() if v >= room.version - DELTA_HISTORY}
+        recent[prev.version] = (prev.shared, prev.viewers)
+    snap = room_snapshots[room_code] = RoomSnapshot(room.version, shared, viewers, recent)
+    if room.settings.allow_spectators: publish_spectator_feed(room_code, room, snap)
+    else: spectator_feeds.pop(room_code, None)
+    trace_add(TRACE_SERIALIZE, time.perf_counter() - encode_start)
+    return snap
+
+def reuse_fragments(new, old):
+    # 與上一版相同的片段沿用舊的物件，整個 dict 都相同時沿用舊的 dict；保留的近期版本因此大多互相共用
+    if not isinstance(old, dict): return new
+    unchanged = len(new) == len(old)
+    for k, v in new.items():
+        o = old.get(k)
+        if isinstance(v, dict): v = new[k] = reuse_fragments(v, o)
+        elif v == o: v = new[k] = o
+        unchanged = unchanged and v is o
+    return old if unchanged else new
+
+def current_snapshot(room_code, room):
+    # 呼叫者持有房間鎖；快照不存在或落後 (例如剛建立、從其他行程或事件日誌載入) 時先發布
+    snap = room_snapshots.get(room_code)
+    if snap is None or snap.version != room.version: snap = publish_snapshot(room_code, room)
+    state_reads.inc("locked")
+    return snap
+
+def read_snapshot(room_code, token):
+    # 不取鎖的讀取與心跳：回傳 (快照, 玩家名稱)。心跳只寫入 last_seen (單一屬性)，不算房間變動
+    # 需要改變房間狀態 (斷線後回來)、找不到玩家或快照不是最新時回傳 (None, None)，由呼叫者改走上鎖的路徑
+    # 共用儲存時本行程的 rooms 只是快取，一律走上鎖的路徑
+    if room_store.shared: return None, None
+    entry = player_tokens.get(token)
+    if not entry or entry[0] != room_code: return None, None
+    player = entry[1]
+    snap, room = room_snapshots.get(room_code), rooms.get(room_code)
+    if not snap or not room or snap.version != room.version or not player.connected or player.name not in snap.viewers: return None, None
+    player.last_seen = time.time()
+    state_reads.inc("snapshot")
+    return snap, player.name
+
+# --- 觀戰 ---
+# 觀戰者看到的就是全房間共用的欄位 (不含任何人的身份、私人事件或房間密碼)，每個版本只組成一次 bytes，
+# 所有觀戰者拿到同一份；有延遲時保留延遲時間內的各版本，讀取時挑「延遲時間之前」最新的一版
+def publish_spectator_feed(room_code, room, snap):
+    # 呼叫者持有房間鎖
+    now = time.time()
+    cutoff = now - room.settings.spectator_delay
+    feed = spectator_feeds.get(room_code, ())
+    visible = [i for i, entry in enumerate(feed) if entry[0] <= cutoff]
+    feed = feed[visible[-1]:] if visible else feed  # 延遲時間之前的只需要留最新的一版
+    if feed and feed[-1][1] == snap.version:
+        spectator_feeds[room_code] = feed  # 同一個版本重新發布時保留原本的時間，延遲不重新計算
+        return
+    spectator_feeds[room_code] = feed + ((now, snap.version, join_fragments(snap.shared)),)
+
+def visible_spectator_entry(room_code):
+    # 不取鎖讀取目前觀戰者應該看到的版本；回傳 (entry, 還要等幾秒)，entry 為 None 表示房間不存在或未開放觀戰
+    # 本行程的觀戰紀錄落後房間 (例如共用儲存時其他行程的變動、剛從事件日誌恢復) 時在房間鎖內補上
+    room = rooms.get(room_code)
+    if not room_store.shared and room and not room.settings.allow_spectators: return None, 0
+    feed = spectator_feeds.get(room_code)
+    if room_store.shared or not feed or not room or feed[-1][1] != room.version:
+        with locked_room(room_code, write=False) as room:
+            if not room or not room.settings.allow_spectators: return None, 0
+            snap = current_snapshot(room_code, room)
+            feed = spectator_feeds.get(room_code)
+            if not feed or feed[-1][1] != snap.version: publish_spectator_feed(room_code, room, snap)
+            feed, delay = spectator_feeds[room_code], room.settings.spectator_delay
+    else:
+        delay = room.settings.spectator_delay
+    cutoff = time.time() - delay
+    for entry in reversed(feed):
+        if entry[0] <= cutoff: return entry, 0
+    return None, feed[0][0] - cutoff
+
+@app.route('/spectate/<room_code>')
+def spectate(room_code):
+    # 觀戰不需要 token；以 GET + ETag 回應，瀏覽器與 CDN 都能快取同一份內容
+    if room_code.upper() in moved_rooms: return room_moved(room_code.upper())
+    entry, wait = visible_spectator_entry(room_code.upper())
+    if entry is None and not wait: return jsonify({"success": False, "message": "房間不存在或未開放觀戰"}), 404
+    if entry is None:
+        response = jsonify({"success": False, "message": "直播延遲中，請稍候"})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(int(wait) + 1)
+        return response
+    etag = f"spectate-{room_code.upper()}-{entry[1]}"
+    if request.if_none_match.contains(etag) or request.args.get('version') == str(entry[1]):
+        spectator_reads.inc(304)
+        response = app.response_class(status=304)
+    else:
+        spectator_reads.inc(200)
+        response = app.response_class(entry[2], mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = f"public, max-age={SPECTATE_MAX_AGE}"
+    return response
+
+def merge_fragments(shared, own):
+    frags = {**shared, **own}
+    if isinstance(shared.get('gameState'), dict):
+        frags['gameState'] = {**shared['gameState'], **own.get('gameState', {})}
+    return frags
+
+def wants_packed():
+    # 內容協商：Accept 明確偏好 application/x-msgpack 時才用精簡格式，其餘 (含 */* 與未指定) 一律 JSON
+    return request.accept_mimetypes.best_match(('application/json', wire.MIMETYPE), 'application/json') == wire.MIMETYPE
+
+def negotiated(value):
+    return app.response_class(wire.pack(value), mimetype=wire.MIMETYPE) if wants_packed() else jsonify(value)
+
+def room_state_logic(snap, room_code, player_name, since=None, want_delta=False):
+    # since: 客戶端已有的版本號。版本未變回 304；want_delta 且 since 還在快照的近期版本內時只回傳不同的欄位
+    # 只讀取快照，不需要持有房間鎖；兩種格式的內容與結構相同，只有編碼不同
+    packed = wants_packed()
+    etag = f"{room_code}-{snap.version}" + ("-p" if packed else "")
+    if since == snap.version or request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        response.vary.add('Accept')
+        return response
+
+    encode_start = time.perf_counter()
+    frags = merge_fragments(snap.shared, snap.viewers.get(player_name, {}))
+    base = snap.recent.get(since) if want_delta else None
+    if base and player_name in base[1]:
+        delta = diff_fragments(merge_fragments(base[0], base[1][player_name]), frags)
+        if packed: body = wire.pack_delta(snap.version, since, delta)
+        else: body = b'{"version":%d,"base_version":%d,"delta":%s}' % (snap.version, since, encode_delta(delta))
+    else:
+        body = wire.pack_fragments(frags) if packed else join_fragments(frags)
+    trace_add(TRACE_SERIALIZE, time.perf_counter() - encode_start)
+    state_bytes.inc("msgpack" if packed else "json", amount=len(body))
+    response = app.response_class(body, mimetype=wire.MIMETYPE if packed else 'application/json')
+    response.set_etag(etag)
+    response.vary.add('Accept')
+    return response
+
+def room_state_fragments(room_code, player_name):
+    # 這位觀看者在目前版本看到的各欄位 (呼叫者持有房間鎖)
+    snap = current_snapshot(room_code, rooms[room_code])
+    return merge_fragments(snap.shared, snap.viewers.get(player_name, {}))
+
+def build_room_view(room_code):
+    # 依房間投影出客戶端實際用到、且對同房間每個人都相同的欄位；token、last_seen、created_at、密碼等一律不送出
+    # 角色總表 (ALL_ROLES) 是固定資料，隨網頁一起送出，不放在每次輪詢裡
+    # 內部的列舉與資料類別在這裡轉成客戶端使用的字串與欄位名稱
     room = rooms[room_code]
-    response_data = room.copy()
-
-    if room.get('gameState'):
-        gs = room['gameState']
-        my_role_data = gs['assigned_roles'].get(player_name, {})
-        evil_roles = [r for r in gs['roles_in_game'] if r in ALL_ROLES['evil']]
-        my_info = {
-            "role": my_role_data.get("role"), "is_evil": my_role_data.get("role") in evil_roles,
-            "role_info": "", "known_evil": []
-        }
-        if my_info["role"] == "梅林": my_info["role_info"] = f"你知道的壞人是: {', '.join([p for p, d in gs['assigned_roles'].items() if d['role'] in evil_roles and d['role'] != '莫德雷德'])}"
-        elif my_info["role"] == "派西維爾": my_info["role_info"] = f"梅林和莫甘娜是: {', '.join([p for p, d in gs['assigned_roles'].items() if d['role'] in ['梅林', '莫甘娜']])}"
-        elif my_info["is_evil"] and my_info["role"] != "奧伯倫":
-            known_evil = [p for p, d in gs['assigned_roles'].items() if d['role'] in evil_roles and d['role'] != '奧伯倫']
-            my_info["known_evil"] = known_evil
-            my_info["role_info"] = f"你的邪惡夥伴是: {', '.join(p for p in known_evil if p != player_name)}"
-        my_info["last_lady_reveal"] = my_role_data.pop("last_lady_reveal", None)
-
-        response_data['gameState'] = {
-            "phase": gs["phase"], "phase_text": gs["phase_text"], "player_order": gs["player_order"],
-            "current_leader": gs["player_order"][gs["current_leader_index"]],
-            "mission_number": gs["mission_number"], "quest_track": gs["quest_track"],
-            "my_info": my_info,
-            "is_leader": gs["player_order"][gs["current_leader_index"]] == player_name,
-            "team_proposal": gs["team_proposal"],
-            "votes": gs["votes"], "mission_votes": gs["mission_votes"],
-            "my_vote": gs["votes"].get(player_name),
-            "my_mission_vote": gs["mission_votes"].get(player_name),
-            "is_on_mission": player_name in gs["team_proposal"],
-            "vote_reject_count": gs["vote_reject_count"],
-            "mission_team_sizes": gs["mission_team_sizes"],
-            "mission_team_size": gs["mission_team_sizes"][gs['mission_number'] - 1],
-            "lady_holder": gs.get("lady_holder"),
-            "is_lady_holder": gs.get("lady_holder") == player_name,
-            "lady_used_on": gs.get("lady_used_on", []),
-            "game_start_time": gs["game_start_time"],
-            "last_vote_details": gs.get("last_vote_details"),
-            "mission_history": gs.get("mission_history", []),
-            "all_possible_roles": {
-                "good": [r for r in gs['roles_in_game'] if r in ALL_ROLES['good']],
-                "evil": [r for r in gs['roles_in_game'] if r in ALL_ROLES['evil']]
-            }
+    view = {"version": room.version, "players": player_list_view(room)}
+    if room.game:
+        gs = room.game
+        # 投票結果公布前只透露誰已經投了，不透露投了什麼
+        view['gameState'] = {
+            "phase": PHASE_NAMES[gs.phase], "phase_text": PHASE_TEXTS[gs.phase], "player_order": gs.player_order,
+            "current_leader": gs.player_order[gs.current_leader_index],
+            "mission_number": gs.mission_number, "quest_track": [QUEST_NAMES[q] for q in gs.quest_track],
+            "team_proposal": gs.team_proposal,
+            "voted": list(gs.votes), "mission_voted": list(gs.mission_votes),
+            "mission_team_sizes": gs.mission_team_sizes,
+            "mission_team_size": gs.mission_team_sizes[gs.mission_number - 1],
+            "lady_used_on": gs.lady_used_on,
+            "game_start_time": gs.game_start_time,
+            "last_vote_details": game_engine.vote_details_view(gs),
+            "mission_history": game_engine.mission_history_view(gs),
+            "all_possible_roles": game_engine.factions_view(gs)
         }
-        if gs["phase"] == "end": response_data["gameState"]["game_over_data"] = gs["game_over_data"]
+        if gs.phase == Phase.END: view["gameState"]["game_over_data"] = game_engine.game_over_view(gs)
     else:
-        good_roles = [r for r in room['settings']['customRoles'] if r in ALL_ROLES['good']]
-        evil_roles = [r for r in room['settings']['customRoles'] if r in ALL_ROLES['evil']]
-        
-        response_data['all_roles_pool'] = ALL_ROLES
-
-        response_data['gameInfo'] = {
-            "good_count": len(good_roles), "evil_count": len(evil_roles),
-            "roles": good_roles + evil_roles, "mission_map": room['settings']['missionTrack']
+        settings = room.settings
+        view['gameState'] = None
+        view['lobbyPlayerOrder'] = room.lobby_order
+        view['settings'] = {
+            "maxPlayers": settings.max_players, "hasPassword": bool(settings.password),
+            "useLady": settings.use_lady, "randomizeOrder": settings.randomize_order,
+            "customRoles": game_engine.role_names(settings.custom_roles), "missionTrack": settings.mission_track,
+            "allowSpectators": settings.allow_spectators, "spectatorDelay": settings.spectator_delay,
         }
-    return jsonify(response_data)
+    return view
+
+def player_list_view(room):
+    return [{"name": p.name, "isHost": p.is_host, "isReady": p.is_ready, "status": "connected" if p.connected else "disconnected"}
+            for p in room.players]
+
+def build_viewer_view(room_code, player_name):
+    # 只屬於這位觀看者的欄位：自己的角色情報與投票、是否輪到自己；房主另外看得到房間密碼
+    room = rooms[room_code]
+    gs = room.game
+    if not gs:
+        viewer = find_player_by_name(room_code, player_name)
+        return {"roomPassword": room.settings.password} if viewer and viewer.is_host else {}
+    my_info = game_engine.player_info_view(gs, player_name)
+    # 私人事件 (例如湖中女神的查驗結果) 只給收件人，讀取時不再修改狀態
+    my_info["events"] = [game_engine.event_view(e) for e in gs.events if e.to == player_name]
+    my_vote, my_mission_vote = gs.votes.get(player_name), gs.mission_votes.get(player_name)
+    return {"gameState": {
+        "my_info": my_info,
+        "is_leader": gs.player_order[gs.current_leader_index] == player_name,
+        "my_vote": None if my_vote is None else game_engine.VOTE_NAMES[my_vote],
+        "my_mission_vote": None if my_mission_vote is None else game_engine.VOTE_NAMES[my_mission_vote],
+        "is_on_mission": player_name in gs.team_proposal,
+        "is_lady_holder": gs.lady_holder == player_name,
+    }}
 
 @app.route('/toggle_ready', methods=['POST'])
 def toggle_ready():
     data = request.json
-    with rooms_lock:
-        room = rooms.get(data['roomCode'])
+    with locked_room(data['roomCode']) as room:
         player = find_player_by_token(room, data['token'])
         if not room or not player: return jsonify({}), 404
-        if not player['isHost']: player['isReady'] = not player['isReady']
+        if not player.is_host:
+            player.is_ready = not player.is_ready
+            mark_room_changed(data['roomCode'])
     return jsonify({"success": True})
 
 @app.route('/update_settings', methods=['POST'])
 def update_settings():
     data = request.json
-    with rooms_lock:
-        room = rooms.get(data['roomCode'])
+    with locked_room(data['roomCode']) as room:
         player = find_player_by_token(room, data['token'])
-        if not room or not player or not player['isHost']: return jsonify({"success": False, "message": "非房主無權操作"}), 403
-        if room['gameState']: return jsonify({"success": False, "message": "遊戲進行中無法修改設定"}), 403
+        if not room or not player or not player.is_host: return jsonify({"success": False, "message": "非房主無權操作"}), 403
+        if room.game: return jsonify({"success": False, "message": "遊戲進行中無法修改設定"}), 403
 
         settings = data['settings']
-        new_max_players = int(settings.get('maxPlayers', room['settings']['maxPlayers']))
-
-        max_players_changed = room['settings']['maxPlayers'] != new_max_players
+        new_max_players = settings.get('maxPlayers', room.settings.max_players)
+        if isinstance(new_max_players, str) and new_max_players.isdigit(): new_max_players = int(new_max_players)
+        if new_max_players not in ROLE_CONFIG: return jsonify({"success": False, "message": "不支援的人數"}), 400
+        delay = settings.get('spectatorDelay', 0)
+        if not isinstance(delay, int) or isinstance(delay, bool) or not 0 <= delay <= MAX_SPECTATOR_DELAY:
+            return jsonify({"success": False, "message": "無效的觀戰延遲"}), 400
+
+        max_players_changed = room.settings.max_players != new_max_players
         
         if max_players_changed:
-            room['settings']['maxPlayers'] = new_max_players
+            room.settings.max_players = new_max_players
             if new_max_players in ROLE_CONFIG:
                 good, evil = ROLE_CONFIG[new_max_players]
-                room['settings']['customRoles'] = good + evil
-                room['settings']['missionTrack'] = MISSION_SIZES[new_max_players]
+                room.settings.custom_roles = good + evil
+                room.settings.mission_track = list(MISSION_SIZES[new_max_players])
         
         if 'customRoles' in settings and not max_players_changed:
-            room['settings']['customRoles'] = settings['customRoles']
-
-        if 'password' in settings: room['settings']['password'] = settings['password']
-        if 'useLady' in settings: room['settings']['useLady'] = settings['useLady']
-        if 'randomizeOrder' in settings: room['settings']['randomizeOrder'] = settings['randomizeOrder']
-            
+            custom_roles = game_engine.parse_roles(settings['customRoles'])
+            if custom_roles is None: return jsonify({"success": False, "message": "未知的角色"}), 400
+            room.settings.custom_roles = custom_roles
+
+        if 'password' in settings: room.settings.password = settings['password']
+        if 'useLady' in settings: room.settings.use_lady = settings['useLady']
+        if 'randomizeOrder' in settings: room.settings.randomize_order = settings['randomizeOrder']
+        if 'allowSpectators' in settings: room.settings.allow_spectators = bool(settings['allowSpectators'])
+        if 'spectatorDelay' in settings: room.settings.spectator_delay = settings['spectatorDelay']
+        mark_room_changed(data['roomCode'])
     return jsonify({"success": True})
 
 @app.route('/update_mission_track', methods=['POST'])
 def update_mission_track():
     data = request.json
-    with rooms_lock:
-        room = rooms.get(data['roomCode'])
+    with locked_room(data['roomCode']) as room:
         player = find_player_by_token(room, data['token'])
-        if not room or not player or not player['isHost']: return jsonify({"success": False, "message": "非房主無權操作"}), 403
-        if room['gameState']: return jsonify({"success": False, "message": "遊戲進行中無法修改設定"}), 403
+        if not room or not player or not player.is_host: return jsonify({"success": False, "message": "非房主無權操作"}), 403
+        if room.game: return jsonify({"success": False, "message": "遊戲進行中無法修改設定"}), 403
         new_track = data.get('missionTrack', [])
-        if len(new_track) == 5 and all(isinstance(x, int) and 1 <= x <= room['settings']['maxPlayers'] for x in new_track):
-            room['settings']['missionTrack'] = new_track
+        if len(new_track) == 5 and all(isinstance(x, int) and 1 <= x <= room.settings.max_players for x in new_track):
+            room.settings.mission_track = new_track
+            mark_room_changed(data['roomCode'])
         else:
             return jsonify({"success": False, "message": "無效的任務軌跡設定"}), 400
     return jsonify({"success": True})
@@ -265,358 +917,671 @@ def update_mission_track():
 @app.route('/leave_room', methods=['POST'])
 def leave_room():
     data = request.json
-    with rooms_lock:
-        room_code = data.get('roomCode')
-        if room_code not in rooms: return jsonify({"success": True})
-        room = rooms[room_code]
+    room_code = data.get('roomCode')
+    with locked_room(room_code) as room:
+        if not room: return jsonify({"success": True})
         player_to_remove = find_player_by_token(room, data['token'])
         if not player_to_remove: return jsonify({"success": True})
 
-        was_host = player_to_remove['isHost']
-        room['players'] = [p for p in room['players'] if p['token'] != data['token']]
-        room['lobbyPlayerOrder'] = [p['name'] for p in room['players']]
-        if not room['players']:
-            if room_code in rooms: del rooms[room_code]
+        was_host = player_to_remove.is_host
+        room.players = [p for p in room.players if p is not player_to_remove]
+        unindex_player(room_code, player_to_remove)
+        room.lobby_order = [p.name for p in room.players]
+        if not room.players:
+            delete_room(room_code)
+            return jsonify({"success": True})
         elif was_host:
-            room['players'][0]['isHost'] = True
-            room['players'][0]['isReady'] = True
+            room.players[0].is_host = True
+            room.players[0].is_ready = True
+        mark_room_changed(room_code)
     return jsonify({"success": True})
 
 @app.route('/kick_player', methods=['POST'])
 def kick_player():
     data = request.json
-    with rooms_lock:
-        room = rooms.get(data['roomCode'])
+    with locked_room(data['roomCode']) as room:
         player = find_player_by_token(room, data['token'])
-        if not room or not player or not player['isHost']: return jsonify({"success": False, "message": "非房主無權操作"}), 403
-        if room['gameState']: return jsonify({"success": False, "message": "遊戲進行中無法踢人"}), 403
+        if not room or not player or not player.is_host: return jsonify({"success": False, "message": "非房主無權操作"}), 403
+        if room.game: return jsonify({"success": False, "message": "遊戲進行中無法踢人"}), 403
 
         target_name = data.get('targetName')
-        room['players'] = [p for p in room['players'] if p['name'] != target_name]
-        room['lobbyPlayerOrder'] = [p for p in room['lobbyPlayerOrder'] if p != target_name]
+        target = find_player_by_name(data['roomCode'], target_name)
+        if target: unindex_player(data['roomCode'], target)
+        room.players = [p for p in room.players if p.name != target_name]
+        room.lobby_order = [p for p in room.lobby_order if p != target_name]
+        mark_room_changed(data['roomCode'])
     return jsonify({"success": True})
 
 @app.route('/transfer_host', methods=['POST'])
 def transfer_host():
     data = request.json
-    with rooms_lock:
-        room = rooms.get(data['roomCode'])
+    with locked_room(data['roomCode']) as room:
         player = find_player_by_token(room, data['token'])
-        if not room or not player or not player['isHost']: return jsonify({"success": False, "message": "非房主無權操作"}), 403
-        if room['gameState']: return jsonify({"success": False, "message": "遊戲進行中無法轉移房主"}), 403
+        if not room or not player or not player.is_host: return jsonify({"success": False, "message": "非房主無權操作"}), 403
+        if room.game: return jsonify({"success": False, "message": "遊戲進行中無法轉移房主"}), 403
 
         target_name = data.get('targetName')
-        for p in room['players']:
-            p['isHost'] = (p['name'] == target_name)
-            p['isReady'] = p['isHost']
+        for p in room.players:
+            p.is_host = (p.name == target_name)
+            p.is_ready = p.is_host
+        mark_room_changed(data['roomCode'])
     return jsonify({"success": True})
 
 @app.route('/update_player_order', methods=['POST'])
 def update_player_order():
     data = request.json
-    with rooms_lock:
-        room = rooms.get(data['roomCode'])
+    with locked_room(data['roomCode']) as room:
         player = find_player_by_token(room, data['token'])
-        if not room or not player or not player['isHost']: return jsonify({"success": False, "message": "非房主無權操作"}), 403
-        if room['gameState']: return jsonify({"success": False, "message": "遊戲進行中無法改變順序"}), 403
-        room['lobbyPlayerOrder'] = data['newOrder']
+        if not room or not player or not player.is_host: return jsonify({"success": False, "message": "非房主無權操作"}), 403
+        if room.game: return jsonify({"success": False, "message": "遊戲進行中無法改變順序"}), 403
+        room.lobby_order = data['newOrder']
+        mark_room_changed(data['roomCode'])
     return jsonify({"success": True})
 
 @app.route('/start_game', methods=['POST'])
 def start_game():
     data = request.json
-    with rooms_lock:
-        room_code = data.get('roomCode')
-        room = rooms.get(room_code)
+    room_code = data.get('roomCode')
+    with locked_room(room_code) as room:
         player = find_player_by_token(room, data['token'])
-        if not room or not player or not player['isHost']: return jsonify({"success": False, "message": "非房主無權操作"}), 403
+        if not room or not player or not player.is_host: return jsonify({"success": False, "message": "非房主無權操作"}), 403
 
-        player_count = len(room['players'])
+        player_count = len(room.players)
+        settings = room.settings
+        if draining: return reject_busy("draining", "伺服器即將更新，房間會移到新的伺服器，請稍候再開始")
         if player_count < 5: return jsonify({"success": False, "message": "玩家人數不足 5 人"}), 400
-        if player_count != room['settings']['maxPlayers']: return jsonify({"success": False, "message": "玩家人數未達房間設定上限"}), 400
-        if not all(p['isReady'] for p in room['players']): return jsonify({"success": False, "message": "尚有玩家未準備"}), 400
-        if len(room['settings']['customRoles']) != player_count: return jsonify({"success": False, "message": "所選角色數量與玩家人數不符"}), 400
-
-        player_order = room['lobbyPlayerOrder'][:]
-        if room['settings']['randomizeOrder']: random.shuffle(player_order)
-        roles = room['settings']['customRoles'][:]
-        random.shuffle(roles)
-        assigned = {name: {"role": role} for name, role in zip(player_order, roles)}
-
-        lady_holder = None
-        lady_used_on = []
-        if room['settings']['useLady'] and player_count >= 7:
-            good_players = [p for p, d in assigned.items() if d['role'] in ALL_ROLES['good']]
-            if good_players:
-                lady_holder = random.choice(good_players)
-                lady_used_on.append(lady_holder)
-
-        room['gameState'] = {
-            "player_order": player_order, "assigned_roles": assigned, "roles_in_game": roles,
-            "current_leader_index": 0, "mission_number": 1,
-            "quest_track": ["pending"] * 5, "mission_history": [],
-            "phase": "team_building", "phase_text": "組建隊伍",
-            "team_proposal": [], "votes": {}, "mission_votes": {}, "vote_reject_count": 0,
-            "game_start_time": time.time() * 1000,
-            "lady_holder": lady_holder, "lady_used_missions": [], "lady_used_on": lady_used_on,
-            "last_vote_details": None,
-            "mission_team_sizes": room['settings']['missionTrack']
-        }
+        if player_count != settings.max_players: return jsonify({"success": False, "message": "玩家人數未達房間設定上限"}), 400
+        if not all(p.is_ready for p in room.players): return jsonify({"success": False, "message": "尚有玩家未準備"}), 400
+        if len(settings.custom_roles) != player_count: return jsonify({"success": False, "message": "所選角色數量與玩家人數不符"}), 400
+
+        room.game = game_engine.new_game(room.lobby_order, settings.custom_roles, settings.mission_track,
+                                         settings.use_lady, settings.randomize_order)
+        mark_room_changed(room_code, ('room',))
     return jsonify({"success": True})
 
 @app.route('/return_to_lobby', methods=['POST'])
 def return_to_lobby():
     data = request.json
-    with rooms_lock:
-        room = rooms.get(data['roomCode'])
+    with locked_room(data['roomCode']) as room:
         player = find_player_by_token(room, data['token'])
-        if not room or not player or not player['isHost']: return jsonify({"success": False, "message": "非房主無權操作"}), 403
+        if not room or not player or not player.is_host: return jsonify({"success": False, "message": "非房主無權操作"}), 403
 
-        room['gameState'] = None
-        room['lobbyPlayerOrder'] = [p['name'] for p in room['players']]
-        for p in room['players']: p['isReady'] = p['isHost']
+        room.game = None
+        room.lobby_order = [p.name for p in room.players]
+        for p in room.players: p.is_ready = p.is_host
+        mark_room_changed(data['roomCode'], ('room',))
     return jsonify({"success": True})
 
 @app.route('/action', methods=['POST'])
 def handle_action():
     data = request.json
-    with rooms_lock:
-        room_code = data.get('roomCode')
-        if room_code not in rooms or not rooms[room_code]['gameState']: return jsonify({"success": False}), 404
-        room = rooms[room_code]
+    room_code = data.get('roomCode')
+    with locked_room(room_code) as room:
+        if not room or not room.game: return jsonify({"success": False}), 404
         player = find_player_by_token(room, data['token'])
         if not player: return jsonify({"success": False, "message": "玩家身份驗證失敗"}), 403
 
-        process_game_action(room_code, player['name'], data['action'], data.get('value'))
-    return jsonify({"success": True})
+        if process_game_action(room_code, player.name, data['action'], data.get('value')):
+            mark_room_changed(room_code, ('action', player.name, data['action'], data.get('value')))
+            # 這個動作可能讓輪到斷線玩家 (隊長或剩下的投票者)，立刻代為行動，不必等排程器
+            run_auto_actions(room_code, room)
+    return negotiated({"success": True})
+
+@app.route('/actions', methods=['POST'])
+def handle_actions():
+    # 批次動作：同一位玩家的多個動作在一次上鎖中依序套用，全部被接受才生效 (任一個被拒絕就整批還原)，
+    # 整批只算一次房間變動。回應直接是套用後的觀看者狀態 (格式同 /room_state，version 為客戶端已有的版本，
+    # delta 時回傳差異)，客戶端不必再輪詢一次才看到結果
+    data = request.json
+    room_code, actions = data.get('roomCode'), data.get('actions')
+    if not isinstance(actions, list) or not 0 < len(actions) <= MAX_BATCH_ACTIONS: return jsonify({"success": False, "message": "無效的動作批次"}), 400
+    batch = [(a.get('action'), a.get('value') or {}) if isinstance(a, dict) else (None, None) for a in actions]
+    if not all(isinstance(action, str) and isinstance(value, dict) for action, value in batch):
+        return jsonify({"success": False, "message": "無效的動作批次"}), 400
+    with locked_room(room_code) as room:
+        if not room or not room.game: return jsonify({"success": False}), 404
+        player = find_player_by_token(room, data.get('token'))
+        if not player: return jsonify({"success": False, "message": "玩家身份驗證失敗"}), 403
 
-def process_game_action(room_code, player_name, action, value=None):
+        touch_player(room_code, player)
+        # 被拒絕的單一動作不會改動狀態，只有多個動作時才需要先備份
+        backup = copy.deepcopy(room.game) if len(batch) > 1 else None
+        for i, (action, value) in enumerate(batch):
+            if not process_game_action(room_code, player.name, action, value):
+                if backup: room.game = backup
+                return jsonify({"success": False, "message": "動作無效", "failedIndex": i}), 409
+        mark_room_changed(room_code, ('actions', player.name, batch))
+        run_auto_actions(room_code, room)
+        return room_state_logic(current_snapshot(room_code, room), room_code, player.name, data.get('version'), data.get('delta'))
+
+def process_game_action(room_code, player_name, action, value=None, now=None):
+    # 規則在 game_engine；這裡只負責從房間取出狀態與目前的玩家名單 (呼叫者持有房間鎖)
     room = rooms[room_code]
-    state = room['gameState']
-    pc = len(room['players'])
-
-    if action == 'propose_team' and state["phase"] == "team_building":
-        team = value.get('team', [])
-        if len(team) != state["mission_team_sizes"][state["mission_number"] - 1]: return
-        state["team_proposal"] = team; state["phase"] = "team_vote"; state["phase_text"] = "隊伍投票"; state["votes"] = {}
-
-    elif action == 'vote_team' and state["phase"] == "team_vote":
-        state["votes"][player_name] = value.get('vote')
-        if len(state["votes"]) >= pc:
-            process_team_vote_result(room_code)
-
-    elif action == 'mission_vote' and state["phase"] == "mission_vote":
-        state["mission_votes"][player_name] = value.get('vote')
-        if len(state["mission_votes"]) >= len(state["team_proposal"]):
-            process_mission_vote_result(room_code)
-
-    elif action == 'use_lady' and state["phase"] == "lady_of_the_lake":
-        if player_name != state["lady_holder"]: return
-        target = value.get('target')
-        if target == player_name or target in state["lady_used_on"]: return
-        evil_roles = [r for r in state['roles_in_game'] if r in ALL_ROLES['evil']]
-        loyalty = "善良" if state["assigned_roles"][target]["role"] not in evil_roles else "邪惡"
-        state["assigned_roles"][player_name]["last_lady_reveal"] = f"你查驗了 {target}，他的陣營是: {loyalty}"
-        state["lady_holder"] = target
-        state["lady_used_missions"].append(state["mission_number"])
-        state["lady_used_on"].append(target)
-        advance_to_next_mission(room_code)
-
-    elif action == 'assassinate' and state["phase"] == "assassination":
-        target = value.get('target')
-        merlin_list = [p for p, d in state["assigned_roles"].items() if d["role"] == "梅林"]
-        if merlin_list and target == merlin_list[0]:
-            end_game(room_code, 'evil', f"刺客 {player_name} 成功刺殺了梅林 ({target})！")
-        else:
-            end_game(room_code, 'good', f"刺客 {player_name} 刺殺失敗！")
+    return game_engine.apply_action(room.game, [p.name for p in room.players], player_name, action, value, now)
+
+# --- 期限排程器 ---
+# 每個房間只在堆積中排一個「最早可能發生事的時間」：玩家超時離線、大廳踢除、房間過期
+# 心跳只更新 last_seen 不碰堆積；期限到時才上鎖檢查，若玩家仍在線就依新的 last_seen 重新排定
+deadline_heap = []     # (期限, room_code)，可能含已失效的舊項目
+room_deadlines = {}    # room_code -> 目前有效的期限
+deadline_cond = threading.Condition()
+scheduler_active = False  # 只有執行排程器的行程需要維護堆積
+deadline_listeners = []   # 最早期限提前時呼叫，供 ASGI 模式喚醒非同步的排程任務
+
+def room_next_deadline(room):
+    if not room.players: return 0
+    in_lobby = room.game is None
+    deadlines = []
+    for p in room.players:
+        if p.connected: deadlines.append(p.last_seen + TIMEOUT_SECONDS)
+        if in_lobby: deadlines.append(p.last_seen + LOBBY_KICK_TIMEOUT)
+    expiry = room.created_at + ROOM_EXPIRY
+    # 過期時間已過時，最後一位在線玩家的離線期限就是刪除房間的時機
+    if expiry > time.time(): deadlines.append(expiry)
+    return min(deadlines) + DEADLINE_SLACK if deadlines else float('inf')
+
+def schedule_room(room_code, when):
+    if not scheduler_active or when == float('inf'): return
+    with deadline_cond:
+        if room_deadlines.get(room_code, float('inf')) <= when: return
+        room_deadlines[room_code] = when
+        heapq.heappush(deadline_heap, (when, room_code))
+        if deadline_heap[0][1] != room_code: return
+        deadline_cond.notify()
+    for listener in deadline_listeners: listener()
+
+def unschedule_room(room_code):
+    with deadline_cond: room_deadlines.pop(room_code, None)
+
+# --- 啟動、健康檢查 ---
+# 建議以 create_app() 啟動 (例如 gunicorn 'v8:create_app()'、python v8.py)：在開始接受請求前就啟動背景工作並預先產生網頁，
+# 不必等第一個請求；ASGI 模式 (asgi.py) 在 lifespan startup 做同樣的事。背景工作是本行程的執行緒，
+# 工廠必須在 worker 行程內呼叫 (gunicorn 預設即是如此，不要搭配 --preload)
+# 負載平衡器以 /healthz 判斷行程是否還活著，以 /readyz 判斷新的行程是否已可接流量
+@dataclass(frozen=True, slots=True)
+class IndexPage:
+    html: bytes
+    gzipped: bytes
+    etag: str
+
+index_page = None
+process_started_at = time.time()
+
+def compile_index_page():
+    # 網頁只依賴固定資料 (角色總表、傳輸字典)，產生一次後連同 gzip 壓縮的版本一起保留
+    global index_page
+    with app.app_context():
+        html = render_template('index.html', all_roles=ALL_ROLES, wire_strings=wire.STRINGS).encode()
+    index_page = IndexPage(html, gzip.compress(html, 9, mtime=0), hashlib.sha1(html).hexdigest()[:20])
+    return index_page
+
+def warm_up():
+    # 開始接流量前先做的事；可重複呼叫
+    if not index_page: compile_index_page()
+    start_background_tasks()
+
+def create_app():
+    warm_up()
+    return app
+
+def readiness_checks():
+    checks = {"backgroundTasks": background_started, "indexPage": index_page is not None, "notDraining": draining is None}
+    try:
+        room_store.usage()
+        checks["roomStore"] = True
+    except Exception:
+        checks["roomStore"] = False
+    return checks
+
+@app.route('/healthz')
+def healthz():
+    return jsonify({"status": "ok", "uptime": round(time.time() - process_started_at, 3)})
+
+@app.route('/readyz')
+def readyz():
+    # 以 create_app() 以外的方式啟動時，第一次探測會順便完成暖機
+    warm_up()
+    checks = readiness_checks()
+    ready = all(checks.values())
+    response = jsonify({"ready": ready, "checks": checks})
+    response.status_code = 200 if ready else 503
+    response.headers['Cache-Control'] = 'no-store'
+    return response
 
-    elif action == 'internal_check_vote_complete':
-        if state['phase'] == 'team_vote' and len(state["votes"]) >= pc:
-            process_team_vote_result(room_code)
-        elif state['phase'] == 'mission_vote' and len(state["mission_votes"]) >= len(state["team_proposal"]):
-            process_mission_vote_result(room_code)
+# --- 背景巡邏員 ---
+background_started = False
 
-def process_team_vote_result(room_code):
-    room = rooms[room_code]
-    state = room['gameState']
-    pc = len(room['players'])
-    approves = list(state["votes"].values()).count('approve')
-    state["last_vote_details"] = [{"name": p['name'], "vote": state["votes"].get(p['name'])} for p in room['players']]
-    if approves > pc / 2:
-        state["phase"] = "mission_vote"; state["phase_text"] = "執行任務"; state["mission_votes"] = {}; state["vote_reject_count"] = 0
-    else:
-        advance_to_next_leader(room_code)
+def start_background_tasks(reaper=True):
+    # 每個行程都啟動巡邏員執行緒，但共用儲存時只有搶到選舉鎖的行程會實際巡邏
+    # ASGI 模式傳入 reaper=False，改由事件迴圈執行排程任務
+    global background_started
+    with rooms_lock:
+        if background_started: return False
+        background_started = True
+    if reaper: threading.Thread(target=reaper_task, daemon=True).start()
+    if PROFILE_HZ > 0: profiler.start(PROFILE_HZ)
+    if game_history: game_history.start()
+    if game_log:
+        game_log.start()
+        threading.Thread(target=snapshot_task, daemon=True).start()
+    return True
+
+@app.before_request
+def ensure_background_tasks():
+    # 沒有透過 create_app() 啟動時 (例如直接 gunicorn v8:app)，至少在第一個請求時啟動背景工作
+    g.request_start = time.perf_counter()
+    if slow_request_seconds: request.environ.setdefault('avalon.trace', [0.0, 0.0, 0.0])
+    if not background_started: start_background_tasks()
+
+@app.after_request
+def observe_request(response):
+    # 未對應到路由的請求合併成 unmatched，避免任意路徑產生大量標籤
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    elapsed = time.perf_counter() - g.get('request_start', time.perf_counter())
+    request_seconds.observe(elapsed, route, response.status_code)
+    check_slow_request(route, response.status_code, elapsed, request.environ.get('avalon.trace'))
+    return response
+
+# --- 慢請求追蹤與剖析器開關 ---
+def trace_add(slot, seconds):
+    # 慢請求追蹤開啟時，把這段時間累計到目前請求的分項；請求以外 (例如巡邏員) 的呼叫不計
+    if slow_request_seconds and has_request_context():
+        trace = request.environ.get('avalon.trace')
+        if trace: trace[slot] += seconds
+
+def check_slow_request(route, status, elapsed, trace):
+    # 長輪詢等待新版本的時間不算在慢請求裡
+    if not slow_request_seconds or not trace: return
+    lock, wait, serialize = trace
+    if elapsed - wait < slow_request_seconds: return
+    app.logger.warning("慢請求 %s %s: %.2f ms (鎖等待 %.2f ms，長輪詢等待 %.2f ms，序列化 %.2f ms，處理邏輯 %.2f ms)",
+                       route, status, elapsed * 1000, lock * 1000, wait * 1000, serialize * 1000,
+                       (elapsed - lock - wait - serialize) * 1000)
+
+@app.route('/admin/profiler', methods=['GET', 'POST'])
+def admin_profiler():
+    # 需要 ADMIN_SECRET；POST {"profile": true/false, "hz": 取樣頻率, "slowRequestMs": 慢請求門檻 (0 關閉)}
+    # 停止取樣時寫出 folded stacks 檔案並回傳路徑
+    global slow_request_seconds
+    denied = admin_denied()
+    if denied: return denied
+    if request.method == 'POST':
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict): return jsonify({"success": False, "message": "請以 JSON 物件傳入設定"}), 400
+        slow_ms = data.get('slowRequestMs', slow_request_seconds * 1000)
+        hz = data.get('hz', PROFILE_HZ or 100)
+        if not valid_number(slow_ms, 0, float('inf')): return jsonify({"success": False, "message": "slowRequestMs 必須是不小於 0 的數字"}), 400
+        if not valid_number(hz, 0, MAX_PROFILE_HZ) or hz <= 0:
+            return jsonify({"success": False, "message": f"hz 必須是大於 0、不超過 {MAX_PROFILE_HZ} 的數字"}), 400
+        slow_request_seconds = slow_ms / 1000
+        if data.get('profile') is True: profiler.start(float(hz))
+        elif data.get('profile') is False: profiler.stop()
+    return jsonify({"success": True, "profiler": profiler.status(), "slowRequestMs": slow_request_seconds * 1000})
+
+def valid_number(value, low, high):
+    # JSON 的數字 (bool 不算)，有限且介於 [low, high]
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value) and low <= value <= high
 
-def process_mission_vote_result(room_code):
-    room = rooms[room_code]
-    state = room['gameState']
-    pc = len(room['players'])
-    fails = list(state["mission_votes"].values()).count('fail')
-    is_two_fails_mission = TWO_FAILS_MISSION_REQUIRED.get(pc) == state["mission_number"]
-    fail_threshold = 2 if is_two_fails_mission else 1
-    is_success = fails < fail_threshold
-    state["quest_track"][state["mission_number"] - 1] = "success" if is_success else "fail"
-    state["mission_history"].append({
-        "mission_num": state["mission_number"],
-        "leader": state["player_order"][state["current_leader_index"]],
-        "team": state["team_proposal"],
-        "result": "success" if is_success else "fail",
-        "fails": fails
-    })
-    check_game_phase_after_mission(room_code)
-
-def end_game(room_code, winning_team, reason=""):
-    state = rooms[room_code]['gameState']
-    state["phase"] = "end"
-    state["phase_text"] = "遊戲結束"
-    
-    # 建立一個角色到陣營的映射
-    good_roles_set = set(ALL_ROLES['good'])
-    
-    all_roles_with_faction = []
-    for p, d in state["assigned_roles"].items():
-        role = d["role"]
-        faction = "good" if role in good_roles_set else "evil"
-        all_roles_with_faction.append({"name": p, "role": role, "faction": faction})
-
-    state["game_over_data"] = {
-        "winning_team": "善良陣營" if winning_team == "good" else "邪惡陣營",
-        "reason": reason,
-        "duration": time.time() * 1000 - state["game_start_time"],
-        "all_roles": all_roles_with_faction, # 使用帶有陣營資訊的新列表
-    }
-
-def check_game_phase_after_mission(room_code):
-    state = rooms[room_code]['gameState']
-    mn = state["mission_number"]
-    if state["quest_track"].count("fail") >= 3:
-        end_game(room_code, 'evil', "壞人贏得了 3 個任務。")
-        return
-    if state["quest_track"].count("success") >= 3:
-        if "刺客" in state["roles_in_game"]:
-            state["phase"] = "assassination"; state["phase_text"] = "刺殺階段"
-            return # <--- 這裡新增 return
-        else:
-            end_game(room_code, 'good', "好人贏得了 3 個任務 (無刺客)。")
+def reaper_task():
+    # 共用儲存時只有搶到選舉鎖的行程會執行排程器；其他行程定期重試，持有者結束後即可接手
+    global scheduler_active
+    while not room_store.is_reaper(): time.sleep(REAP_INTERVAL)
+    scheduler_active = True
+    known_versions, next_sync = {}, 0
+    while True:
+        if time.time() >= next_sync:
+            start = time.perf_counter()
+            known_versions, next_sync = sync_room_deadlines(known_versions)
+            reaper_seconds.observe(time.perf_counter() - start, "sync")
+        with deadline_cond:
+            timeout = min(next_room_deadline(), next_sync) - time.time()
+            if timeout > 0: deadline_cond.wait(None if timeout == float('inf') else timeout)
+        due = take_due_rooms(time.time())
+        if not due: continue
+        start = time.perf_counter()
+        for room_code in due:
+            run_room_deadline(room_code)
+        reaper_seconds.observe(time.perf_counter() - start, "deadlines")
+
+def sync_room_deadlines(known_versions):
+    # 第一次同步排入所有既有房間 (例如從事件日誌恢復的)；共用儲存時之後也定期同步，
+    # 其他行程新增或改動的房間 (版本號不同) 會重新計算期限。回傳 (新的版本表, 下次同步時間)
+    versions = room_store.versions()
+    for room_code, version in versions.items():
+        if known_versions.get(room_code) != version: schedule_room(room_code, 0)
+    return versions, (time.time() + REAP_INTERVAL if room_store.shared else float('inf'))
+
+def next_room_deadline():
+    with deadline_cond:
+        return deadline_heap[0][0] if deadline_heap else float('inf')
+
+def take_due_rooms(now):
+    due = []
+    with deadline_cond:
+        while deadline_heap and deadline_heap[0][0] <= now:
+            when, room_code = heapq.heappop(deadline_heap)
+            if room_deadlines.get(room_code) == when:  # 否則是已被更早期限取代或已取消的舊項目
+                del room_deadlines[room_code]
+                due.append(room_code)
+    return due
+
+def run_room_deadline(room_code):
+    with locked_room(room_code) as room:
+        if not room:
+            unschedule_room(room_code)
             return
-    if state.get("lady_holder") and mn in [2, 3, 4] and mn not in state.get("lady_used_missions", []):
-        state["phase"] = "lady_of_the_lake"; state["phase_text"] = "湖中女神階段"
+        reap_room(room_code, room, time.time())
+        if rooms.get(room_code) is not room: return  # 房間已被刪除
+        run_auto_actions(room_code, room)
+        schedule_room(room_code, room_next_deadline(room))
+
+def reap_room(room_code, room, current_time):
+    if not room.players:
+        delete_room(room_code)
         return
-    advance_to_next_mission(room_code)
-
-def advance_to_next_mission(room_code):
-    state = rooms[room_code]['gameState']
-    pc = len(rooms[room_code]['players'])
-    state["mission_number"] += 1
-    state["current_leader_index"] = (state["current_leader_index"] + 1) % pc
-    state["phase"] = "team_building"; state["phase_text"] = "組建隊伍"
-    state["team_proposal"] = []; state["votes"] = {}; state["last_vote_details"] = None
-
-def advance_to_next_leader(room_code):
-    state = rooms[room_code]['gameState']
-    state["vote_reject_count"] += 1
-    if state["vote_reject_count"] >= 5:
-        end_game(room_code, 'evil', "連續 5 次投票被否決。")
-    else:
-        pc = len(rooms[room_code]['players'])
-        state["current_leader_index"] = (state["current_leader_index"] + 1) % pc
-        state["phase"] = "team_building"; state["phase_text"] = "組建隊伍"
-        state["team_proposal"] = []; state["votes"] = {}
 
-# --- 背景巡邏員 ---
-def reaper_task():
+    players_to_remove = []
+    active_players = 0
+    changed = False
+
+    # --- 這是修改後的核心邏輯 ---
+    for player in room.players:
+        time_since_seen = current_time - player.last_seen
+        is_connected = player.connected
+
+        if room.game is None:  # 處理【大廳中】的玩家
+            if time_since_seen > LOBBY_KICK_TIMEOUT:
+                players_to_remove.append(player) # 超過 60 秒，加入踢除列表
+            elif time_since_seen > TIMEOUT_SECONDS and is_connected:
+                player.connected = False # 超過 10 秒，僅標記為離線
+                changed = True
+
+        else:  # 處理【遊戲中】的玩家
+            if time_since_seen > TIMEOUT_SECONDS and is_connected:
+                player.connected = False # 超過 10 秒，標記為離線
+                changed = True
+
+        if player.connected:
+            active_players += 1
+    # --- 邏輯修改結束 ---
+
+    if players_to_remove:
+        was_host_removed = any(p.is_host for p in players_to_remove)
+
+        # ---【BUG修正】保留原始玩家順序 ---
+        removed_names = {p.name for p in players_to_remove}
+        room.players = [p for p in room.players if p.name not in removed_names]
+        for p in players_to_remove: unindex_player(room_code, p)
+        room.lobby_order = [name for name in room.lobby_order if name not in removed_names]
+        # --- 順序修正結束 ---
+
+        if was_host_removed and room.players:
+            room.players[0].is_host = True
+            room.players[0].is_ready = True
+        changed = True
+
+    if not room.players or (current_time - room.created_at > ROOM_EXPIRY and active_players == 0):
+        delete_room(room_code)
+    elif changed:
+        mark_room_changed(room_code, players_only=not players_to_remove)
+
+def run_auto_actions(room_code, room):
+    # 一次代理動作可能又輪到斷線玩家 (例如連續幾位隊長都斷線)，一路做到沒有可代理的為止；
+    # 每一次各記一筆 auto 事件，重播時逐筆對應。跳過隊長會累計否決次數，最多幾輪就會結束，上限只是保險
+    for _ in range(MAX_AUTO_ACTIONS):
+        if not check_room_auto_actions(room_code, room): return
+        mark_room_changed(room_code, ('auto',))
+
+def check_room_auto_actions(room_code, room, now=None):
+    # 回傳 True 表示有代替斷線玩家執行動作；重播事件日誌時 (傳入 now) 不計入指標
+    if not room.game: return False
+
+    state = room.game
+    pc = len(room.players)
+    if pc == 0: return False
+
+    current_leader_name = state.player_order[state.current_leader_index]
+    current_leader_player = find_player_by_name(room_code, current_leader_name)
+
+    if state.phase == Phase.TEAM_BUILDING and current_leader_player and not current_leader_player.connected:
+        game_engine.advance_to_next_leader(state, [p.name for p in room.players], now)
+        if now is None: auto_actions.inc("skip_leader")
+        return True
+
+    acted = False
+    connected_players = [p for p in room.players if p.connected]
+    all_connected_voted = lambda votes, players: all(p.name in votes for p in players)
+
+    if state.phase == Phase.TEAM_VOTE:
+        if all_connected_voted(state.votes, connected_players) and len(state.votes) < pc:
+            for p in room.players:
+                if not p.connected and p.name not in state.votes:
+                    state.votes[p.name] = Vote.REJECT
+            game_engine.check_vote_complete(state, [p.name for p in room.players], now)
+            if now is None: auto_actions.inc("team_vote")
+            acted = True
+
+    if state.phase == Phase.MISSION_VOTE:
+        team_members = [find_player_by_name(room_code, name) for name in state.team_proposal]
+        connected_team_members = [p for p in team_members if p and p.connected]
+        if all_connected_voted(state.mission_votes, connected_team_members) and len(state.mission_votes) < len(team_members):
+            for p in team_members:
+                if p and not p.connected and p.name not in state.mission_votes:
+                    state.mission_votes[p.name] = Vote.SUCCESS
+            game_engine.check_vote_complete(state, [p.name for p in room.players], now)
+            if now is None: auto_actions.inc("mission_vote")
+            acted = True
+    return acted
+
+# --- 排空與房間遷移 (部署新版本時不中斷遊戲) ---
+# 部署流程: 啟動新行程並等它的 /readyz 回 200 -> 對舊行程 POST /admin/drain -> 等 GET /admin/drain 的 rooms 歸零後結束舊行程
+# (/admin/drain 需帶 X-Admin-Secret，見「管理介面」一節)
+# 排空期間 /readyz 回 503 (負載平衡器不再送新流量過來)，不再建立房間或開始新的一局，進行中的遊戲照常進行
+# 指定 target (新行程的內部網址) 時，背景執行緒把房間 (玩家、token、遊戲狀態) 整個交給新行程的 /migrate/room：
+# 大廳與已結束的房間立刻移交，進行中的遊戲等這局結束後再移交 (migrateGames 為 true 時也立刻移交)
+# 已移交房間的請求一律回 410 與 movedTo (客戶端之後改連的網址前綴，預設空字串表示同一個網域，由負載平衡器送到新行程)，
+# 客戶端改向 movedTo 呼叫 /reconnect，以原本的 token 繼續遊戲
+# 行程之間以 MIGRATION_SECRET 驗證 (新舊行程需相同)，未設定時不接受移入；
+# 共用儲存 (ROOM_STORE=sqlite) 的房間不屬於單一行程，只需排空、不需遷移
+MIGRATION_SECRET = os.environ.get("MIGRATION_SECRET")
+MIGRATION_TIMEOUT = 5  # 移交一個房間的 HTTP 逾時 (秒)，期間該房間的請求會等待房間鎖
+DRAIN_INTERVAL = 1     # 排空時檢查可移交房間的間隔 (秒)
+draining = None        # 排空中時為 {"since", "target", "publicUrl", "migrateGames"}，整個換掉
+drain_thread = None
+moved_rooms = {}       # room_code -> movedTo，本行程已移交出去的房間
+migrated_rooms = metrics.counter("avalon_migrated_rooms_total", "遷移的房間 (direction=out 移出、in 移入)", ["direction", "result"])
+metrics.gauge("avalon_draining", "本行程是否在排空中", lambda: int(draining is not None))
+
+def room_moved(room_code):
+    response = jsonify({"success": False, "message": "房間已移到新的伺服器，正在重新連線", "movedTo": moved_rooms[room_code]})
+    response.status_code = 410
+    return response
+
+def room_not_found(room_code):
+    # 長輪詢等待期間房間被移交時也會走到這裡
+    if room_code in moved_rooms: return room_moved(room_code)
+    return jsonify({"success": False, "message": "房間不存在"}), 404
+
+@app.before_request
+def redirect_moved_rooms():
+    if not moved_rooms or request.method != 'POST': return None
+    data = request.get_json(silent=True)
+    room_code = data.get('roomCode') if isinstance(data, dict) else None
+    if isinstance(room_code, str) and room_code in moved_rooms: return room_moved(room_code)
+    return None
+
+def room_in_progress(room):
+    return room.game is not None and room.game.phase != Phase.END
+
+def drain_status():
+    room_count, player_count = room_store.usage()
+    config = draining or {}
+    return {"draining": draining is not None, "since": config.get("since"), "target": config.get("target"),
+            "rooms": room_count, "players": player_count, "activeGames": sum(room_in_progress(r) for r in list(rooms.values())),
+            "movedRooms": len(moved_rooms)}
+
+def migrate_room(room_code, config):
+    # 在房間鎖內序列化並送出，送出期間房間不會再變動；新行程接受後才在本行程刪除，失敗時房間原封不動留下
+    # 回傳是否已移交；連線失敗時拋出 urllib.error.URLError / OSError
+    with locked_room(room_code) as room:
+        if not room or (room_in_progress(room) and not config["migrateGames"]): return False
+        body = encode_json({"roomCode": room_code, "room": room_to_dict(room)})
+        req = urllib.request.Request(config["target"].rstrip('/') + '/migrate/room', data=body, method='POST',
+                                     headers={"Content-Type": "application/json", "X-Migration-Secret": MIGRATION_SECRET or ""})
+        try:
+            with urllib.request.urlopen(req, timeout=MIGRATION_TIMEOUT): pass
+        except (urllib.error.URLError, OSError):
+            migrated_rooms.inc("out", "failed")
+            raise
+        moved_rooms[room_code] = config["publicUrl"]
+        delete_room(room_code)
+    migrated_rooms.inc("out", "ok")
+    return True
+
+def drain_task():
+    # 每隔 DRAIN_INTERVAL 掃描一次本行程的房間；取消排空或不再指定 target 時結束
+    # 新行程拒絕某個房間 (例如房號衝突) 時略過它繼續下一個，連不上新行程時整輪放棄、下一輪重試；同一個原因只印一次
+    reported = set()
+    while draining and draining["target"]:
+        config = draining
+        for room_code in room_store.codes():
+            try:
+                migrate_room(room_code, config)
+            except urllib.error.HTTPError as e:
+                if (room_code, e.code) not in reported: print(f"新行程拒絕房間 {room_code}: HTTP {e.code}", file=sys.stderr)
+                reported.add((room_code, e.code))
+            except (urllib.error.URLError, OSError) as e:
+                if str(e) not in reported: print(f"無法連線到新行程 {config['target']}: {e}", file=sys.stderr)
+                reported.add(str(e))
+                break
+        time.sleep(DRAIN_INTERVAL)
+
+@app.route('/admin/drain', methods=['GET', 'POST'])
+def admin_drain():
+    # 需要 ADMIN_SECRET；POST {"drain": true/false, "target": 新行程的網址, "publicUrl": 客戶端改連的網址前綴, "migrateGames": bool}
+    # 回傳排空進度，rooms 歸零後即可結束本行程
+    global draining, drain_thread
+    denied = admin_denied()
+    if denied: return denied
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        target, public_url = data.get('target') or None, data.get('publicUrl') or ""
+        if data.get('drain') is False:
+            draining = None
+        elif data.get('drain') is True:
+            if target is not None and not isinstance(target, str) or not isinstance(public_url, str):
+                return jsonify({"success": False, "message": "target 與 publicUrl 必須是字串"}), 400
+            if target and room_store.shared: return jsonify({"success": False, "message": "共用儲存的房間不需要遷移，只需排空"}), 400
+            if target and not MIGRATION_SECRET: return jsonify({"success": False, "message": "未設定 MIGRATION_SECRET"}), 400
+            draining = {"since": draining["since"] if draining else time.time(), "target": target, "publicUrl": public_url,
+                        "migrateGames": bool(data.get('migrateGames'))}
+            if target and not (drain_thread and drain_thread.is_alive()):
+                drain_thread = threading.Thread(target=drain_task, name="drain", daemon=True)
+                drain_thread.start()
+    return jsonify({"success": True, **drain_status()})
+
+@app.route('/migrate/room', methods=['POST'])
+def migrate_room_in():
+    # 接收舊行程移交的房間；同一個房間重送 (例如上次的回應逾時) 時，以版本號較新的為準
+    secret = request.headers.get('X-Migration-Secret', '')
+    if not MIGRATION_SECRET or not hmac.compare_digest(secret.encode(), MIGRATION_SECRET.encode()):
+        return jsonify({"success": False, "message": "遷移驗證失敗"}), 403
+    if room_store.shared: return jsonify({"success": False, "message": "共用儲存不接受遷移"}), 409
+    if draining: return reject_busy("draining", "本行程也在排空中")
+    data = request.get_json(silent=True) or {}
+    room_code = data.get('roomCode')
+    try:
+        room = room_from_dict(data['room'])
+    except (KeyError, TypeError, ValueError):
+        return jsonify({"success": False, "message": "無效的房間資料"}), 400
+    if not isinstance(room_code, str) or not room_code: return jsonify({"success": False, "message": "無效的房號"}), 400
+    now = time.time()
+    for p in room.players: p.last_seen = now  # 給玩家重新連線的時間
+    inserted = room_store.insert(room_code, room, is_joinable(room))
+    if inserted:
+        with rooms_lock: init_room_runtime(room_code)
+    with locked_room(room_code) as existing:
+        if existing is None: return jsonify({"success": False, "message": "房間已被刪除"}), 409
+        if not inserted and existing.created_at != room.created_at: return jsonify({"success": False, "message": "房號已被使用"}), 409
+        if inserted or existing.version <= room.version:
+            reindex_room(room_code, room)
+            moved_rooms.pop(room_code, None)
+            # 版本號 +1：客戶端重新連線時一定拿到完整狀態；事件日誌記下整個房間
+            mark_room_changed(room_code, ('room',))
+            # 重送時 rooms 裡已換成新物件，locked_room 結束時不會寫回，這裡自己更新可加入清單與人數
+            room_store.save(room_code, room, is_joinable(room))
+    migrated_rooms.inc("in", "ok")
+    return jsonify({"success": True, "roomCode": room_code})
+
+# --- 事件日誌：快照與重播 ---
+def snapshot_task():
     while True:
-        time.sleep(REAP_INTERVAL)
-        with rooms_lock:
-            current_time = time.time()
-            rooms_to_delete = []
-            for room_code, room in list(rooms.items()):
-                if not room['players']:
-                    rooms_to_delete.append(room_code)
-                    continue
-                    
-                players_to_remove = []
-                active_players = 0
-
-                # --- 這是修改後的核心邏輯 ---
-                for player in room['players']:
-                    time_since_seen = current_time - player['last_seen']
-                    is_connected = player['status'] == 'connected'
-
-                    if room['gameState'] is None:  # 處理【大廳中】的玩家
-                        if time_since_seen > LOBBY_KICK_TIMEOUT:
-                            players_to_remove.append(player) # 超過 60 秒，加入踢除列表
-                        elif time_since_seen > TIMEOUT_SECONDS and is_connected:
-                            player['status'] = 'disconnected' # 超過 10 秒，僅標記為離線
-                    
-                    else:  # 處理【遊戲中】的玩家
-                        if time_since_seen > TIMEOUT_SECONDS and is_connected:
-                            player['status'] = 'disconnected' # 超過 10 秒，標記為離線
-                    
-                    if player['status'] == 'connected':
-                        active_players += 1
-                # --- 邏輯修改結束 ---
-
-                if players_to_remove:
-                    was_host_removed = any(p['isHost'] for p in players_to_remove)
-                    
-                    # ---【BUG修正】保留原始玩家順序 ---
-                    removed_names = {p['name'] for p in players_to_remove}
-                    room['players'] = [p for p in room['players'] if p not in players_to_remove]
-                    room['lobbyPlayerOrder'] = [name for name in room['lobbyPlayerOrder'] if name not in removed_names]
-                    # --- 順序修正結束 ---
-
-                    if was_host_removed and room['players']:
-                        room['players'][0]['isHost'] = True
-                        room['players'][0]['isReady'] = True
-
-                if not room['players'] or (current_time - room.get('created_at', current_time) > 3600 and active_players == 0):
-                    rooms_to_delete.append(room_code)
-
-            for code in rooms_to_delete:
-                if code in rooms: del rooms[code]
-
-        check_for_auto_actions()
-
-def check_for_auto_actions():
-    with rooms_lock:
-        for room_code, room in list(rooms.items()):
-            if not room.get('gameState'): continue
-
-            state = room['gameState']
-            pc = len(room['players'])
-            if pc == 0: continue
-
-            current_leader_name = state['player_order'][state['current_leader_index']]
-            current_leader_player = find_player_by_name(room, current_leader_name)
-
-            if state['phase'] == 'team_building' and current_leader_player and current_leader_player['status'] == 'disconnected':
-                advance_to_next_leader(room_code)
-                continue
-            
-            connected_players = [p for p in room['players'] if p['status'] == 'connected']
-            all_connected_voted = lambda votes, players: all(p['name'] in votes for p in players)
-
-            if state['phase'] == 'team_vote':
-                if all_connected_voted(state['votes'], connected_players) and len(state['votes']) < pc:
-                    for p in room['players']:
-                        if p['status'] == 'disconnected' and p['name'] not in state['votes']:
-                            state['votes'][p['name']] = 'reject'
-                    process_game_action(room_code, "server", "internal_check_vote_complete")
-
-            if state['phase'] == 'mission_vote':
-                team_members = [find_player_by_name(room, name) for name in state['team_proposal']]
-                connected_team_members = [p for p in team_members if p and p['status'] == 'connected']
-                if all_connected_voted(state['mission_votes'], connected_team_members) and len(state['mission_votes']) < len(team_members):
-                    for p in team_members:
-                        if p and p['status'] == 'disconnected' and p['name'] not in state['mission_votes']:
-                            state['mission_votes'][p['name']] = 'success'
-                    process_game_action(room_code, "server", "internal_check_vote_complete")
+        time.sleep(SNAPSHOT_INTERVAL)
+        take_snapshot()
+
+def take_snapshot():
+    # 先切換日誌分段，再逐一 (各自上鎖) 複製房間；快照涵蓋舊分段的所有紀錄，
+    # 新分段中已反映在快照裡的紀錄，重播時會依版本號略過
+    segment = game_log.rotate()
+    room_texts = {}
+    for room_code in room_store.codes():
+        with locked_room(room_code) as room:
+            if room: room_texts[room_code] = encode_json(room_to_dict(room)).decode()
+    game_log.write_snapshot(segment, room_texts)
+
+def install_room(room_code, room):
+    with rooms_lock: init_room_runtime(room_code)
+    reindex_room(room_code, room)
+
+def replay_record(record):
+    ts, room_code, version, kind, args = record
+    room = rooms.get(room_code)
+    if kind == 'delete':
+        if room:
+            with room_runtime[room_code]['cond']:  # forget_room 會喚醒等待者，需持有房間鎖
+                room_store.delete(room_code)
+                forget_room(room_code)
+        return
+    if kind == 'room':
+        if not room or room.version < version: install_room(room_code, room_from_dict(args[0]))
+        return
+    if not room or version <= room.version: return
+
+    if kind == 'lobby':
+        room = with_lobby(room, args[0])
+        install_room(room_code, room)
+    elif kind == 'action':
+        # 以事件發生的時間 (而不是重播的時間) 計算遊戲時長
+        process_game_action(room_code, *args, now=ts)
+    elif kind == 'actions':
+        player_name, batch = args
+        for action, value in batch: process_game_action(room_code, player_name, action, value, now=ts)
+    elif kind == 'auto':
+        check_room_auto_actions(room_code, room, now=ts)
+    room.version = version
+
+def recover_rooms():
+    # 啟動時由快照 + 日誌重建所有房間；玩家的最後上線時間重設為現在，給大家重新連線的時間
+    snapshot_rooms, records = game_log.load()
+    for room_code, room in snapshot_rooms.items():
+        install_room(room_code, room_from_dict(room))
+    replayed = 0
+    for record in records:
+        replay_record(record)
+        replayed += 1
+    now = time.time()
+    for room_code, room in list(rooms.items()):
+        for p in room.players: p.last_seen = now
+        room_store.save(room_code, room, is_joinable(room))
+    return len(rooms), replayed
+
+if game_log:
+    recovered_rooms, replayed_records = recover_rooms()
+    print(f"已從事件日誌恢復 {recovered_rooms} 個房間 (重播 {replayed_records} 筆紀錄)。")
 
 # --- 伺服器啟動 ---
 if __name__ == "__main__":
-    reaper_thread = threading.Thread(target=reaper_task, daemon=True)
-    reaper_thread.start()
+    create_app()
     print("背景巡邏員已啟動。")
     # Render 會透過環境變數設定 PORT，若無則預設為 10000
     # 監聽 0.0.0.0 以便從外部訪問
@@ -0,0 +1,103 @@
+# 精簡的二進位傳輸格式 (給網路較差的行動裝置)：MessagePack，不依賴外部套件
+# 欄位名稱、階段、角色、投票結果等固定字串都在 STRINGS 字典裡，送出時只寫索引 (ext 型別 0，共 3 bytes)；
+# 客戶端只需取得字典一次 (內嵌在網頁裡，或 GET /wire/dictionary)
+# 快照裡存的是 JSON 片段，這裡以「JSON 片段 -> MessagePack 片段」的快取轉換；相同的片段物件在各版本間共用，大多直接命中
+import hashlib
+import json
+import struct
+from functools import lru_cache
+
+from game_engine import PHASE_NAMES, PHASE_TEXTS, QUEST_NAMES, ROLE_NAMES, VOTE_NAMES
+
+MIMETYPE = "application/x-msgpack"
+STRING_EXT = 0  # 字典字串的 ext 型別，資料為索引 (1 或 2 bytes，big-endian)
+
+# 順序就是索引，只能在最後面新增；字典內容變動時 DICTIONARY_ID 會跟著改變
+STRINGS = PHASE_NAMES + PHASE_TEXTS + ROLE_NAMES + VOTE_NAMES + QUEST_NAMES + (
+    "good", "evil", "善良陣營", "邪惡陣營", "connected", "disconnected", "lady_reveal",
+    # 回應與差異
+    "version", "base_version", "delta", "set", "unset", "patch", "success", "message", "failedIndex",
+    # 房間與大廳
+    "players", "name", "isHost", "isReady", "status", "gameState", "lobbyPlayerOrder", "roomPassword", "settings",
+    "maxPlayers", "hasPassword", "useLady", "randomizeOrder", "customRoles", "missionTrack", "allowSpectators", "spectatorDelay",
+    # 遊戲狀態
+    "phase", "phase_text", "player_order", "current_leader", "mission_number", "quest_track", "team_proposal", "voted",
+    "mission_voted", "mission_team_sizes", "mission_team_size", "lady_used_on", "game_start_time", "last_vote_details",
+    "mission_history", "all_possible_roles", "game_over_data", "my_info", "is_leader", "my_vote", "my_mission_vote",
+    "is_on_mission", "is_lady_holder", "vote", "mission_num", "leader", "team", "result", "fails",
+    "winning_team", "reason", "duration", "all_roles", "role", "faction", "is_evil", "role_info", "known_evil", "events",
+    "type", "to", "target", "text",
+)
+STRING_INDEX = {s: i for i, s in enumerate(STRINGS)}
+DICTIONARY_ID = hashlib.sha1(json.dumps(STRINGS, ensure_ascii=False).encode()).hexdigest()[:12]
+
+
+def pack_str(s):
+    i = STRING_INDEX.get(s)
+    data = s.encode()
+    n = len(data)
+    if i is not None and n > 2:
+        return b'\xd4\x00' + bytes((i,)) if i < 256 else b'\xd5\x00' + struct.pack('>H', i)
+    if n < 32: return bytes((0xa0 | n,)) + data
+    if n < 0x100: return b'\xd9' + bytes((n,)) + data
+    if n < 0x10000: return b'\xda' + struct.pack('>H', n) + data
+    return b'\xdb' + struct.pack('>I', n) + data
+
+def pack_int(n):
+    if 0 <= n < 0x80: return bytes((n,))
+    if -32 <= n < 0: return struct.pack('>b', n)
+    if n >= 0:
+        if n < 0x100: return b'\xcc' + bytes((n,))
+        if n < 0x10000: return b'\xcd' + struct.pack('>H', n)
+        if n < 0x100000000: return b'\xce' + struct.pack('>I', n)
+        return b'\xcf' + struct.pack('>Q', n)
+    if n >= -0x80: return b'\xd0' + struct.pack('>b', n)
+    if n >= -0x8000: return b'\xd1' + struct.pack('>h', n)
+    if n >= -0x80000000: return b'\xd2' + struct.pack('>i', n)
+    return b'\xd3' + struct.pack('>q', n)
+
+def array_header(n):
+    if n < 16: return bytes((0x90 | n,))
+    return b'\xdc' + struct.pack('>H', n) if n < 0x10000 else b'\xdd' + struct.pack('>I', n)
+
+def map_header(n):
+    if n < 16: return bytes((0x80 | n,))
+    return b'\xde' + struct.pack('>H', n) if n < 0x10000 else b'\xdf' + struct.pack('>I', n)
+
+def pack(value):
+    if value is None: return b'\xc0'
+    if value is True: return b'\xc3'
+    if value is False: return b'\xc2'
+    if isinstance(value, int): return pack_int(value)
+    if isinstance(value, float):
+        # 整數值的浮點數 (例如毫秒時間戳) 以整數送出，省下 float64 的 9 bytes
+        return pack_int(int(value)) if value.is_integer() else b'\xcb' + struct.pack('>d', value)
+    if isinstance(value, str): return pack_str(value)
+    if isinstance(value, (list, tuple)): return array_header(len(value)) + b''.join(pack(v) for v in value)
+    if isinstance(value, dict): return map_header(len(value)) + b''.join(pack_key(k) + pack(v) for k, v in value.items())
+    raise TypeError(f"無法編碼的型別: {type(value).__name__}")
+
+@lru_cache(maxsize=1024)
+def pack_key(key):
+    return pack_str(str(key))
+
+@lru_cache(maxsize=65536)
+def pack_fragment(fragment):
+    # JSON 片段 (bytes) -> MessagePack 片段；以片段內容為鍵，未變動的欄位每次都命中
+    return pack(json.loads(fragment))
+
+def pack_fragments(frags):
+    # 與 join_fragments 相同的結構 (欄位 -> 片段，gameState 再往下一層)，輸出 MessagePack map
+    return map_header(len(frags)) + b''.join(pack_key(k) + (pack_fragments(v) if isinstance(v, dict) else pack_fragment(v))
+                                             for k, v in frags.items())
+
+def pack_delta(version, base_version, delta):
+    # 與 JSON 的差異回應相同的結構: {"version", "base_version", "delta": {"set", "unset", "patch"}}
+    return (map_header(3) + pack_key("version") + pack_int(version) + pack_key("base_version") + pack_int(base_version)
+            + pack_key("delta") + pack_delta_body(delta))
+
+def pack_delta_body(delta):
+    if not delta: return pack({"set": {}, "unset": [], "patch": {}})
+    patch = map_header(len(delta['patch'])) + b''.join(pack_key(k) + pack_delta_body(v) for k, v in delta['patch'].items())
+    return (map_header(3) + pack_key("set") + pack_fragments(delta["set"]) + pack_key("unset") + pack(delta["unset"])
+            + pack_key("patch") + patch)